@@ -0,0 +1,58 @@
+"""
+Brightspace Role Permissions Exporter - importable engine and CLI.
+
+The Streamlit app (brightspace_role_exporter_v3.py) is a thin UI over
+`brightspace_exporter.engine`; `python -m brightspace_exporter` runs the
+same discovery and export steps from the command line.
+"""
+
+import importlib
+
+# Public name -> submodule. Imported on first use, so `import brightspace_exporter.engine`
+# and the CLI subcommands only load the modules (and optional packages) they need.
+_EXPORTS = {
+    'ArchiveSizeExceeded': 'archive',
+    'PipelinedArchiveWriter': 'archive',
+    'SpooledArchive': 'archive',
+    'load_batch_targets': 'batch',
+    'run_batch_export': 'batch',
+    'build_permission_dataset': 'dataset',
+    'parse_role_file': 'dataset',
+    'write_permission_dataset': 'dataset',
+    'diff_archives': 'diff',
+    'ExportPathSelector': 'export_paths',
+    'RoleContentCache': 'incremental',
+    'ExportJobQueue': 'jobs',
+    'ExportManifest': 'manifest',
+    'build_permission_index': 'permission_index',
+    'query_permissions': 'permission_index',
+    'RateController': 'rate_limit',
+    'ExportTimings': 'timings',
+    'write_permission_workbook': 'xlsx_report',
+    'PLAYWRIGHT_AVAILABLE': 'engine',
+    'BrowserPool': 'engine',
+    'check_whoami': 'engine',
+    'discover_roles': 'engine',
+    'ensure_playwright_browsers': 'engine',
+    'export_one_role_http': 'engine',
+    'export_one_role_v2': 'engine',
+    'export_roles_to_archive': 'engine',
+    'fetch_roles_via_api': 'engine',
+    'fetch_roles_via_ui_scrape': 'engine',
+    'install_playwright_browsers': 'engine',
+    'playwright_browsers_installed': 'engine',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{_EXPORTS[name]}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
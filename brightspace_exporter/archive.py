@@ -0,0 +1,554 @@
+"""
+Archive output for exported role files.
+
+Downloads are handed to a PipelinedArchiveWriter in fixed-size chunks and
+compressed on a separate writer thread, so memory per role stays bounded
+and the network never waits on the compressor. The archive (ZIP, or
+tar.zst when the optional `zstandard` package is installed) can be written
+to a path or to a SpooledArchive, which keeps small archives in memory and
+rolls larger ones over to an anonymous temp file.
+"""
+
+import csv
+import hashlib
+import io
+import os
+import queue
+import struct
+import tarfile
+import tempfile
+import threading
+import time
+import weakref
+import zipfile
+import zlib
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+# Attempt to import zstandard (optional, enables tar.zst output)
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DEFAULT_ENTRY_BUFFER_BYTES = 4 * 1024 * 1024
+DEFAULT_SPOOL_MEMORY_LIMIT = 32 * 1024 * 1024
+DEFAULT_ARCHIVE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+# Written into deduplicated archives: which files were stored once under another name
+DUPLICATES_MANIFEST_NAME = '_duplicates.csv'
+
+
+class ArchiveSizeExceeded(Exception):
+    """Raised when a SpooledArchive would grow past its size cap."""
+
+
+def format_bytes(size: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+
+
+class SpooledArchive:
+    """
+    Seekable, size-capped output file for ZipFile.
+
+    Stays in memory up to `memory_limit` bytes, then rolls over to an
+    anonymous temporary file (never a named path, and removed by the OS as
+    soon as it is closed). Writing past `max_size` raises ArchiveSizeExceeded.
+    The spool is closed by close(), or when the object is garbage collected,
+    e.g. when the Streamlit session holding it ends.
+    """
+
+    def __init__(self, memory_limit: int = DEFAULT_SPOOL_MEMORY_LIMIT, max_size: Optional[int] = DEFAULT_ARCHIVE_MAX_SIZE):
+        self.memory_limit = memory_limit
+        self.max_size = max_size
+        self.size = 0
+        self._file = tempfile.SpooledTemporaryFile(max_size=memory_limit)
+        # Guards the shared file position between the writer and open_reader() handles
+        self._lock = threading.RLock()
+        self._finalizer = weakref.finalize(self, self._file.close)
+
+    # --- file protocol used by zipfile ---
+    def write(self, data: bytes) -> int:
+        with self._lock:
+            position = self._file.tell()
+            if self.max_size is not None and position + len(data) > self.max_size:
+                raise ArchiveSizeExceeded(f"Archive exceeded the {format_bytes(self.max_size)} cap")
+            written = self._file.write(data)
+            self.size = max(self.size, position + written)
+            return written
+
+    def tell(self) -> int:
+        with self._lock:
+            return self._file.tell()
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        with self._lock:
+            return self._file.seek(offset, whence)
+
+    def read(self, size: int = -1) -> bytes:
+        with self._lock:
+            return self._file.read(size)
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        """Reads `size` bytes at `offset` without moving the position the writer uses."""
+        with self._lock:
+            position = self._file.tell()
+            try:
+                self._file.seek(offset)
+                return self._file.read(size)
+            finally:
+                self._file.seek(position)
+
+    def flush(self) -> None:
+        with self._lock:
+            self._file.flush()
+
+    def truncate(self, size: Optional[int] = None) -> int:
+        # Used by ZipFile when appending to an existing archive
+        with self._lock:
+            self._file.truncate(size)
+            self.size = self._file.tell() if size is None else size
+            return self.size
+
+    def seekable(self) -> bool:
+        return True
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    def close(self) -> None:
+        self._finalizer()
+
+    # --- helpers ---
+    @property
+    def on_disk(self) -> bool:
+        # SpooledTemporaryFile rolls over once its position passes max_size
+        return self.size > self.memory_limit
+
+    def memory_footprint(self) -> Dict[str, int]:
+        """Bytes of this archive currently held in process memory vs spooled to disk."""
+        return {
+            'archive_bytes': self.size,
+            'in_memory_bytes': 0 if self.on_disk else self.size,
+            'on_disk_bytes': self.size if self.on_disk else 0,
+        }
+
+    def open_reader(self) -> BinaryIO:
+        """
+        Returns a new read-only file over the archive with its own position,
+        so several readers (downloads, indexing) can run at once. Close it
+        when done; the archive itself stays open.
+        """
+        return io.BufferedReader(_ArchiveReader(self), buffer_size=DOWNLOAD_CHUNK_SIZE)
+
+    def getvalue(self) -> bytes:
+        """Copies the whole archive into memory through a reader of its own, e.g. to serve a download."""
+        with self.open_reader() as reader:
+            return reader.read()
+
+
+class _ArchiveReader(io.RawIOBase):
+    """Independent read position over a SpooledArchive; every read runs under the archive's lock."""
+
+    def __init__(self, archive: SpooledArchive):
+        super().__init__()
+        self._archive = archive
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._archive.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError("Negative seek position")
+        self._position = position
+        return position
+
+    def tell(self) -> int:
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        data = self._archive.read_at(self._position, len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+# --- CONTAINERS & COMPRESSION ---
+# Preset -> (zip compression, zip level, zstd level). zstd has no "store" mode, so it uses its fastest level.
+COMPRESSION_PRESETS = {
+    'store': (zipfile.ZIP_STORED, None, 1),
+    'fast': (zipfile.ZIP_DEFLATED, 1, 1),
+    'default': (zipfile.ZIP_DEFLATED, 6, 3),
+    'max': (zipfile.ZIP_DEFLATED, 9, 19),
+}
+ARCHIVE_FORMATS = {
+    'zip': ('.zip', 'application/zip'),
+    'tar.zst': ('.tar.zst', 'application/zstd'),
+}
+
+
+def available_archive_formats() -> List[str]:
+    return [name for name in ARCHIVE_FORMATS if name != 'tar.zst' or ZSTD_AVAILABLE]
+
+
+def archive_base_path(path: str) -> str:
+    """Archive path without its extension, for files written next to it: roles.tar.zst -> roles"""
+    extension = ARCHIVE_FORMATS['tar.zst'][0]
+    return path[:-len(extension)] if path.endswith(extension) else os.path.splitext(path)[0]
+
+
+class _ZipContainer:
+    def __init__(self, target: Union[str, BinaryIO], compression: str, append: bool = False):
+        zip_compression, zip_level, _ = COMPRESSION_PRESETS[compression]
+        if append and not isinstance(target, str):
+            target.seek(0)
+        self.zip_archive = zipfile.ZipFile(target, 'a' if append else 'w', zip_compression, compresslevel=zip_level)
+
+    def write_entry(self, arcname: str, chunks: Iterable[bytes]) -> None:
+        with self.zip_archive.open(arcname, 'w') as entry:
+            for chunk in chunks:
+                entry.write(chunk)
+
+    def write_staged(self, arcname: str, staged: BinaryIO, size: int) -> None:
+        self.write_entry(arcname, iter(lambda: staged.read(DOWNLOAD_CHUNK_SIZE), b''))
+
+    def write_link(self, arcname: str, target: str) -> None:
+        # ZIP has no portable hard links; the duplicates manifest records the mapping
+        pass
+
+    def close(self) -> None:
+        self.zip_archive.close()
+
+
+class _TarZstdContainer:
+    def __init__(self, target: Union[str, BinaryIO], compression: str, entry_buffer_bytes: int):
+        if not ZSTD_AVAILABLE:
+            raise RuntimeError("tar.zst output needs the 'zstandard' package")
+        self._owns_file = isinstance(target, str)
+        self._raw = open(target, 'wb') if self._owns_file else target
+        self._zstd = zstandard.ZstdCompressor(level=COMPRESSION_PRESETS[compression][2]).stream_writer(self._raw, closefd=False)
+        self._tar = tarfile.open(fileobj=self._zstd, mode='w|')
+        self._entry_buffer_bytes = entry_buffer_bytes
+
+    def write_entry(self, arcname: str, chunks: Iterable[bytes]) -> None:
+        # Tar headers carry the size up front, so each entry is staged first
+        # (in memory, spilling to an anonymous temp file only for very large files)
+        with tempfile.SpooledTemporaryFile(max_size=self._entry_buffer_bytes) as staged:
+            for chunk in chunks:
+                staged.write(chunk)
+            size = staged.tell()
+            staged.seek(0)
+            self.write_staged(arcname, staged, size)
+
+    def write_staged(self, arcname: str, staged: BinaryIO, size: int) -> None:
+        info = tarfile.TarInfo(arcname)
+        info.size = size
+        info.mtime = int(time.time())
+        self._tar.addfile(info, staged)
+
+    def write_link(self, arcname: str, target: str) -> None:
+        # A hard link member: no payload, extracted as a copy of `target`
+        info = tarfile.TarInfo(arcname)
+        info.type = tarfile.LNKTYPE
+        info.linkname = target
+        info.mtime = int(time.time())
+        self._tar.addfile(info)
+
+    def close(self) -> None:
+        self._tar.close()
+        self._zstd.close()
+        if self._owns_file:
+            self._raw.close()
+
+
+# --- PIPELINED WRITER ---
+_END = object()
+_ABORT = object()
+
+
+class PipelinedArchiveWriter:
+    """
+    Producer/consumer archive writer. Export workers (producers) hand each
+    download over as a stream of chunks and go straight back to the network;
+    a single writer thread (consumer) compresses and writes the entries.
+
+    Memory is bounded: at most `max_pending_entries` entries are queued,
+    each holding at most `entry_buffer_bytes` of not-yet-written chunks;
+    an entry that outgrows the buffer is staged in a spooled temp file.
+    Entries are written only once complete, so a download that fails
+    midway leaves nothing behind in the archive.
+
+    Errors from the writer thread (e.g. ArchiveSizeExceeded) are kept in
+    `error`; the export stops pulling new roles once it is set.
+
+    `on_entry_written(arcname, size, sha256, stored_as)` is called from the
+    writer thread after each entry is committed, for checkpointing.
+    `append=True` adds entries to an existing ZIP (used to resume an export).
+
+    With `dedup=True` every entry is hashed before it is written, and a
+    payload identical to an earlier entry is stored only once: tar.zst gets
+    a hard link, a ZIP simply omits the copy. `stored_as` names the entry
+    holding the bytes, and the mapping is also written into the archive as
+    DUPLICATES_MANIFEST_NAME. Dedup is off when appending.
+    """
+
+    def __init__(self, target: Union[str, BinaryIO], archive_format: str = 'zip', compression: str = 'default', max_pending_entries: int = 8, entry_buffer_bytes: int = DEFAULT_ENTRY_BUFFER_BYTES, append: bool = False, on_entry_written: Optional[Callable[[str, int, str, str], None]] = None, dedup: bool = False):
+        if compression not in COMPRESSION_PRESETS:
+            raise ValueError(f"Unknown compression preset: {compression}")
+        if archive_format == 'zip':
+            self._container = _ZipContainer(target, compression, append=append)
+        elif append:
+            raise ValueError("Resuming is only supported for ZIP archives")
+        elif archive_format == 'tar.zst':
+            self._container = _TarZstdContainer(target, compression, entry_buffer_bytes)
+        else:
+            raise ValueError(f"Unknown archive format: {archive_format}")
+        self.error: Optional[Exception] = None
+        self._closed = False
+        self._on_entry_written = on_entry_written
+        self._dedup = dedup and not append
+        self._stored: Dict[str, str] = {}
+        self.duplicates: List[Dict[str, object]] = []
+        self._entry_buffer_bytes = entry_buffer_bytes
+        self._entry_buffer_chunks = max(1, entry_buffer_bytes // DOWNLOAD_CHUNK_SIZE)
+        self._entries = queue.Queue(maxsize=max_pending_entries)
+        self._writer = threading.Thread(target=self._writer_main, daemon=True)
+        self._writer.start()
+
+    def __enter__(self) -> 'PipelinedArchiveWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def write_stream(self, arcname: str, chunks: Iterable[bytes]) -> int:
+        """
+        Queues `chunks` as a new entry and returns the number of bytes handed
+        over. Returns once the last chunk is queued, not once it is written.
+        """
+        if self.error is not None:
+            raise self.error
+        chunk_queue = queue.Queue(maxsize=self._entry_buffer_chunks)
+        self._put(self._entries, (arcname, chunk_queue))
+        size = 0
+        try:
+            for chunk in chunks:
+                if chunk:
+                    self._put(chunk_queue, chunk)
+                    size += len(chunk)
+        except BaseException:
+            if not self._closed:
+                chunk_queue.put(_ABORT)
+            raise
+        self._put(chunk_queue, _END)
+        return size
+
+    def _put(self, target_queue: queue.Queue, item) -> None:
+        # Producers must never block forever on a writer that has been closed underneath them
+        while True:
+            if self._closed:
+                raise RuntimeError("Archive writer is closed")
+            try:
+                target_queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def write_file(self, arcname: str, path: str) -> int:
+        """Streams a file from disk into a new entry and returns its size."""
+        with open(path, 'rb') as file_handle:
+            return self.write_stream(arcname, iter(lambda: file_handle.read(DOWNLOAD_CHUNK_SIZE), b''))
+
+    def drain(self) -> None:
+        """Blocks until every entry queued so far has been written (or dropped)."""
+        self._entries.join()
+
+    def close(self) -> None:
+        """Waits for queued entries to be written, then finalizes the archive."""
+        if self._writer.is_alive():
+            self._entries.put(None)
+            self._writer.join()
+        self._closed = True
+        if self.duplicates and self.error is None:
+            self._container.write_entry(DUPLICATES_MANIFEST_NAME, [format_duplicates_manifest(self.duplicates)])
+        self._container.close()
+
+    def _writer_main(self) -> None:
+        while True:
+            item = self._entries.get()
+            if item is None:
+                self._entries.task_done()
+                return
+            try:
+                self._write_queued_entry(*item)
+            finally:
+                self._entries.task_done()
+
+    def _write_queued_entry(self, arcname: str, chunk_queue: queue.Queue) -> None:
+        # Held in memory up to the buffer limit, then staged on disk: nothing reaches
+        # the container before the producer's clean end, so an aborted stream leaves no entry
+        buffered: List[bytes] = []
+        staged: Optional[BinaryIO] = None
+        digest, size, done, aborted = hashlib.sha256(), 0, False, False
+        try:
+            while not done:
+                chunk = chunk_queue.get()
+                if chunk is _END or chunk is _ABORT:
+                    done, aborted = True, chunk is _ABORT
+                elif self.error is None:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    if staged is None and len(buffered) < self._entry_buffer_chunks:
+                        buffered.append(chunk)
+                        continue
+                    if staged is None:
+                        staged = tempfile.SpooledTemporaryFile(max_size=self._entry_buffer_bytes)
+                        for buffered_chunk in buffered:
+                            staged.write(buffered_chunk)
+                        buffered = []
+                    staged.write(chunk)
+            if not aborted and self.error is None:
+                self._commit_entry(arcname, buffered, staged, size, digest.hexdigest())
+        except Exception as e:
+            self.error = e
+        finally:
+            if staged is not None:
+                staged.close()
+            # Drain whatever the producer still sends so it never blocks forever
+            while not done:
+                chunk = chunk_queue.get()
+                done = chunk is _END or chunk is _ABORT
+
+    def _commit_entry(self, arcname: str, buffered: List[bytes], staged: Optional[BinaryIO], size: int, sha256: str) -> None:
+        # With dedup, the hash decides whether the bytes are stored at all
+        stored_as = self._stored.setdefault(sha256, arcname) if self._dedup else arcname
+        if stored_as != arcname:
+            self._container.write_link(arcname, stored_as)
+            self.duplicates.append({'filename': arcname, 'stored_as': stored_as, 'sha256': sha256, 'size': size})
+        elif staged is not None:
+            staged.seek(0)
+            self._container.write_staged(arcname, staged, size)
+        else:
+            self._container.write_entry(arcname, buffered)
+        if self._on_entry_written:
+            self._on_entry_written(arcname, size, sha256, stored_as)
+
+
+# --- READING ---
+def archive_format_for(path: str) -> str:
+    """Archive format implied by a file name: 'tar.zst' or 'zip'."""
+    return 'tar.zst' if path.endswith('.tar.zst') else 'zip'
+
+
+def iter_archive_members(source: Union[str, BinaryIO, 'SpooledArchive'], archive_format: str = 'zip', names: Optional[Set[str]] = None) -> Iterator[Tuple[str, BinaryIO]]:
+    """
+    Yields (name, readable file) for each file in an exported archive,
+    optionally only those in `names`. Each file object is only valid until
+    the next item is requested; entries are decompressed as they are read.
+    """
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Unknown archive format: {archive_format}")
+    if archive_format == 'tar.zst' and not ZSTD_AVAILABLE:
+        raise RuntimeError("Reading tar.zst archives needs the 'zstandard' package")
+    # Paths and SpooledArchives get a handle of their own, closed when iteration ends
+    if isinstance(source, str):
+        raw = open(source, 'rb')
+    elif isinstance(source, SpooledArchive):
+        raw = source.open_reader()
+    else:
+        raw = None
+    try:
+        if archive_format == 'zip':
+            with zipfile.ZipFile(raw or source) as zip_archive:
+                for info in zip_archive.infolist():
+                    if info.is_dir() or (names is not None and info.filename not in names):
+                        continue
+                    with zip_archive.open(info) as member_file:
+                        yield info.filename, member_file
+        else:
+            with zstandard.ZstdDecompressor().stream_reader(raw or source, closefd=False) as reader, tarfile.open(fileobj=reader, mode='r|') as tar:
+                for member in tar:
+                    if not member.isfile() or (names is not None and member.name not in names):
+                        continue
+                    yield member.name, tar.extractfile(member)
+    finally:
+        if raw is not None:
+            raw.close()
+
+
+def format_duplicates_manifest(duplicates: List[Dict[str, object]]) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=['filename', 'stored_as', 'sha256', 'size'], lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(duplicates)
+    return buffer.getvalue().encode('utf-8')
+
+
+def parse_duplicates_manifest(data: bytes) -> Dict[str, str]:
+    """{duplicate filename: filename the bytes are stored under} from DUPLICATES_MANIFEST_NAME."""
+    return {row['filename']: row['stored_as'] for row in csv.DictReader(io.StringIO(data.decode('utf-8')))}
+
+
+def read_duplicates_manifest(source: Union[str, BinaryIO, 'SpooledArchive'], archive_format: str = 'zip') -> Dict[str, str]:
+    """Duplicate mapping of a deduplicated archive; empty for archives written without dedup."""
+    for _, member_file in iter_archive_members(source, archive_format, names={DUPLICATES_MANIFEST_NAME}):
+        return parse_duplicates_manifest(member_file.read())
+    return {}
+
+
+# --- RECOVERY ---
+_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+
+
+def recover_partial_zip(path: str, expected_sha256: Dict[str, str]) -> List[str]:
+    """
+    Rebuilds a ZIP whose writer died before the central directory was
+    written (e.g. the exporter process was killed). Walks the local file
+    headers, keeps only entries whose content matches `expected_sha256`
+    (arcname -> hex digest, from the manifest), and rewrites `path` in place.
+    Returns the names of the entries that were kept.
+    """
+    kept: List[str] = []
+    recovered_path = f"{path}.recovering"
+    with open(path, 'rb') as source, zipfile.ZipFile(recovered_path, 'w', zipfile.ZIP_DEFLATED) as target:
+        while True:
+            header = source.read(_LOCAL_HEADER.size)
+            if len(header) < _LOCAL_HEADER.size:
+                break
+            signature, _, flags, method, _, _, _, compressed_size, _, name_length, extra_length = _LOCAL_HEADER.unpack(header)
+            # Entries written to a seekable file have their sizes patched into the local header;
+            # a data-descriptor entry is one that was still being written when the process died
+            if signature != b'PK\x03\x04' or flags & 0x08:
+                break
+            arcname = source.read(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+            extra = source.read(extra_length)
+            if compressed_size == 0xFFFFFFFF and len(extra) >= 20:
+                compressed_size = struct.unpack('<Q', extra[12:20])[0]
+            payload = source.read(compressed_size)
+            if len(payload) < compressed_size:
+                break
+            try:
+                data = zlib.decompress(payload, -15) if method == zipfile.ZIP_DEFLATED else payload
+            except zlib.error:
+                break
+            if method in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) and hashlib.sha256(data).hexdigest() == expected_sha256.get(arcname):
+                target.writestr(arcname, data)
+                kept.append(arcname)
+    os.replace(recovered_path, path)
+    return kept
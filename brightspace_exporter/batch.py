@@ -0,0 +1,406 @@
+"""
+Batch exports across several hosts and org units in one run.
+
+A batch is a list of targets, each a host, an org unit, a reference to the
+cookie for that host (the name of an environment variable; cookies never go
+in the targets file) and optional role filters:
+
+    [
+        {"name": "main", "host": "https://univ.brightspace.com", "ou": 6606,
+         "cookie_env": "UNIV_COOKIE", "role_pattern": "Instructor|TA"},
+        {"host": "https://other.brightspace.com", "cookie_env": "OTHER_COOKIE",
+         "roles": ["Student", "118"], "host_workers": 1}
+    ]
+
+run_batch_export discovers the roles of every target, then exports all of
+them on one pool of workers sharing one browser pool. BatchScheduler hands
+roles out round-robin across hosts, so a tenant with hundreds of roles does
+not starve the others, and never puts more than the host's cap in flight
+against one host; the cap follows that host's RateController down while it
+throttles. Within a host, targets are worked through in order, which keeps
+only a few archives open at a time. Every target gets its own archive, log,
+manifest and timings file, and a combined index lists every role of every
+target with the archive its file ended up in.
+"""
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import pandas as pd
+
+from .archive import ARCHIVE_FORMATS, PipelinedArchiveWriter, archive_base_path
+from .export_paths import ExportPathSelector
+from .manifest import manifest_path_for, open_export_manifest
+from .rate_limit import DEFAULT_MAX_RATE, RateController, Throttled
+from .timings import ExportTimings, RoleTimer, timings_path_for
+from .engine import (
+    BrowserPool,
+    build_http_session,
+    discover_roles,
+    export_role,
+    filter_roles,
+    is_safe_url,
+    normalize_cookie,
+    normalize_url,
+    role_output_filename,
+    sanitize_filename,
+)
+
+DEFAULT_COOKIE_ENV = 'BRIGHTSPACE_COOKIE'
+DEFAULT_HOST_WORKERS = 2
+BATCH_INDEX_NAME = 'batch_index.csv'
+BATCH_INDEX_COLUMNS = ['target', 'host', 'ou', 'archive', 'role_id', 'role_name', 'status', 'method', 'bytes', 'sha256', 'error']
+
+
+def load_batch_targets(path: str) -> List[Dict[str, Any]]:
+    """
+    Reads and validates a JSON list of targets. Returns one dict per target
+    with name, host, ou, cookie_env, roles, role_pattern, include_d2lmonitor
+    and host_workers filled in. Raises ValueError naming the bad entry.
+    """
+    with open(path, encoding='utf-8') as targets_file:
+        entries = json.load(targets_file)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("The targets file must hold a non-empty JSON list of targets")
+
+    targets, names = [], set()
+    for number, entry in enumerate(entries, start=1):
+        if not isinstance(entry, dict) or not entry.get('host'):
+            raise ValueError(f"Target {number}: needs at least a 'host'")
+        host_url = normalize_url(str(entry['host']))
+        if not is_safe_url(host_url):
+            raise ValueError(f"Target {number}: invalid host URL (must be http/https and not a local address)")
+        try:
+            ou = int(entry.get('ou', 6606))
+            host_workers = entry.get('host_workers')
+            host_workers = max(1, int(host_workers)) if host_workers is not None else None
+        except (TypeError, ValueError):
+            raise ValueError(f"Target {number}: 'ou' and 'host_workers' must be integers") from None
+        name = sanitize_filename(str(entry.get('name') or f"{urlparse(host_url).netloc}_ou{ou}"), f'target_{number}')
+        if name in names:
+            raise ValueError(f"Target {number}: duplicate name '{name}' (names become file names)")
+        names.add(name)
+        roles = entry.get('roles')
+        targets.append({
+            'name': name,
+            'host': host_url,
+            'ou': ou,
+            'cookie_env': str(entry.get('cookie_env') or DEFAULT_COOKIE_ENV),
+            'roles': [str(role) for role in roles] if roles else None,
+            'role_pattern': entry.get('role_pattern'),
+            'include_d2lmonitor': bool(entry.get('include_d2lmonitor', False)),
+            'host_workers': host_workers,
+        })
+    return targets
+
+
+class BatchScheduler:
+    """
+    Thread-safe hand-out of (target run, role) tasks for a shared worker
+    pool. next() picks hosts round-robin and skips any host that already
+    has `min(cap, rate controller concurrency)` roles in flight; done()
+    frees the slot. Tasks of one host come out in the order they were added.
+    """
+
+    def __init__(self, host_caps: Dict[str, int], rate_controllers: Dict[str, RateController]):
+        self.host_caps = host_caps
+        self.rate_controllers = rate_controllers
+        self._pending: Dict[str, Deque[Any]] = collections.OrderedDict()
+        self._in_flight: Dict[str, int] = collections.defaultdict(int)
+        self._condition = threading.Condition()
+
+    def add(self, host: str, task: Any) -> None:
+        with self._condition:
+            self._pending.setdefault(host, collections.deque()).append(task)
+            self._condition.notify()
+
+    def _capacity(self, host: str) -> int:
+        return min(self.host_caps[host], self.rate_controllers[host].concurrency)
+
+    def next(self) -> Optional[Tuple[str, Any]]:
+        """Blocks until some host has room, then returns (host, task); None once nothing is left."""
+        with self._condition:
+            while True:
+                if not self._pending:
+                    return None
+                for host in list(self._pending):
+                    # Rotate: the host served now goes to the back of the line
+                    tasks = self._pending.pop(host)
+                    self._pending[host] = tasks
+                    if self._in_flight[host] < self._capacity(host):
+                        task = tasks.popleft()
+                        if not tasks:
+                            del self._pending[host]
+                        self._in_flight[host] += 1
+                        return host, task
+                # Re-checked periodically too: a recovering rate controller widens its host's cap
+                self._condition.wait(timeout=0.5)
+
+    def done(self, host: str) -> None:
+        with self._condition:
+            self._in_flight[host] -= 1
+            self._condition.notify_all()
+
+
+class _TargetRun:
+    """One target's outputs while its roles are being exported; opened on its first role, finalized after its last."""
+
+    def __init__(self, target: Dict[str, Any], cookie_header: str, role_list: List[Tuple[int, str]], output_dir: str, archive_format: str, compression: str, dedup: bool, direct_http: bool, worker_count: int):
+        self.target = target
+        self.cookie_header = cookie_header
+        self.role_list = role_list
+        self.archive_path = os.path.join(output_dir, f"{target['name']}{ARCHIVE_FORMATS[archive_format][0]}")
+        self.archive_format = archive_format
+        self.compression = compression
+        self.dedup = dedup
+        self.direct_http = direct_http
+        self.worker_count = worker_count
+        self.manifest_path = manifest_path_for(self.archive_path)
+        self.manifest = open_export_manifest(self.manifest_path)
+        self.timings = ExportTimings()
+        self.archive: Optional[PipelinedArchiveWriter] = None
+        self.http_session = None
+        self.export_log: List[Dict[str, Any]] = []
+        self.error: Optional[str] = None
+        self.finished = False
+        self._remaining = len(role_list)
+        self._lock = threading.Lock()
+        self._roles_by_filename = {role_output_filename(rid, rname): (rid, rname) for rid, rname in role_list}
+
+    def open(self) -> PipelinedArchiveWriter:
+        with self._lock:
+            if self.archive is None:
+                self.archive = PipelinedArchiveWriter(
+                    self.archive_path, archive_format=self.archive_format, compression=self.compression,
+                    max_pending_entries=2 * self.worker_count, on_entry_written=self._checkpoint, dedup=self.dedup
+                )
+                if self.direct_http:
+                    self.http_session = build_http_session(self.cookie_header, pool_size=self.worker_count)
+            return self.archive
+
+    def _checkpoint(self, filename: str, size: int, sha256: str, stored_as: str) -> None:
+        if filename in self._roles_by_filename:
+            rid, rname = self._roles_by_filename[filename]
+            self.manifest.record(rid, rname, filename, size, sha256, stored_as=stored_as)
+
+    def record(self, entry: Dict[str, Any]) -> bool:
+        """Adds one role's log entry; returns True for the target's last role, after finalizing its outputs."""
+        with self._lock:
+            self.export_log.append(entry)
+            self._remaining -= 1
+            if self._remaining:
+                return False
+        self.finish()
+        return True
+
+    def finish(self) -> None:
+        """Closes the archive and writes the log and timings; later calls do nothing."""
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+        try:
+            if self.archive is not None:
+                self.archive.close()
+                if self.archive.error is not None:
+                    logging.warning(f"Batch archive error: {type(self.archive.error).__name__}")
+                    self.error = 'Archive could not be written'
+            order = {role_id: index for index, (role_id, _) in enumerate(self.role_list)}
+            self.export_log.sort(key=lambda entry: order[entry['ID']])
+            output_base = archive_base_path(self.archive_path)
+            pd.DataFrame(self.export_log).to_csv(f"{output_base}_log.csv", index=False)
+            self.timings.write(timings_path_for(self.archive_path))
+        except Exception as e:
+            logging.warning(f"Batch finalize error: {type(e).__name__}")
+            self.error = 'Outputs could not be written'
+        finally:
+            if self.http_session is not None:
+                self.http_session.close()
+
+
+def _index_rows(target: Dict[str, Any], run: Optional[_TargetRun], status: Optional[str] = None) -> List[Dict[str, Any]]:
+    base = {'target': target['name'], 'host': target['host'], 'ou': target['ou']}
+    if run is None:
+        # Nothing exported for this target: one row saying why
+        return [{**base, 'archive': None, 'role_id': None, 'role_name': None, 'status': status, 'method': None, 'bytes': None, 'sha256': None, 'error': None}]
+    rows = []
+    for entry in run.export_log:
+        manifest_entry = run.manifest.get(entry['ID']) if entry['Status'] == 'OK' else None
+        rows.append({
+            **base,
+            'archive': os.path.basename(run.archive_path),
+            'role_id': entry['ID'],
+            'role_name': entry['Role'],
+            'status': entry['Status'] if run.error is None else 'Failed',
+            'method': entry.get('Method'),
+            'bytes': entry.get('Bytes'),
+            'sha256': manifest_entry['sha256'] if manifest_entry else None,
+            'error': entry.get('Error') or run.error,
+        })
+    return rows
+
+
+def run_batch_export(
+    targets: List[Dict[str, Any]],
+    output_dir: str,
+    worker_count: int = 4,
+    host_workers: int = DEFAULT_HOST_WORKERS,
+    page_timeout: int = 45000,
+    link_timeout: int = 30000,
+    max_retries: int = 2,
+    direct_http: bool = False,
+    archive_format: str = 'zip',
+    compression: str = 'default',
+    dedup: bool = False,
+    max_rate: float = DEFAULT_MAX_RATE,
+    browser_pool: Optional[BrowserPool] = None,
+    path_selector: Optional[ExportPathSelector] = None,
+    progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+    message_callback: Optional[Callable[[str], None]] = None,
+) -> pd.DataFrame:
+    """
+    Exports every target (see load_batch_targets) into `output_dir` with
+    `worker_count` shared workers and at most `host_workers` roles in flight
+    per host (a target's own host_workers lowers its host's cap). Each host
+    gets one RateController with `max_rate` requests per second, shared by
+    all of its targets.
+
+    Writes <name>.zip (or .tar.zst), <name>_log.csv, <name>.manifest.jsonl
+    and <name>.timings.csv per target, plus BATCH_INDEX_NAME with one
+    BATCH_INDEX_COLUMNS row per exported role (or per target that could not
+    be exported, with the reason as its status), which is also returned.
+    `progress_callback` receives a dict after each role with the keys
+    completed, total, target, role, success_count, failure_count and
+    eta_seconds; `message_callback` gets discovery messages.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    say = message_callback or (lambda message: None)
+    skipped: Dict[str, str] = {}
+    runs: List[_TargetRun] = []
+    worker_count = max(1, worker_count)
+
+    host_caps: Dict[str, int] = {}
+    for target in targets:
+        cap = target.get('host_workers') or host_workers
+        host_caps[target['host']] = min(host_caps.get(target['host'], cap), cap, worker_count)
+
+    for target in targets:
+        cookie = normalize_cookie(os.environ.get(target['cookie_env'], ''))
+        if not cookie:
+            say(f"{target['name']}: no cookie found in ${target['cookie_env']}, skipped")
+            skipped[target['name']] = 'No Cookie'
+            continue
+        say(f"{target['name']}: discovering roles on {target['host']} (ou {target['ou']})")
+        try:
+            roles_df = discover_roles(target['host'], target['ou'], cookie, exclude_d2lmonitor=not target['include_d2lmonitor'], progress_callback=say)
+        except Throttled:
+            say(f"{target['name']}: {target['host']} is throttling role discovery, skipped")
+            skipped[target['name']] = 'Throttled'
+            continue
+        role_list = filter_roles(roles_df, target['roles'], target['role_pattern']) if not roles_df.empty else []
+        if not role_list:
+            say(f"{target['name']}: no roles matched, skipped")
+            skipped[target['name']] = 'No Roles'
+            continue
+        runs.append(_TargetRun(target, cookie, role_list, output_dir, archive_format, compression, dedup, direct_http, host_caps[target['host']]))
+
+    rate_controllers = {host: RateController(max_rate, max_concurrency=cap) for host, cap in host_caps.items()}
+    scheduler = BatchScheduler(host_caps, rate_controllers)
+    for run in runs:
+        for role_id, role_name in run.role_list:
+            scheduler.add(run.target['host'], (run, role_id, role_name))
+
+    own_pool = browser_pool is None
+    if own_pool:
+        browser_pool = BrowserPool(max_contexts=worker_count)
+    if path_selector is None:
+        path_selector = ExportPathSelector()
+    total = sum(len(run.role_list) for run in runs)
+    counts = {'completed': 0, 'success': 0, 'failure': 0}
+    counts_lock = threading.Lock()
+    start_time = time.time()
+
+    def report(run: _TargetRun, role_name: str, success: bool) -> None:
+        with counts_lock:
+            counts['completed'] += 1
+            counts['success' if success else 'failure'] += 1
+            progress = {
+                'completed': counts['completed'],
+                'total': total,
+                'target': run.target['name'],
+                'role': role_name,
+                'success_count': counts['success'],
+                'failure_count': counts['failure'],
+            }
+        elapsed = time.time() - start_time
+        progress['eta_seconds'] = (total - progress['completed']) * elapsed / progress['completed']
+        if progress_callback:
+            progress_callback(progress)
+
+    def worker() -> None:
+        while True:
+            scheduled = scheduler.next()
+            if scheduled is None:
+                return
+            host, (run, role_id, role_name) = scheduled
+            timer = RoleTimer()
+            try:
+                archive = run.open()
+                if archive.error is not None:
+                    success, fname, size, method = False, 'Archive could not be written', None, None
+                else:
+                    success, fname, size, method = export_role(
+                        archive, host, run.target['ou'], run.cookie_header, role_id, role_name,
+                        page_timeout, link_timeout, max_retries, browser_pool, run.http_session, path_selector,
+                        rate_controllers[host], timer
+                    )
+            except Exception as e:
+                # Keep the worker alive for the other targets; log generically
+                logging.warning(f"Batch worker error: {type(e).__name__}")
+                success, fname, size, method = False, 'Export error', None, None
+            finally:
+                scheduler.done(host)
+            run.timings.add_role(role_id, role_name, timer, success, method)
+            if success:
+                entry = {'Role': role_name, 'ID': role_id, 'Status': 'OK', 'Method': method, 'Bytes': size}
+            else:
+                # Only log generic error, as in single exports
+                entry = {'Role': role_name, 'ID': role_id, 'Status': 'Failed', 'Error': 'Download Failed or Timed Out'}
+            try:
+                run.record(entry)
+                report(run, role_name, success)
+            except Exception as e:
+                # A failing progress callback must not drop this worker's remaining roles
+                logging.warning(f"Batch progress error: {type(e).__name__}")
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(min(worker_count, max(1, total)))]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if own_pool:
+            browser_pool.close()
+        # Normally done by each target's last role; this closes any target a worker left open
+        for run in runs:
+            if not run.finished and run.error is None and len(run.export_log) < len(run.role_list):
+                run.error = 'Batch stopped before all roles were exported'
+            run.finish()
+
+    runs_by_name = {run.target['name']: run for run in runs}
+    index_rows = []
+    for target in targets:
+        index_rows += _index_rows(target, runs_by_name.get(target['name']), skipped.get(target['name']))
+    index = pd.DataFrame(index_rows, columns=BATCH_INDEX_COLUMNS)
+    for column in ('ou', 'role_id', 'bytes'):
+        # Nullable: targets that were skipped have no role rows
+        index[column] = index[column].astype('Int64')
+    index.to_csv(os.path.join(output_dir, BATCH_INDEX_NAME), index=False)
+    return index
@@ -0,0 +1,395 @@
+"""
+Offline benchmark against a local stand-in Brightspace server.
+
+MockBrightspace serves the endpoints the exporter uses (whoami, the roles
+API, a paginated role_list.d2l, export_preview.d2l, export_file.d2l and
+viewFile.d2lfile downloads) with configurable latency, failure rate,
+throttling and payload size. run_benchmark drives role discovery (API and
+UI scrape) and a full export against it and reports roles/second, tail
+latency and peak memory; compare_to_baseline flags regressions against the
+JSON of an earlier run.
+
+    python -m brightspace_exporter bench --roles 200 --workers 4 --latency 0.05 --json bench.json
+"""
+
+import html
+import http.server
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from .engine import (
+    LP_API_VERSION,
+    PLAYWRIGHT_AVAILABLE,
+    export_roles_to_archive,
+    fetch_roles_via_api,
+    fetch_roles_via_ui_scrape,
+    playwright_browsers_installed,
+    roles_api_url,
+)
+from .export_paths import EXPORT_PATH_BUTTON, EXPORT_PATH_DIRECT, EXPORT_PATH_HTTP, ExportPathSelector
+from .rate_limit import RateController, Throttled
+from .timings import ExportTimings
+
+try:
+    import resource  # Unix only
+    RESOURCE_AVAILABLE = True
+except ImportError:
+    RESOURCE_AVAILABLE = False
+
+BENCHMARK_COOKIE = 'd2lSessionVal=benchmark; d2lSecureSessionVal=benchmark'
+
+
+class _QuietThreadingHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address) -> None:
+        # Clients drop connections mid-request (e.g. closing a throttled response); not a server fault
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+class MockBrightspace:
+    """
+    Stand-in Brightspace host on 127.0.0.1. Every response waits `latency`
+    seconds (varied by +/- `jitter` as a fraction); `failure_rate` of the
+    requests get a 500 and `throttle_rate` a 429 with Retry-After. With
+    `rate_limit`, requests beyond that many per second are throttled too,
+    like a tenant's real limiter. Role files have `payload_rows` permission
+    rows; `export_button=False` mimics tenants whose preview page has no
+    Export button. Status codes served are counted in `stats`.
+    """
+
+    def __init__(self, role_count: int = 100, page_size: int = 50, latency: float = 0.05, jitter: float = 0.5, failure_rate: float = 0.0, throttle_rate: float = 0.0, rate_limit: Optional[float] = None, retry_after: float = 1.0, payload_rows: int = 500, export_button: bool = True, seed: int = 0):
+        self.role_ids = list(range(1000, 1000 + role_count))
+        self.page_size = page_size
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.export_button = export_button
+        self.stats: Dict[int, int] = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_requests = 0
+        # One shared body; only the first line differs per role
+        tools = ['Grades', 'Content', 'Discussions', 'Quizzes', 'Users', 'Dropbox', 'Reports', 'Classlist']
+        org_unit_types = ['Organization', 'Department', 'Course Offering', 'Section']
+        self._payload = ('Tool\tPermission\tOrg Unit Type\tValue\n' + ''.join(
+            f"{tools[row % len(tools)]}\tPermission {row // len(org_unit_types)}\t{org_unit_types[row % len(org_unit_types)]}\t{'True' if row % 3 else 'False'}\n"
+            for row in range(payload_rows)
+        )).encode('utf-8')
+        self._server: Optional[_QuietThreadingHTTPServer] = None
+
+    @staticmethod
+    def role_name(role_id: int) -> str:
+        return f'Benchmark Role {role_id}'
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def start(self) -> str:
+        """Starts serving on a free port in a background thread and returns the host URL."""
+        mock = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out as separate writes; without this, delayed ACKs add ~40 ms per response
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                mock._handle(self)
+
+        self._server = _QuietThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> 'MockBrightspace':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    # --- request handling ---
+    def _send(self, handler, status: int, body: bytes = b'', content_type: str = 'text/html; charset=utf-8', headers: Optional[Dict[str, str]] = None) -> None:
+        with self._lock:
+            self.stats[status] = self.stats.get(status, 0) + 1
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _throttled(self) -> bool:
+        with self._lock:
+            if self.throttle_rate and self._random.random() < self.throttle_rate:
+                return True
+            if self.rate_limit:
+                now = time.monotonic()
+                if now - self._window_start >= 1.0:
+                    self._window_start, self._window_requests = now, 0
+                self._window_requests += 1
+                return self._window_requests > self.rate_limit
+            return False
+
+    def _handle(self, handler) -> None:
+        url = urlparse(handler.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        with self._lock:
+            delay = self.latency * self._random.uniform(1 - self.jitter, 1 + self.jitter)
+            failed = self.failure_rate and self._random.random() < self.failure_rate
+        time.sleep(max(0.0, delay))
+
+        if 'Cookie' not in handler.headers:
+            return self._send(handler, 403, b'Not signed in')
+        if self._throttled():
+            return self._send(handler, 429, b'Too Many Requests', headers={'Retry-After': f'{self.retry_after:g}'})
+        if failed:
+            return self._send(handler, 500, b'Internal Server Error')
+
+        path = url.path
+        if path == f'/d2l/api/lp/{LP_API_VERSION}/users/whoami':
+            return self._send(handler, 200, json.dumps({'FirstName': 'Bench', 'LastName': 'Mark'}).encode(), 'application/json')
+        if path == f'/d2l/api/lp/{LP_API_VERSION}/roles/':
+            roles = [{'Identifier': str(role_id), 'DisplayName': self.role_name(role_id)} for role_id in self.role_ids]
+            return self._send(handler, 200, json.dumps(roles).encode(), 'application/json')
+        if path == '/d2l/lp/security/role_list.d2l':
+            return self._send(handler, 200, self._role_list_page(query.get('ou', ''), int(query.get('page', 0))))
+        if path in ('/d2l/lp/security/export_preview.d2l', '/d2l/lp/security/export_file.d2l') and query.get('roleId', '').isdigit():
+            return self._send(handler, 200, self._export_page(path, query['roleId'], query.get('ou', '')))
+        if path.startswith('/d2l/common/viewFile.d2lfile/') and query.get('roleId', '').isdigit():
+            role_id = int(query['roleId'])
+            body = f'Role {role_id} Permissions\n'.encode('utf-8') + self._payload
+            disposition = f'attachment; filename="{self.role_name(role_id).replace(" ", "_")}.txt"'
+            return self._send(handler, 200, body, 'text/plain; charset=utf-8', {'Content-Disposition': disposition})
+        self._send(handler, 404, b'Not Found')
+
+    def _role_list_page(self, ou: str, page: int) -> bytes:
+        start = page * self.page_size
+        rows = ''.join(
+            f'<tr><td><a href="/d2l/lp/security/role_edit.d2l?roleId={role_id}&amp;ou={html.escape(ou)}">{self.role_name(role_id)}</a></td></tr>'
+            for role_id in self.role_ids[start:start + self.page_size]
+        )
+        pager = ''
+        if start + self.page_size < len(self.role_ids):
+            pager = f'<a title="Next Page" href="role_list.d2l?ou={html.escape(ou)}&amp;page={page + 1}">&gt;</a>'
+        return f'<html><body><table>{rows}</table>{pager}</body></html>'.encode('utf-8')
+
+    def _export_page(self, path: str, role_id: str, ou: str) -> bytes:
+        if path.endswith('export_preview.d2l'):
+            button = ''
+            if self.export_button:
+                button = f'<button type="button" onclick="location.href=\'export_file.d2l?roleId={role_id}&amp;ou={html.escape(ou)}\'">Export</button>'
+            return f'<html><body><h1>Export Preview</h1>{button}</body></html>'.encode('utf-8')
+        return (
+            f'<html><body><a href="/d2l/common/viewFile.d2lfile/Database/Export/permissions.txt?roleId={role_id}&amp;ou={html.escape(ou)}">'
+            f'Download</a></body></html>'
+        ).encode('utf-8')
+
+
+# --- BENCHMARK RUN ---
+def _peak_rss_mb() -> Optional[float]:
+    if not RESOURCE_AVAILABLE:
+        return None
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if os.uname().sysname == 'Darwin' else peak / 1024
+
+
+def _timed(trace_memory: bool, run):
+    if trace_memory:
+        tracemalloc.reset_peak()
+    started = time.perf_counter()
+    value = run()
+    seconds = time.perf_counter() - started
+    peak_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024) if trace_memory else None
+    return value, seconds, peak_mb
+
+
+def _discovery(fetch: Callable[..., Any], *args) -> Tuple[int, bool]:
+    """Roles found by a discovery call, and whether it gave up because the server kept throttling."""
+    try:
+        return len(fetch(*args)), False
+    except Throttled:
+        return 0, True
+
+
+def run_benchmark(
+    role_count: int = 100,
+    worker_count: int = 4,
+    latency: float = 0.05,
+    jitter: float = 0.5,
+    failure_rate: float = 0.0,
+    throttle_rate: float = 0.0,
+    rate_limit: Optional[float] = None,
+    payload_rows: int = 500,
+    page_size: int = 50,
+    export_button: bool = True,
+    browser: bool = False,
+    max_rate: float = 100.0,
+    trace_memory: bool = True,
+    progress_callback=None,
+) -> Dict[str, Any]:
+    """
+    Runs discovery and export scenarios against a fresh MockBrightspace and
+    returns the results as a JSON-serializable dict.
+
+    Export scenarios report roles, ok, seconds, roles_per_second, role
+    latency p50/p95/p99/max (from the export's phase timings), the peak
+    Python heap in MB (tracemalloc; off with `trace_memory=False`, which
+    also removes its overhead from the timings) and what the server
+    throttled or failed. 'http' always runs; 'browser' runs with
+    `browser=True` when Playwright and Chromium are available. `max_rate` is
+    the exporter's request-rate ceiling; the default is high so the numbers
+    measure the exporter rather than its politeness limit.
+    """
+    settings = {
+        'role_count': role_count, 'worker_count': worker_count, 'latency': latency, 'jitter': jitter,
+        'failure_rate': failure_rate, 'throttle_rate': throttle_rate, 'rate_limit': rate_limit,
+        'payload_rows': payload_rows, 'page_size': page_size, 'export_button': export_button, 'max_rate': max_rate,
+    }
+    results: Dict[str, Any] = {'settings': settings, 'discovery': {}, 'export': {}}
+    mock = MockBrightspace(role_count, page_size, latency, jitter, failure_rate, throttle_rate, rate_limit, payload_rows=payload_rows, export_button=export_button)
+    role_list = [(role_id, mock.role_name(role_id)) for role_id in mock.role_ids]
+
+    def note(message: str) -> None:
+        if progress_callback:
+            progress_callback(message)
+
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    try:
+        with mock:
+            note("Discovery via the roles API...")
+            (roles, throttled), seconds, peak_mb = _timed(trace_memory, lambda: _discovery(fetch_roles_via_api, roles_api_url(mock.url), BENCHMARK_COOKIE))
+            results['discovery']['api'] = {'roles': roles, 'throttled': throttled, 'seconds': seconds, 'peak_python_mb': peak_mb}
+
+            note("Discovery via the role list UI...")
+            (roles, throttled), seconds, peak_mb = _timed(trace_memory, lambda: _discovery(fetch_roles_via_ui_scrape, mock.url, 6606, BENCHMARK_COOKIE))
+            results['discovery']['scrape'] = {'roles': roles, 'throttled': throttled, 'pages': -(-role_count // page_size), 'seconds': seconds, 'peak_python_mb': peak_mb}
+
+            # Each scenario is limited to its own paths, so a failed HTTP export is not retried in a browser
+            scenarios = {'http': [EXPORT_PATH_HTTP]}
+            if browser:
+                if PLAYWRIGHT_AVAILABLE and playwright_browsers_installed():
+                    scenarios['browser'] = [EXPORT_PATH_BUTTON, EXPORT_PATH_DIRECT]
+                else:
+                    results['export']['browser'] = {'skipped': 'Playwright or Chromium is not installed'}
+
+            with tempfile.TemporaryDirectory(prefix='role_bench_') as directory:
+                for name, export_paths in scenarios.items():
+                    note(f"Exporting {role_count} roles ({name})...")
+                    before = dict(mock.stats)
+                    timings = ExportTimings()
+                    export_log, seconds, peak_mb = _timed(trace_memory, lambda: export_roles_to_archive(
+                        os.path.join(directory, f'{name}.zip'), role_list, mock.url, 6606, BENCHMARK_COOKIE,
+                        worker_count=worker_count, direct_http=EXPORT_PATH_HTTP in export_paths,
+                        path_selector=ExportPathSelector(paths=export_paths),
+                        rate_controller=RateController(max_rate, max_concurrency=worker_count),
+                        timings=timings
+                    ))
+                    role_seconds = timings.to_dataframe().groupby('role_id')['seconds'].sum() if len(timings) else None
+                    served = {status: count - before.get(status, 0) for status, count in mock.stats.items()}
+                    ok = sum(1 for entry in export_log if entry['Status'] == 'OK')
+                    results['export'][name] = {
+                        'roles': len(role_list),
+                        'ok': ok,
+                        'seconds': seconds,
+                        'roles_per_second': ok / seconds if seconds > 0 else None,
+                        **{
+                            f'p{int(q * 100)}': float(role_seconds.quantile(q)) if role_seconds is not None else None
+                            for q in (0.5, 0.95, 0.99)
+                        },
+                        'max': float(role_seconds.max()) if role_seconds is not None else None,
+                        'peak_python_mb': peak_mb,
+                        'server_throttled': served.get(429, 0),
+                        'server_errors': served.get(500, 0),
+                    }
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+    results['peak_rss_mb'] = _peak_rss_mb()
+    return results
+
+
+# Metrics checked against a baseline, and whether a higher value is better
+_BASELINE_METRICS = {
+    'roles_per_second': True,
+    'p95': False,
+    'peak_python_mb': False,
+}
+
+
+def compare_to_baseline(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.2) -> List[str]:
+    """
+    Regressions of `results` against an earlier run's results: any export
+    scenario whose throughput dropped, p95 latency grew or peak memory grew
+    by more than `tolerance` (a fraction), plus discovery slowdowns. Runs
+    with different settings are not comparable and yield a single message.
+    """
+    if results.get('settings') != baseline.get('settings'):
+        return ["Baseline was recorded with different settings; not comparable."]
+    regressions = []
+    for scenario, current in results.get('export', {}).items():
+        previous = baseline.get('export', {}).get(scenario)
+        if not previous or 'skipped' in current or 'skipped' in previous:
+            continue
+        for metric, higher_is_better in _BASELINE_METRICS.items():
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"export/{scenario} {metric}: {old:.3f} -> {new:.3f} ({change:+.0%})")
+    for scenario, current in results.get('discovery', {}).items():
+        previous = baseline.get('discovery', {}).get(scenario)
+        if previous and previous.get('seconds') and (current['seconds'] - previous['seconds']) / previous['seconds'] > tolerance:
+            regressions.append(f"discovery/{scenario} seconds: {previous['seconds']:.3f} -> {current['seconds']:.3f}")
+    return regressions
+
+
+def format_benchmark(results: Dict[str, Any]) -> str:
+    """Human-readable summary of run_benchmark results."""
+    lines = []
+    for scenario, result in results['discovery'].items():
+        throttled = ' (gave up: server kept throttling)' if result.get('throttled') else ''
+        lines.append(f"discovery/{scenario:<8} {result['roles']:>6} roles in {result['seconds']:.2f}s{throttled}")
+    for scenario, result in results['export'].items():
+        if 'skipped' in result:
+            lines.append(f"export/{scenario:<11} skipped: {result['skipped']}")
+            continue
+        rate = f"{result['roles_per_second']:.1f}" if result['roles_per_second'] is not None else '-'
+        latency = ' '.join(f"{key} {result[key]:.2f}s" for key in ('p50', 'p95', 'p99', 'max') if result[key] is not None)
+        memory = f", peak heap {result['peak_python_mb']:.1f} MB" if result['peak_python_mb'] is not None else ''
+        lines.append(
+            f"export/{scenario:<11} {result['ok']}/{result['roles']} roles in {result['seconds']:.2f}s = {rate} roles/s; "
+            f"role latency {latency}{memory}; server throttled {result['server_throttled']}, errors {result['server_errors']}"
+        )
+    if results.get('peak_rss_mb') is not None:
+        lines.append(f"peak RSS {results['peak_rss_mb']:.1f} MB")
+    return '\n'.join(lines)
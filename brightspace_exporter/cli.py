@@ -0,0 +1,494 @@
+"""
+Command-line entry point for scheduled/bulk exports without a Streamlit server.
+
+    BRIGHTSPACE_COOKIE='d2lSessionVal=...; d2lSecureSessionVal=...' \
+        python -m brightspace_exporter export --host https://univ.brightspace.com --ou 6606 --output roles.zip
+
+The cookie is read from an environment variable (never a command-line
+argument) so it does not end up in shell history or process listings.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from typing import List, Optional
+
+import pandas as pd
+
+from .archive import COMPRESSION_PRESETS, DUPLICATES_MANIFEST_NAME, archive_base_path, archive_format_for, available_archive_formats
+from .batch import BATCH_INDEX_NAME, DEFAULT_COOKIE_ENV, DEFAULT_HOST_WORKERS
+from .dataset import DATASET_FORMATS, PYARROW_AVAILABLE
+from .export_paths import ExportPathSelector, default_export_path_store
+from .rate_limit import DEFAULT_MAX_RATE, RateController, Throttled
+from .xlsx_report import XLSX_SPLIT_MODES, XLSXWRITER_AVAILABLE
+# Modules only some subcommands use (reports, indexes, diffs, the benchmark) are imported in those subcommands
+from .engine import (
+    PLAYWRIGHT_AVAILABLE,
+    check_whoami,
+    discover_roles,
+    export_roles_to_archive,
+    filter_roles,
+    format_seconds_to_hms,
+    install_playwright_browsers,
+    is_safe_url,
+    normalize_cookie,
+    normalize_url,
+    playwright_browsers_installed,
+    throttled_message,
+    whoami_url,
+)
+
+
+def _read_cookie(args: argparse.Namespace) -> str:
+    cookie = normalize_cookie(os.environ.get(args.cookie_env, ''))
+    if not cookie:
+        raise SystemExit(f"error: no cookie found in ${args.cookie_env}")
+    return cookie
+
+
+def _read_host(args: argparse.Namespace) -> str:
+    host_url = normalize_url(args.host)
+    if not is_safe_url(host_url):
+        raise SystemExit("error: invalid host URL (must be http/https and not a local address)")
+    return host_url
+
+
+def _discover_roles(args: argparse.Namespace, host_url: str, cookie: str) -> pd.DataFrame:
+    try:
+        return discover_roles(
+            host_url, args.ou, cookie,
+            exclude_d2lmonitor=not args.include_d2lmonitor,
+            progress_callback=lambda message: print(message, file=sys.stderr)
+        )
+    except Throttled as throttled:
+        raise SystemExit(f"error: {throttled_message(throttled.retry_after)}") from None
+
+
+def cmd_verify(args: argparse.Namespace) -> int:
+    host_url = _read_host(args)
+    result = check_whoami(whoami_url(host_url), _read_cookie(args))
+    print(result['message'])
+    return 0 if result['status'] == 'success' else 2
+
+
+def cmd_list_roles(args: argparse.Namespace) -> int:
+    host_url = _read_host(args)
+    roles_df = _discover_roles(args, host_url, _read_cookie(args))
+    if roles_df.empty:
+        print("Could not find any roles. Check Org Unit ID or Cookie.", file=sys.stderr)
+        return 2
+    for role_id, role_name in filter_roles(roles_df, args.role, args.role_pattern):
+        print(f"{role_id}\t{role_name}")
+    return 0
+
+
+def cmd_export(args: argparse.Namespace) -> int:
+    from .dataset import build_permission_dataset, dataset_path_for, write_permission_dataset
+    from .incremental import RoleContentCache
+    from .manifest import manifest_path_for, open_export_manifest
+    from .permission_index import build_permission_index, index_path_for
+    from .timings import ExportTimings, timings_path_for
+    from .xlsx_report import write_permission_workbook, xlsx_path_for
+
+    host_url = _read_host(args)
+    cookie = _read_cookie(args)
+    if not PLAYWRIGHT_AVAILABLE and not args.direct_http:
+        print("error: Playwright is not available (install it or use --direct-http)", file=sys.stderr)
+        return 2
+    if args.xlsx and not XLSXWRITER_AVAILABLE:
+        print("error: --xlsx needs xlsxwriter (pip install xlsxwriter)", file=sys.stderr)
+        return 2
+
+    roles_df = _discover_roles(args, host_url, cookie)
+    role_list = filter_roles(roles_df, args.role, args.role_pattern) if not roles_df.empty else []
+    if not role_list:
+        print("No roles matched. Check Org Unit ID, Cookie or role filters.", file=sys.stderr)
+        return 2
+
+    def show_progress(progress):
+        eta = format_seconds_to_hms(progress['eta_seconds']) if progress['eta_seconds'] is not None else '--:--:--'
+        role_p50, role_p95 = progress['percentiles'].get('role', (None, None))
+        print(
+            f"[{progress['completed']}/{progress['total']}] {progress['role']} "
+            f"(ok {progress['success_count']}, failed {progress['failure_count']}, ETA {eta}"
+            + (f", role p50 {role_p50:.1f}s p95 {role_p95:.1f}s" if role_p50 is not None else '')
+            + (f", throttled {progress['throttle_count']}x" if progress['throttle_count'] else '') + ")",
+            file=sys.stderr
+        )
+
+    manifest_path = args.manifest or manifest_path_for(args.output)
+    if args.resume and args.format != 'zip':
+        print("error: --resume is only supported for ZIP output", file=sys.stderr)
+        return 2
+    manifest = open_export_manifest(manifest_path, resume=args.resume)
+    cache = RoleContentCache(args.cache_dir, host_url, args.ou, max_age_days=args.cache_max_age_days) if args.cache_dir else None
+    timings = ExportTimings()
+
+    start_time = time.time()
+    export_log = export_roles_to_archive(
+        args.output, role_list, host_url, args.ou, cookie,
+        page_timeout=args.page_timeout,
+        link_timeout=args.link_timeout,
+        max_retries=args.retries,
+        worker_count=args.workers,
+        direct_http=args.direct_http,
+        archive_format=args.format,
+        compression=args.compression,
+        manifest=manifest,
+        resume=args.resume,
+        cache=cache,
+        sample_size=args.sample_size,
+        dedup=args.dedup,
+        path_selector=ExportPathSelector(None if args.no_export_path_store else args.export_path_store),
+        rate_controller=RateController(args.max_rate, max_concurrency=args.workers),
+        timings=timings,
+        progress_callback=None if args.quiet else show_progress
+    )
+
+    output_base = archive_base_path(args.output)
+    log_path = args.log or f"{output_base}_log.csv"
+    pd.DataFrame(export_log).to_csv(log_path, index=False)
+    timings_path = args.timings or timings_path_for(args.output)
+    timings.write(timings_path)
+
+    dataset_note = ''
+    if args.dataset != 'none' or not args.no_index:
+        # Parsed once, shared by the columnar file and the SQLite index
+        dataset = build_permission_dataset(args.output, args.format, role_list)
+        if args.dataset != 'none':
+            dataset_path = args.dataset_path or dataset_path_for(args.output, args.dataset)
+            write_permission_dataset(dataset, dataset_path, args.dataset)
+            dataset_note += f", dataset: {dataset_path} ({len(dataset):,} rows)"
+        if not args.no_index:
+            index_path = args.index_path or index_path_for(args.output)
+            build_permission_index(dataset, index_path).close()
+            dataset_note += f", index: {index_path}"
+    if args.xlsx:
+        xlsx_path = args.xlsx_path or xlsx_path_for(args.output)
+        report = write_permission_workbook(args.output, xlsx_path, args.format, role_list, split=args.xlsx_split)
+        dataset_note += f", Excel report: {', '.join(report['workbooks'])} ({report['rows']:,} rows)"
+
+    failures = sum(1 for entry in export_log if entry['Status'] != 'OK')
+    print(
+        f"Exported {len(export_log) - failures}/{len(export_log)} roles to {args.output} "
+        f"in {format_seconds_to_hms(time.time() - start_time)} (log: {log_path}, manifest: {manifest_path}, timings: {timings_path}{dataset_note})",
+        file=sys.stderr
+    )
+    return 1 if failures else 0
+
+
+def cmd_batch(args: argparse.Namespace) -> int:
+    from .batch import load_batch_targets, run_batch_export
+
+    try:
+        targets = load_batch_targets(args.targets)
+    except (OSError, ValueError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 2
+    if not PLAYWRIGHT_AVAILABLE and not args.direct_http:
+        print("error: Playwright is not available (install it or use --direct-http)", file=sys.stderr)
+        return 2
+
+    def show_progress(progress):
+        eta = format_seconds_to_hms(progress['eta_seconds'])
+        print(
+            f"[{progress['completed']}/{progress['total']}] {progress['target']}: {progress['role']} "
+            f"(ok {progress['success_count']}, failed {progress['failure_count']}, ETA {eta})",
+            file=sys.stderr
+        )
+
+    start_time = time.time()
+    index = run_batch_export(
+        targets, args.output_dir,
+        worker_count=args.workers,
+        host_workers=args.host_workers,
+        page_timeout=args.page_timeout,
+        link_timeout=args.link_timeout,
+        max_retries=args.retries,
+        direct_http=args.direct_http,
+        archive_format=args.format,
+        compression=args.compression,
+        dedup=args.dedup,
+        max_rate=args.max_rate,
+        path_selector=ExportPathSelector(None if args.no_export_path_store else args.export_path_store),
+        progress_callback=None if args.quiet else show_progress,
+        message_callback=lambda message: print(message, file=sys.stderr)
+    )
+
+    for name, rows in index.groupby('target', sort=False):
+        exported = rows['role_id'].notna()
+        if not exported.any():
+            print(f"{name}: skipped ({rows['status'].iloc[0]})", file=sys.stderr)
+            continue
+        ok = int((rows['status'] == 'OK').sum())
+        print(f"{name}: {ok}/{int(exported.sum())} roles -> {rows['archive'].iloc[0]}", file=sys.stderr)
+    print(
+        f"Batch finished in {format_seconds_to_hms(time.time() - start_time)} "
+        f"(index: {os.path.join(args.output_dir, BATCH_INDEX_NAME)})",
+        file=sys.stderr
+    )
+    if not index['role_id'].notna().any():
+        return 2
+    return 1 if (index['status'] != 'OK').any() else 0
+
+
+def cmd_report(args: argparse.Namespace) -> int:
+    from .xlsx_report import write_permission_workbook, xlsx_path_for
+
+    if not XLSXWRITER_AVAILABLE:
+        print("error: the Excel report needs xlsxwriter (pip install xlsxwriter)", file=sys.stderr)
+        return 2
+    archive_format = archive_format_for(args.archive)
+    output = args.output or xlsx_path_for(args.archive)
+    start_time = time.time()
+    report = write_permission_workbook(args.archive, output, archive_format, split=args.split, pivot=not args.no_pivot)
+    print(
+        f"Wrote {report['rows']:,} permission rows to {', '.join(report['workbooks'])} "
+        f"({', '.join(report['sheets'])}) in {format_seconds_to_hms(time.time() - start_time)}",
+        file=sys.stderr
+    )
+    return 0
+
+
+def cmd_query(args: argparse.Namespace) -> int:
+    from .dataset import build_permission_dataset
+    from .permission_index import build_permission_index, open_permission_index, query_permissions
+
+    if args.source.endswith(('.zip', '.tar.zst')):
+        # Query an archive directly by indexing it in memory first
+        connection = build_permission_index(build_permission_dataset(args.source, archive_format_for(args.source)))
+    else:
+        connection = open_permission_index(args.source)
+    try:
+        results = query_permissions(
+            connection,
+            permission=args.permission,
+            tool=args.tool,
+            org_unit_type=args.org_unit_type,
+            role=args.role,
+            granted_only=not args.all_values,
+            limit=args.limit
+        )
+    finally:
+        connection.close()
+
+    if args.csv:
+        results.to_csv(sys.stdout, index=False)
+    elif results.empty:
+        print("No matching permissions.", file=sys.stderr)
+    else:
+        print(results.to_string(index=False))
+    return 0
+
+
+def cmd_diff(args: argparse.Namespace) -> int:
+    from .dataset import write_permission_dataset
+    from .diff import diff_archives
+
+    changes, summary = diff_archives(args.old, args.new, archive_format_for(args.old), archive_format_for(args.new))
+    changed_roles = summary[summary['status'] != 'unchanged']
+    if changed_roles.empty:
+        print(f"No permission changes across {len(summary)} roles.", file=sys.stderr)
+    else:
+        print(changed_roles.to_string(index=False))
+    print(
+        f"{len(changed_roles)} of {len(summary)} roles changed: "
+        f"{(changes['change'] == 'added').sum():,} added, {(changes['change'] == 'removed').sum():,} removed, "
+        f"{(changes['change'] == 'changed').sum():,} changed permission rows",
+        file=sys.stderr
+    )
+    if args.output:
+        if args.output.endswith('.parquet'):
+            write_permission_dataset(changes, args.output, 'parquet')
+        else:
+            changes.to_csv(args.output, index=False)
+        print(f"Change report: {args.output}", file=sys.stderr)
+    # Like diff(1): 0 when identical, 1 when something changed
+    return 1 if len(changed_roles) else 0
+
+
+def cmd_bench(args: argparse.Namespace) -> int:
+    from .benchmark import compare_to_baseline, format_benchmark, run_benchmark
+
+    results = run_benchmark(
+        role_count=args.roles,
+        worker_count=args.workers,
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        throttle_rate=args.throttle_rate,
+        rate_limit=args.server_rate_limit,
+        payload_rows=args.payload_rows,
+        page_size=args.page_size,
+        export_button=not args.no_export_button,
+        browser=args.browser,
+        max_rate=args.max_rate,
+        trace_memory=not args.no_memory,
+        progress_callback=None if args.quiet else lambda message: print(message, file=sys.stderr)
+    )
+    print(format_benchmark(results))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as results_file:
+            json.dump(results, results_file, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+def cmd_install_browsers(args: argparse.Namespace) -> int:
+    if not PLAYWRIGHT_AVAILABLE:
+        print("error: Playwright is not installed (pip install playwright)", file=sys.stderr)
+        return 2
+    if playwright_browsers_installed() and not args.force:
+        print("Playwright Chromium is already installed.")
+        return 0
+    if args.check:
+        print("Playwright Chromium is not installed.")
+        return 1
+    return 0 if install_playwright_browsers() else 1
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='python -m brightspace_exporter',
+        description='Bulk export Brightspace role permissions without the Streamlit UI.'
+    )
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show INFO-level log messages.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_connection_args(subparser):
+        subparser.add_argument('--host', required=True, help='Brightspace host URL, e.g. https://univ.brightspace.com')
+        subparser.add_argument('--cookie-env', default=DEFAULT_COOKIE_ENV, help=f'Environment variable holding the Cookie header (default: {DEFAULT_COOKIE_ENV}).')
+
+    def add_role_args(subparser):
+        subparser.add_argument('--ou', type=int, default=6606, help='Org Unit ID (default: 6606).')
+        subparser.add_argument('--role', action='append', help='Role display name or ID to include (repeatable).')
+        subparser.add_argument('--role-pattern', help='Regex matched against role display names.')
+        subparser.add_argument('--include-d2lmonitor', action='store_true', help="Keep the 'D2LMonitor' role.")
+
+    verify = subparsers.add_parser('verify', help='Check that the cookie authenticates against the host.')
+    add_connection_args(verify)
+    verify.set_defaults(func=cmd_verify)
+
+    list_roles = subparsers.add_parser('list-roles', help='Print the roles that would be exported.')
+    add_connection_args(list_roles)
+    add_role_args(list_roles)
+    list_roles.set_defaults(func=cmd_list_roles)
+
+    export = subparsers.add_parser('export', help='Export role permission files into an archive.')
+    add_connection_args(export)
+    add_role_args(export)
+    export.add_argument('--output', '-o', required=True, help='Path of the archive to write.')
+    export.add_argument('--format', choices=available_archive_formats(), default='zip', help='Archive container (tar.zst needs the zstandard package; default: zip).')
+    export.add_argument('--compression', choices=list(COMPRESSION_PRESETS), default='default', help='Compression preset (default: default).')
+    export.add_argument('--dedup', action='store_true', help=f'Store byte-identical role files once; duplicates are listed in {DUPLICATES_MANIFEST_NAME} inside the archive (hard links in tar.zst).')
+    export.add_argument('--log', help='Path of the CSV export log (default: <output>_log.csv).')
+    export.add_argument('--timings', help='Path of the per-phase timing report; .json for JSON with a per-phase summary, otherwise CSV (default: <output>.timings.csv).')
+    export.add_argument('--manifest', help='Path of the per-role checkpoint manifest (default: <output>.manifest.jsonl).')
+    export.add_argument(
+        '--dataset', choices=list(DATASET_FORMATS) + ['none'], default='parquet' if PYARROW_AVAILABLE else 'none',
+        help='Also write a long-format permission table parsed from the role files (needs pyarrow; default: parquet if available).'
+    )
+    export.add_argument('--dataset-path', help='Path of the permission table (default: <output>.permissions.<format>).')
+    export.add_argument('--xlsx', action='store_true', help='Also write an Excel report with a role x permission pivot, split at the row limit (needs xlsxwriter).')
+    export.add_argument('--xlsx-path', help='Path of the Excel report (default: <output>.permissions.xlsx).')
+    export.add_argument('--xlsx-split', choices=XLSX_SPLIT_MODES, default='sheets', help='Past 1,048,576 rows, continue on numbered sheets or numbered workbooks (default: sheets).')
+    export.add_argument('--no-index', action='store_true', help='Skip the SQLite permission index used by the query command.')
+    export.add_argument('--index-path', help='Path of the SQLite permission index (default: <output>.permissions.sqlite).')
+    export.add_argument('--resume', action='store_true', help='Continue an interrupted export: keep roles already in the output ZIP and export only the missing/failed ones.')
+    export.add_argument('--cache-dir', help='Directory for the incremental-export cache; unchanged roles are copied from it instead of exported again.')
+    export.add_argument('--sample-size', type=int, default=3, help='Cached roles re-exported to detect changes before trusting the cache (default: 3).')
+    export.add_argument('--cache-max-age-days', type=float, default=30, help='Re-export cached roles older than this many days (default: 30).')
+    export.add_argument('--workers', type=int, default=1, help='Roles exported in parallel (default: 1).')
+    export.add_argument('--max-rate', type=float, default=DEFAULT_MAX_RATE, help='Ceiling on requests per second; the exporter slows down below it while the host throttles (default: %(default)s).')
+    export.add_argument('--direct-http', action='store_true', help='Try the browserless HTTP export first, falling back to the browser per role.')
+    export.add_argument('--export-path-store', default=default_export_path_store(), help='JSON file remembering which export path (HTTP, browser Export button, direct file URL) works for each host (default: %(default)s).')
+    export.add_argument('--no-export-path-store', action='store_true', help='Probe export paths afresh and do not remember the result.')
+    export.add_argument('--page-timeout', type=int, default=45000, help='Page load timeout in ms (default: 45000).')
+    export.add_argument('--link-timeout', type=int, default=30000, help='Download wait timeout in ms (default: 30000).')
+    export.add_argument('--retries', type=int, default=2, help='Retries per role (default: 2).')
+    export.add_argument('--quiet', '-q', action='store_true', help='Do not print per-role progress.')
+    export.set_defaults(func=cmd_export)
+
+    batch = subparsers.add_parser('batch', help='Export several hosts/org units in one run, one archive each plus a combined index.')
+    batch.add_argument('targets', help='JSON list of targets: host, ou, cookie_env (environment variable holding that host\'s cookie), roles, role_pattern, include_d2lmonitor, host_workers, name.')
+    batch.add_argument('--output-dir', '-o', required=True, help=f'Directory for the per-target archives, logs and manifests and {BATCH_INDEX_NAME}.')
+    batch.add_argument('--workers', type=int, default=4, help='Roles exported in parallel across all targets (default: 4).')
+    batch.add_argument('--host-workers', type=int, default=DEFAULT_HOST_WORKERS, help=f'Most roles in flight against any one host (default: {DEFAULT_HOST_WORKERS}).')
+    batch.add_argument('--format', choices=available_archive_formats(), default='zip', help='Archive container (default: zip).')
+    batch.add_argument('--compression', choices=list(COMPRESSION_PRESETS), default='default', help='Compression preset (default: default).')
+    batch.add_argument('--dedup', action='store_true', help='Store byte-identical role files once per archive.')
+    batch.add_argument('--max-rate', type=float, default=DEFAULT_MAX_RATE, help='Ceiling on requests per second, per host (default: %(default)s).')
+    batch.add_argument('--direct-http', action='store_true', help='Try the browserless HTTP export first, falling back to the browser per role.')
+    batch.add_argument('--export-path-store', default=default_export_path_store(), help='JSON file remembering which export path works for each host (default: %(default)s).')
+    batch.add_argument('--no-export-path-store', action='store_true', help='Probe export paths afresh and do not remember the result.')
+    batch.add_argument('--page-timeout', type=int, default=45000, help='Page load timeout in ms (default: 45000).')
+    batch.add_argument('--link-timeout', type=int, default=30000, help='Download wait timeout in ms (default: 30000).')
+    batch.add_argument('--retries', type=int, default=2, help='Retries per role (default: 2).')
+    batch.add_argument('--quiet', '-q', action='store_true', help='Do not print per-role progress.')
+    batch.set_defaults(func=cmd_batch)
+
+    report = subparsers.add_parser('report', help='Write an Excel report (rows split at the row limit, plus a pivot) from an exported archive.')
+    report.add_argument('archive', help='An exported .zip or .tar.zst archive.')
+    report.add_argument('--output', '-o', help='Path of the report (default: <archive>.permissions.xlsx).')
+    report.add_argument('--split', choices=XLSX_SPLIT_MODES, default='sheets', help='Past 1,048,576 rows, continue on numbered sheets or numbered workbooks (default: sheets).')
+    report.add_argument('--no-pivot', action='store_true', help='Skip the role x permission pivot sheet.')
+    report.set_defaults(func=cmd_report)
+
+    query = subparsers.add_parser('query', help='Ask which roles hold a permission, from an export index or archive.')
+    query.add_argument('source', help='A .permissions.sqlite index written by export, or an exported .zip/.tar.zst archive.')
+    query.add_argument('--permission', help="Permission name; * is a wildcard, e.g. 'Impersonate*'.")
+    query.add_argument('--tool', help='Tool name; * is a wildcard.')
+    query.add_argument('--org-unit-type', help="Org unit type, e.g. 'Course Offering'.")
+    query.add_argument('--role', help='Role display name (wildcards allowed) or ID.')
+    query.add_argument('--all-values', action='store_true', help='Include permissions that are not granted.')
+    query.add_argument('--limit', type=int, help='Return at most this many rows.')
+    query.add_argument('--csv', action='store_true', help='Print CSV instead of a table.')
+    query.set_defaults(func=cmd_query)
+
+    diff = subparsers.add_parser('diff', help='Report permission changes between two exported archives.')
+    diff.add_argument('old', help='The earlier export (.zip or .tar.zst).')
+    diff.add_argument('new', help='The later export (.zip or .tar.zst).')
+    diff.add_argument('--output', '-o', help='Write every changed permission row to this CSV (or .parquet) file.')
+    diff.set_defaults(func=cmd_diff)
+
+    bench = subparsers.add_parser('bench', help='Benchmark discovery and export against a local stand-in Brightspace server.')
+    bench.add_argument('--roles', type=int, default=100, help='Roles served by the stand-in server (default: 100).')
+    bench.add_argument('--workers', type=int, default=4, help='Roles exported in parallel (default: 4).')
+    bench.add_argument('--latency', type=float, default=0.05, help='Server latency per request in seconds (default: 0.05).')
+    bench.add_argument('--jitter', type=float, default=0.5, help='Latency variation as a fraction of --latency (default: 0.5).')
+    bench.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of requests answered with HTTP 500 (default: 0).')
+    bench.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests answered with HTTP 429 (default: 0).')
+    bench.add_argument('--server-rate-limit', type=float, help='Throttle requests beyond this many per second, like a tenant limiter.')
+    bench.add_argument('--payload-rows', type=int, default=500, help='Permission rows per role file (default: 500).')
+    bench.add_argument('--page-size', type=int, default=50, help='Roles per role_list.d2l page (default: 50).')
+    bench.add_argument('--no-export-button', action='store_true', help='Serve preview pages without the Export button.')
+    bench.add_argument('--browser', action='store_true', help='Also benchmark the browser export path (needs Playwright and Chromium).')
+    bench.add_argument('--max-rate', type=float, default=100.0, help="The exporter's request-rate ceiling (default: 100).")
+    bench.add_argument('--no-memory', action='store_true', help='Skip tracemalloc peak-memory tracking and its overhead.')
+    bench.add_argument('--json', help='Write the results as JSON, e.g. to use as a later --baseline.')
+    bench.add_argument('--baseline', help='JSON from an earlier run; exit 1 if throughput, p95 latency or memory regressed.')
+    bench.add_argument('--tolerance', type=float, default=0.2, help='Allowed regression against --baseline as a fraction (default: 0.2).')
+    bench.add_argument('--quiet', '-q', action='store_true', help='Do not print progress.')
+    bench.set_defaults(func=cmd_bench)
+
+    install = subparsers.add_parser('install-browsers', help='Provision the Chromium build used for browser exports.')
+    install.add_argument('--check', action='store_true', help='Only report whether Chromium is installed (exit 1 if not).')
+    install.add_argument('--force', action='store_true', help='Run the installer even if Chromium looks installed.')
+    install.set_defaults(func=cmd_install_browsers)
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    # Configure logging but prevent propagation of sensitive data
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(asctime)s %(levelname)s %(message)s')
+    return args.func(args)
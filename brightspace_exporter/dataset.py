@@ -0,0 +1,243 @@
+"""
+Columnar permission dataset built from the exported role files.
+
+Every role file becomes rows of a single long-format table with the columns
+role_id, role_name, tool, permission, org_unit_type and value, so the full
+Role x Tool x Permission x Org Unit Type product can be analysed without
+hitting Excel's 1,048,576-row limit. Parsing is done by pandas' C reader and
+vectorized reshaping, never line by line in Python. Writing Parquet/Feather
+needs pyarrow.
+"""
+
+import csv
+import io
+import os
+import re
+import tempfile
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from .archive import DUPLICATES_MANIFEST_NAME, archive_base_path, iter_archive_members, parse_duplicates_manifest
+from .engine import role_output_filename
+
+try:
+    import pyarrow  # noqa: F401  (pandas' Parquet/Feather engine)
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+PERMISSION_COLUMNS = ['role_id', 'role_name', 'tool', 'permission', 'org_unit_type', 'value']
+CATEGORY_COLUMNS = ['role_name', 'tool', 'permission', 'org_unit_type', 'value']
+
+# file extension, MIME type
+DATASET_FORMATS = {
+    'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+    'feather': ('.feather', 'application/vnd.apache.arrow.file'),
+}
+
+_ROLE_FILENAME_RE = re.compile(r'^(?P<name>.*)_(?P<id>\d+)\.txt$')
+_HEADER_ALIASES = {
+    'tool': ('tool', 'tool name'),
+    'permission': ('permission', 'capability', 'permission name'),
+    'org_unit_type': ('org unit type', 'orgunittype', 'org unit', 'org type', 'organization unit type'),
+    'value': ('value', 'setting', 'enabled', 'granted'),
+}
+
+
+def dataset_path_for(output_path: str, dataset_format: str = 'parquet') -> str:
+    """Default location next to the archive: roles.zip -> roles.permissions.parquet"""
+    base = archive_base_path(output_path)
+    return f"{base}.permissions{DATASET_FORMATS[dataset_format][0]}"
+
+
+def role_from_filename(filename: str) -> Optional[Tuple[int, str]]:
+    """(role_id, sanitized role name) from an exported file name, or None for other files."""
+    match = _ROLE_FILENAME_RE.match(os.path.basename(filename))
+    return (int(match.group('id')), match.group('name')) if match else None
+
+
+def decode_role_file(data: bytes) -> str:
+    """Text of an exported role file."""
+    # D2L text exports may be UTF-16 (Excel-friendly) or UTF-8, with or without a BOM
+    if data.startswith((b'\xff\xfe', b'\xfe\xff')):
+        return data.decode('utf-16')
+    return data.decode('utf-8-sig', errors='replace')
+
+
+def find_header_line(lines: List[str]) -> Optional[int]:
+    """Index of the Tool/Permission header line among the first 50 lines, or None."""
+    return next(
+        (i for i, line in enumerate(lines[:50]) if re.search(r'\btool\b', line, re.I) and re.search(r'\bpermission\b', line, re.I)),
+        None
+    )
+
+
+def _canonical_header(cell: str) -> Optional[str]:
+    cell = re.sub(r'\s+', ' ', str(cell)).strip().lower()
+    for column, aliases in _HEADER_ALIASES.items():
+        if cell in aliases:
+            return column
+    return None
+
+
+def parse_role_file(data: Union[bytes, str], role_id: int, role_name: str) -> pd.DataFrame:
+    """
+    Parses one exported role file (raw bytes or decoded text) into
+    PERMISSION_COLUMNS rows.
+
+    The delimiter (tab, comma or semicolon) and header row are detected from
+    the text. A long file (Tool, Permission, Org Unit Type, Value columns) is
+    used as is; a wide file with one column per org unit type is melted.
+    A headerless file is read positionally as tool, permission, [org unit
+    type,] value.
+    """
+    text = decode_role_file(data) if isinstance(data, bytes) else data
+    lines = text.splitlines()
+    header_index = find_header_line(lines)
+    sample = lines[header_index] if header_index is not None else '\n'.join(lines[:20])
+    delimiter = max(('\t', ',', ';'), key=sample.count)
+    # Without a header, name the columns up front so short preamble lines do not fix the width
+    width = None if header_index is not None else max((line.count(delimiter) for line in lines), default=0) + 1
+
+    try:
+        frame = pd.read_csv(
+            io.StringIO(text), sep=delimiter, header=None, dtype=str, engine='c',
+            names=range(width) if width else None,
+            skiprows=(header_index + 1) if header_index is not None else 0,
+            skip_blank_lines=True, quoting=csv.QUOTE_MINIMAL, on_bad_lines='skip'
+        )
+    except pd.errors.EmptyDataError:
+        # Header only (e.g. a diff that kept no data lines)
+        return pd.DataFrame(columns=PERMISSION_COLUMNS)
+    if frame.empty:
+        return pd.DataFrame(columns=PERMISSION_COLUMNS)
+
+    if header_index is not None:
+        header = next(csv.reader([lines[header_index]], delimiter=delimiter))
+        header += [f'column_{i}' for i in range(len(header), frame.shape[1])]
+        frame.columns = [_canonical_header(cell) or cell.strip() for cell in header[:frame.shape[1]]]
+        frame = frame.loc[:, ~frame.columns.duplicated()]
+        if {'tool', 'permission'} - set(frame.columns):
+            return pd.DataFrame(columns=PERMISSION_COLUMNS)
+        if 'org_unit_type' not in frame.columns:
+            # Wide layout: every column besides tool/permission is an org unit type
+            type_columns = [column for column in frame.columns if column not in ('tool', 'permission', 'value')]
+            if type_columns:
+                frame = frame.melt(id_vars=['tool', 'permission'], value_vars=type_columns, var_name='org_unit_type', value_name='value')
+            else:
+                frame['org_unit_type'] = None
+    else:
+        positional = ['tool', 'permission', 'org_unit_type', 'value'] if frame.shape[1] >= 4 else ['tool', 'permission', 'value']
+        frame = frame.iloc[:, :len(positional)]
+        frame.columns = positional[:frame.shape[1]]
+        frame = frame.dropna(subset=frame.columns[1:])
+
+    frame = frame.reindex(columns=PERMISSION_COLUMNS[2:])
+    frame = frame.dropna(subset=['tool', 'permission'], how='all')
+    for column in PERMISSION_COLUMNS[2:]:
+        frame[column] = frame[column].str.strip()
+    frame.insert(0, 'role_name', role_name)
+    frame.insert(0, 'role_id', int(role_id))
+    return frame.reset_index(drop=True)
+
+
+def build_permission_dataset(source: Union[str, BinaryIO], archive_format: str = 'zip', role_list: Optional[List[Tuple[int, str]]] = None) -> pd.DataFrame:
+    """
+    Parses every role file in the archive at `source` (a path or file object,
+    e.g. a SpooledArchive) into one long-format DataFrame. Role names come
+    from `role_list` when given, otherwise from the file names. Repeated text
+    columns are stored as categoricals, which keeps millions of rows small.
+    """
+    names_by_file: Dict[str, Tuple[int, str]] = {}
+    order: Dict[int, int] = {}
+    if role_list is not None:
+        names_by_file = {role_output_filename(role_id, role_name): (role_id, role_name) for role_id, role_name in role_list}
+        order = {role_id: index for index, (role_id, _) in enumerate(role_list)}
+
+    frames, parsed, duplicates = [], {}, {}
+    for filename, member_file in iter_archive_members(source, archive_format):
+        if filename == DUPLICATES_MANIFEST_NAME:
+            duplicates = parse_duplicates_manifest(member_file.read())
+            continue
+        role = names_by_file.get(filename) or role_from_filename(filename)
+        if role is None:
+            continue
+        parsed[filename] = parse_role_file(member_file.read(), *role)
+        frames.append((order.get(role[0], len(order)), role[0], parsed[filename]))
+
+    # Deduplicated roles reuse the frame of the file holding their bytes: each unique blob is parsed once
+    for filename, stored_as in duplicates.items():
+        role = names_by_file.get(filename) or role_from_filename(filename)
+        if role is None or stored_as not in parsed:
+            continue
+        frame = parsed[stored_as].assign(role_id=role[0], role_name=role[1])
+        frames.append((order.get(role[0], len(order)), role[0], frame))
+
+    # Archive order follows download completion; keep the selection order instead
+    frames = [frame for _, _, frame in sorted(frames, key=lambda item: item[:2])]
+    if not frames:
+        dataset = pd.DataFrame(columns=PERMISSION_COLUMNS)
+    else:
+        dataset = pd.concat(frames, ignore_index=True)
+    dataset['role_id'] = dataset['role_id'].astype('int64')
+    for column in CATEGORY_COLUMNS:
+        dataset[column] = dataset[column].astype('category')
+    return dataset
+
+
+def iter_permission_frames(source: Union[str, BinaryIO], archive_format: str = 'zip', role_list: Optional[List[Tuple[int, str]]] = None) -> Iterator[pd.DataFrame]:
+    """
+    Yields one PERMISSION_COLUMNS frame per role file, in archive order, so
+    callers can stream any number of rows while holding one role at a time.
+    Deduplicated roles come last, from a second pass over the archive that
+    parses only the files holding their bytes; `source` must be re-readable.
+    """
+    names_by_file: Dict[str, Tuple[int, str]] = {}
+    if role_list is not None:
+        names_by_file = {role_output_filename(role_id, role_name): (role_id, role_name) for role_id, role_name in role_list}
+
+    duplicates: Dict[str, str] = {}
+    for filename, member_file in iter_archive_members(source, archive_format):
+        if filename == DUPLICATES_MANIFEST_NAME:
+            duplicates = parse_duplicates_manifest(member_file.read())
+            continue
+        role = names_by_file.get(filename) or role_from_filename(filename)
+        if role is not None:
+            yield parse_role_file(member_file.read(), *role)
+
+    duplicates_by_file: Dict[str, List[Tuple[int, str]]] = {}
+    for filename, stored_as in duplicates.items():
+        role = names_by_file.get(filename) or role_from_filename(filename)
+        if role is not None:
+            duplicates_by_file.setdefault(stored_as, []).append(role)
+    if duplicates_by_file:
+        for filename, member_file in iter_archive_members(source, archive_format, names=set(duplicates_by_file)):
+            frame = parse_role_file(member_file.read(), 0, '')
+            for role_id, role_name in duplicates_by_file[filename]:
+                yield frame.assign(role_id=int(role_id), role_name=role_name)
+
+
+def write_permission_dataset(dataset: pd.DataFrame, destination: Union[str, BinaryIO], dataset_format: str = 'parquet') -> None:
+    """Writes the dataset as Parquet (zstd-compressed) or Feather to a path or binary file object."""
+    if not PYARROW_AVAILABLE:
+        raise RuntimeError("Writing the permission dataset requires pyarrow (pip install pyarrow)")
+    if dataset_format == 'parquet':
+        dataset.to_parquet(destination, index=False, compression='zstd')
+    elif dataset_format == 'feather':
+        dataset.reset_index(drop=True).to_feather(destination, compression='zstd')
+    else:
+        raise ValueError(f"Unknown dataset format: {dataset_format}")
+
+
+def permission_dataset_bytes(source: Union[str, BinaryIO], archive_format: str = 'zip', role_list: Optional[List[Tuple[int, str]]] = None, dataset_format: str = 'parquet') -> bytes:
+    """
+    Builds the dataset from an archive and returns it serialized, for
+    download buttons. The file is written to an anonymous temp file, which
+    is closed before returning, and a SpooledArchive is read through a handle
+    of its own, so concurrent downloads do not disturb each other.
+    """
+    with tempfile.TemporaryFile() as dataset_file:
+        write_permission_dataset(build_permission_dataset(source, archive_format, role_list), dataset_file, dataset_format)
+        dataset_file.seek(0)
+        return dataset_file.read()
@@ -0,0 +1,1077 @@
+"""
+Headless engine for the Brightspace Role Permissions Exporter.
+
+Everything needed to discover roles and export their permission files,
+without any Streamlit dependency. Used by the Streamlit app
+(brightspace_role_exporter_v3.py) and the command-line entry point
+(python -m brightspace_exporter).
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlencode, urljoin, urlparse
+from http.cookies import SimpleCookie
+
+import pandas as pd
+import requests
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+
+from .archive import DOWNLOAD_CHUNK_SIZE, DUPLICATES_MANIFEST_NAME, PipelinedArchiveWriter, iter_archive_members, parse_duplicates_manifest, recover_partial_zip
+from .export_paths import EXPORT_PATH_BUTTON, EXPORT_PATH_DIRECT, EXPORT_PATH_HTTP, ExportPathSelector
+from .incremental import CHANGE_CARRIED_OVER, CHANGE_UNCHANGED, RoleContentCache, plan_incremental_export
+from .manifest import ExportManifest
+from .timings import ExportTimings, RoleTimer
+from .rate_limit import THROTTLE_STATUSES, RateController, Throttled, backoff_delay, parse_retry_after, rate_limited_request
+
+try:
+    import lxml.html  # faster role list parsing
+    LXML_AVAILABLE = True
+except ImportError:
+    LXML_AVAILABLE = False
+
+# Attempt to import Playwright
+try:
+    from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
+    PLAYWRIGHT_AVAILABLE = True
+except ImportError:
+    PLAYWRIGHT_AVAILABLE = False
+
+LP_API_VERSION = '1.48'
+
+# --- ASYNCIO SETUP FOR WINDOWS ---
+if sys.platform.startswith("win"):
+    try:
+        asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+    except Exception:
+        pass
+
+# --- BROWSER INSTALLER ---
+_browsers_ready = False
+_browsers_lock = threading.Lock()
+
+def _playwright_registry_directory(package_dir: str) -> str:
+    # Mirrors Playwright's own lookup: PLAYWRIGHT_BROWSERS_PATH, then the per-OS cache dir
+    browsers_path = os.environ.get('PLAYWRIGHT_BROWSERS_PATH')
+    if browsers_path == '0':
+        return os.path.join(package_dir, '.local-browsers')
+    if browsers_path:
+        return os.path.abspath(browsers_path)
+    if sys.platform.startswith('win'):
+        cache_dir = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), 'AppData', 'Local')
+    elif sys.platform == 'darwin':
+        cache_dir = os.path.join(os.path.expanduser('~'), 'Library', 'Caches')
+    else:
+        cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'ms-playwright')
+
+def playwright_browsers_installed() -> bool:
+    """
+    Fast check (no subprocess) for the Chromium build the installed Playwright
+    expects: looks for its INSTALLATION_COMPLETE marker in the browser registry.
+    Returns False when unsure, so callers fall back to a real install.
+    """
+    if not PLAYWRIGHT_AVAILABLE:
+        return False
+    try:
+        import playwright
+        package_dir = os.path.join(os.path.dirname(playwright.__file__), 'driver', 'package')
+        with open(os.path.join(package_dir, 'browsers.json'), encoding='utf-8') as browsers_file:
+            browsers = {browser['name']: browser for browser in json.load(browsers_file)['browsers']}
+        # Headless launches use the headless shell on Playwright versions that ship one
+        name = 'chromium-headless-shell' if 'chromium-headless-shell' in browsers else 'chromium'
+        browser_dir = f"{name.replace('-', '_')}-{browsers[name]['revision']}"
+    except (OSError, ValueError, KeyError):
+        return False
+    registry_dir = _playwright_registry_directory(package_dir)
+    return os.path.exists(os.path.join(registry_dir, browser_dir, 'INSTALLATION_COMPLETE'))
+
+def install_playwright_browsers() -> bool:
+    print("Installing Playwright Chromium...")
+    try:
+        subprocess.run([sys.executable, "-m", "playwright", "install", "chromium"], check=True)
+        print("Playwright browsers installed successfully.")
+        return True
+    except subprocess.CalledProcessError as e:
+        print(f"Error installing Playwright browsers: {e}")
+        return False
+
+def ensure_playwright_browsers() -> bool:
+    """
+    Installs Chromium at most once per process, and only when the marker check
+    says it is missing. Called lazily right before the first browser launch.
+    """
+    global _browsers_ready
+    with _browsers_lock:
+        if not _browsers_ready:
+            _browsers_ready = playwright_browsers_installed() or install_playwright_browsers()
+    return _browsers_ready
+
+
+# --- SECURITY & UTILITY FUNCTIONS ---
+
+def is_safe_url(url: str) -> bool:
+    """
+    SSRF Protection: Validates that the URL is http/s and not a local/internal address.
+    """
+    try:
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https'):
+            return False
+        
+        hostname = parsed.hostname
+        if not hostname:
+            return False
+            
+        # Block localhost
+        if hostname in ('localhost', '127.0.0.1', '::1', '0.0.0.0'):
+            return False
+            
+        # Optional: specific D2L/Brightspace regex check could go here
+        # if "brightspace.com" not in hostname and "d2l" not in hostname: return False
+        
+        return True
+    except Exception:
+        return False
+
+def normalize_url(url: str) -> str:
+    return (url or '').strip().rstrip('/')
+
+def normalize_cookie(value: str) -> str:
+    if not value:
+        return ''
+    value = value.strip()
+    if value.lower().startswith('cookie:'):
+        value = value[7:].strip()
+    return re.sub(r'\s*;\s*', '; ', value)
+
+def sanitize_filename(name: str, default: str) -> str:
+    safe_name = re.sub(r'[^A-Za-z0-9_. -]+', '_', (name or '').strip())
+    return safe_name or default
+
+def format_seconds_to_hms(total_seconds: float) -> str:
+    total_seconds = max(0, int(total_seconds))
+    minutes, seconds = divmod(total_seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d}'
+
+def role_output_filename(role_id: int, role_name: str) -> str:
+    safe_name = sanitize_filename(role_name or f'role_{role_id}', f'role_{role_id}')
+    return f"{safe_name}_{role_id}.txt"
+
+def add_cookies_to_browser_context(context, host_url: str, cookie_header: str) -> None:
+    domain = urlparse(host_url).netloc
+    simple_cookie = SimpleCookie()
+    try:
+        simple_cookie.load(cookie_header or '')
+        cookies_for_playwright = [
+            {
+                'name': name,
+                'value': morsel.value,
+                'domain': domain,
+                'path': '/',
+                'secure': host_url.lower().startswith('https'),
+                'httpOnly': False,
+                'sameSite': 'Lax'
+            }
+            for name, morsel in simple_cookie.items()
+        ]
+        if cookies_for_playwright:
+            context.add_cookies(cookies_for_playwright)
+    except Exception as e:
+        logging.warning(f"Error parsing cookies: {e}") # Changed to warning
+
+# --- CORE LOGIC ---
+
+# Verify and discovery run while someone waits on the page: retry a throttled
+# request once, briefly, then report the throttling instead of sleeping it out
+INTERACTIVE_MAX_RETRIES = 1
+INTERACTIVE_MAX_WAIT_SECONDS = 10.0
+
+def throttled_message(retry_after: Optional[float] = None) -> str:
+    wait = f"about {int(retry_after + 0.5) or 1} seconds" if retry_after else "a minute"
+    return f"Brightspace is throttling requests. Wait {wait} and try again."
+
+def _raise_if_throttled(response) -> None:
+    if response.status_code in THROTTLE_STATUSES:
+        raise Throttled(parse_retry_after(response.headers.get('Retry-After')))
+
+def check_whoami(api_endpoint_url: str, cookie_header: str) -> Dict[str, Any]:
+    # User-Agent is important for WAFs
+    headers = {'User-Agent': 'Role-Permissions-Exporter/2.0', 'Cookie': cookie_header}
+    try:
+        response = rate_limited_request(requests.get, api_endpoint_url, max_retries=INTERACTIVE_MAX_RETRIES, max_wait=INTERACTIVE_MAX_WAIT_SECONDS, headers=headers, timeout=15)
+        if response.status_code == 200:
+            user_data = response.json()
+            user_full_name = user_data.get('FirstName', '') + ' ' + user_data.get('LastName', '')
+            return {'status': 'success', 'message': f"Authentication successful for: {user_full_name.strip()}"}
+        elif response.status_code in THROTTLE_STATUSES:
+            return {'status': 'throttled', 'message': throttled_message(parse_retry_after(response.headers.get('Retry-After')))}
+        else:
+            return {'status': 'fail', 'message': f"Authentication failed (Status {response.status_code}). Expired cookie or wrong host."}
+    except requests.RequestException as exception:
+        # Log generic error, do not log 'exception' object blindly as it may contain headers
+        logging.error(f"WhoAmI check failed for {api_endpoint_url}") 
+        return {'status': 'fail', 'message': "Network error. Please check URL."}
+
+def fetch_roles_via_api(api_endpoint_url: str, cookie_header: str) -> pd.DataFrame:
+    """Roles from the LP API (empty on failure). Raises Throttled if the host keeps throttling."""
+    headers = {'User-Agent': 'Role-Permissions-Exporter/2.0', 'Accept': 'application/json', 'Cookie': cookie_header}
+    try:
+        response = rate_limited_request(requests.get, api_endpoint_url, max_retries=INTERACTIVE_MAX_RETRIES, max_wait=INTERACTIVE_MAX_WAIT_SECONDS, headers=headers, timeout=30)
+        _raise_if_throttled(response)
+        response.raise_for_status()
+        roles_data = [{'Identifier': role.get('Identifier'), 'DisplayName': role.get('DisplayName')} for role in response.json()]
+        return pd.DataFrame(roles_data)
+    except Throttled:
+        raise
+    except Exception as exception:
+        logging.warning(f"API call failed (Status: {getattr(exception.response, 'status_code', 'N/A') if hasattr(exception, 'response') else 'N/A'})")
+        return pd.DataFrame()
+
+# --- ROLE LIST SCRAPING ---
+_ROLE_ID_RE = re.compile(r'roleId=(\d+)')
+_NEXT_TITLE_RE = re.compile(r'next', re.I)
+# Pages fetched at once once the pager's URL pattern is known
+DISCOVERY_WORKERS = 4
+MAX_ROLE_LIST_PAGES = 50
+
+def _parse_role_list_page(page_html: str, page_url: str) -> Tuple[List[Tuple[int, str]], Optional[str]]:
+    """(role id, display name) pairs and the absolute next-page URL (or None) of one role_list.d2l page."""
+    if LXML_AVAILABLE:
+        # Re-encoded with an explicit parser encoding: works with or without a declared charset
+        document = lxml.html.fromstring(page_html.encode('utf-8'), parser=lxml.html.HTMLParser(encoding='utf-8'))
+        anchors = [(anchor.get('href', ''), anchor.text_content()) for anchor in document.xpath('//a[contains(@href, "roleId=")]')]
+        next_links = [anchor.get('href') for anchor in document.xpath('//a[@title and @href]') if _NEXT_TITLE_RE.search(anchor.get('title'))]
+    else:
+        soup = BeautifulSoup(page_html, 'html.parser')
+        anchors = [(anchor['href'], anchor.get_text()) for anchor in soup.find_all('a', href=_ROLE_ID_RE)]
+        next_links = [anchor['href'] for anchor in soup.find_all('a', title=_NEXT_TITLE_RE) if anchor.has_attr('href')]
+    roles = []
+    for href, text in anchors:
+        match = _ROLE_ID_RE.search(href)
+        if match:
+            roles.append((int(match.group(1)), ' '.join(text.split()) or f'Role_{match.group(1)}'))
+    return roles, urljoin(page_url, next_links[0]) if next_links else None
+
+def _paging_pattern(second_url: str, third_url: str) -> Optional[Tuple[str, int, int]]:
+    """
+    (parameter, value on the second page, step) when two consecutive next-page
+    URLs differ only in one integer query parameter, e.g. page=1 -> page=2 or
+    start=50 -> start=100; later pages can then be requested directly.
+    """
+    second, third = urlparse(second_url), urlparse(third_url)
+    if (second.scheme, second.netloc, second.path) != (third.scheme, third.netloc, third.path):
+        return None
+    second_query, third_query = parse_qs(second.query), parse_qs(third.query)
+    if second_query.keys() != third_query.keys():
+        return None
+    differing = [key for key in second_query if second_query[key] != third_query[key]]
+    if len(differing) != 1:
+        return None
+    key = differing[0]
+    try:
+        second_value, third_value = int(second_query[key][0]), int(third_query[key][0])
+    except ValueError:
+        return None
+    return (key, second_value, third_value - second_value) if third_value > second_value else None
+
+def _page_url(template_url: str, parameter: str, value: int) -> str:
+    parts = urlparse(template_url)
+    query = parse_qs(parts.query)
+    query[parameter] = [str(value)]
+    return parts._replace(query=urlencode(query, doseq=True)).geturl()
+
+# Statuses some pagers return for a page number past the end of the list
+PAST_LAST_PAGE_STATUSES = (400, 404, 410, 416)
+
+def _is_past_last_page(error: Exception) -> bool:
+    return isinstance(error, requests.HTTPError) and error.response is not None and error.response.status_code in PAST_LAST_PAGE_STATUSES
+
+def fetch_roles_via_ui_scrape(host_url: str, organization_unit_id: int, cookie_header: str, progress_callback: Optional[Callable[[str], None]] = None) -> pd.DataFrame:
+    """
+    Scrapes role ids and names from the role_list.d2l pages over one pooled
+    session. The first pages are followed by their Next links; once two of
+    them reveal the pager's URL pattern (one integer parameter stepping by a
+    fixed amount), the remaining pages are fetched DISCOVERY_WORKERS at a
+    time. Pages are parsed with lxml when installed, else html.parser.
+    Raises Throttled rather than return a partial list if the host keeps
+    throttling.
+    """
+    start_url = f'{host_url}/d2l/lp/security/role_list.d2l?ou={organization_unit_id}'
+    roles: Dict[int, str] = {}
+    
+    if progress_callback:
+        progress_callback("Scraping role list from UI...")
+
+    session = build_http_session(cookie_header, pool_size=DISCOVERY_WORKERS)
+    session.headers['User-Agent'] = 'Mozilla/5.0'
+
+    def fetch_page(url: str) -> Tuple[List[Tuple[int, str]], Optional[str]]:
+        response = rate_limited_request(session.get, url, max_retries=INTERACTIVE_MAX_RETRIES, max_wait=INTERACTIVE_MAX_WAIT_SECONDS, timeout=30)
+        _raise_if_throttled(response)
+        response.raise_for_status()
+        return _parse_role_list_page(response.text, response.url)
+
+    def fetch_page_or_error(url: str) -> Tuple[Optional[Tuple[List[Tuple[int, str]], Optional[str]]], Optional[Exception]]:
+        # Concurrent pages report their error instead of raising, so one past the end can be told apart
+        try:
+            return fetch_page(url), None
+        except Exception as exception:
+            return None, exception
+
+    def add_roles(page_roles: List[Tuple[int, str]]) -> int:
+        new = 0
+        for role_id, display_name in page_roles:
+            if role_id not in roles:
+                roles[role_id] = display_name
+                new += 1
+        return new
+
+    page_number, pattern = 0, None
+    try:
+        # Sequential until the pager's pattern is known
+        followed, current_url = [], start_url
+        while current_url and current_url not in followed and page_number < MAX_ROLE_LIST_PAGES:
+            followed.append(current_url)
+            page_roles, current_url = fetch_page(followed[-1])
+            page_number += 1
+            if not add_roles(page_roles):
+                current_url = None
+            elif current_url and len(followed) >= 2:
+                pattern = _paging_pattern(followed[-1], current_url)
+                if pattern:
+                    break
+
+        if pattern and current_url and page_number < MAX_ROLE_LIST_PAGES:
+            parameter, value, step = pattern
+            # current_url is the first page not fetched yet
+            next_value = value + step
+            with ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS, thread_name_prefix='role-scrape') as executor:
+                while page_number < MAX_ROLE_LIST_PAGES:
+                    batch = min(DISCOVERY_WORKERS, MAX_ROLE_LIST_PAGES - page_number)
+                    urls = [_page_url(current_url, parameter, next_value + i * step) for i in range(batch)]
+                    next_value += batch * step
+                    finished = False
+                    # Results are consumed in page order; anything past the last page is discarded
+                    for page, error in executor.map(fetch_page_or_error, urls):
+                        page_number += 1
+                        if finished:
+                            continue
+                        if error is not None:
+                            if not _is_past_last_page(error):
+                                raise error
+                            # Out of range: the previous page was the last one
+                            finished = True
+                            continue
+                        page_roles, next_url = page
+                        if not add_roles(page_roles) or not next_url:
+                            finished = True
+                    if progress_callback:
+                        progress_callback(f"Scraping role list from UI... {len(roles)} roles so far")
+                    if finished:
+                        break
+    except Throttled:
+        # A partial list would look complete; let the caller report the throttling
+        raise
+    except Exception as exception:
+        logging.warning(f"UI scraping failed on page {page_number}")
+    finally:
+        session.close()
+            
+    return pd.DataFrame(list(roles.items()), columns=['Identifier', 'DisplayName']) if roles else pd.DataFrame()
+
+# How long the preview page gets to render its Export button
+EXPORT_BUTTON_TIMEOUT_MS = 8000
+
+def _goto(page, url: str, page_timeout: int, rate_controller: Optional[RateController], timer: RoleTimer, phase: str = 'navigate') -> None:
+    # Paced like any other request; a 429/503 page counts as throttling, not as content
+    if rate_controller is not None:
+        rate_controller.acquire()
+    started = time.monotonic()
+    with timer.phase(phase):
+        response = page.goto(url, wait_until='domcontentloaded', timeout=page_timeout)
+    if response is not None and response.status in THROTTLE_STATUSES:
+        if rate_controller is not None:
+            rate_controller.throttled(parse_retry_after(response.headers.get('retry-after')))
+        raise Throttled()
+    if rate_controller is not None:
+        rate_controller.succeeded(time.monotonic() - started)
+
+def export_one_role_v2(page, archive: PipelinedArchiveWriter, host_url: str, organization_unit_id: int, role_id: int, role_name: str, page_timeout: int, link_timeout: int, max_retries: int, export_path: str = 'auto', rate_controller: Optional[RateController] = None, timer: Optional[RoleTimer] = None) -> Tuple[bool, str, Optional[int]]:
+    """
+    Exports one role through the browser and streams the download into
+    `archive`. Returns (success, filename or error message, bytes written).
+
+    `export_path` 'button' uses the preview page's Export button only,
+    'direct' opens export_file.d2l straight away, and 'auto' tries the
+    button and falls back to export_file.d2l if it does not appear.
+    Page loads are paced by `rate_controller`; retries back off exponentially.
+    Each attempt's phases are timed into `timer` (see timings.py).
+    """
+    timer = timer if timer is not None else RoleTimer()
+    file_url = f'{host_url}/d2l/lp/security/export_file.d2l?roleId={role_id}&ou={organization_unit_id}'
+    last_error_message = "No attempts were made."
+    for attempt in range(max_retries + 1):
+        timer.start_attempt(export_path)
+        try:
+            if export_path == EXPORT_PATH_DIRECT:
+                _goto(page, file_url, page_timeout, rate_controller, timer)
+            else:
+                preview_url = f'{host_url}/d2l/lp/security/export_preview.d2l?roleId={role_id}&ou={organization_unit_id}'
+                _goto(page, preview_url, page_timeout, rate_controller, timer)
+
+                # Handling the "Export" button
+                export_button = page.get_by_role('button', name=re.compile(r'^\s*Export\s*$', re.I))
+                try:
+                    with timer.phase('button_wait'):
+                        export_button.wait_for(state='visible', timeout=EXPORT_BUTTON_TIMEOUT_MS)
+                        export_button.click()
+                except PlaywrightTimeoutError:
+                    if export_path == EXPORT_PATH_BUTTON:
+                        # A missing button will not appear on retry; let the caller switch paths
+                        return False, f'Export button not found for {role_id}.', None
+                    _goto(page, file_url, page_timeout, rate_controller, timer, phase='fallback_navigate')
+            
+            link_locator = page.locator('a[href*="viewFile.d2lfile"]')
+            with timer.phase('link_wait'):
+                link_locator.wait_for(state='visible', timeout=link_timeout)
+            
+            with timer.phase('download'):
+                with page.expect_download(timeout=link_timeout) as download_info:
+                    link_locator.click()
+                download = download_info.value
+                download_path = download.path()  # waits for the download to finish
+            output_filename = role_output_filename(role_id, role_name)
+            
+            # Copy Playwright's own download artifact into the ZIP in chunks,
+            # then drop it; no extra temp file and no full read into memory
+            with timer.phase('archive_write'):
+                file_size = archive.write_file(output_filename, download_path)
+            download.delete()
+            return True, output_filename, file_size
+
+        except Exception as exception:
+            # Do not log full exception as it might contain URL parameters or data
+            last_error_message = f'Export failed for {role_id}. Attempt {attempt+1}. Error: {type(exception).__name__}'
+            if attempt < max_retries:
+                # After a throttled page, rate_controller.acquire() also waits out Retry-After
+                time.sleep(backoff_delay(attempt))
+
+    return False, last_error_message, None
+
+def build_http_session(cookie_header: str, pool_size: int = 4) -> requests.Session:
+    """
+    Keep-alive session for the direct HTTP export path. Uses the same
+    header-based cookie handling as check_whoami/fetch_roles_via_api.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'User-Agent': 'Role-Permissions-Exporter/2.0', 'Cookie': cookie_header})
+    return session
+
+def export_one_role_http(session: requests.Session, archive: PipelinedArchiveWriter, host_url: str, organization_unit_id: int, role_id: int, role_name: str, page_timeout: int, link_timeout: int, rate_controller: Optional[RateController] = None, timer: Optional[RoleTimer] = None) -> Tuple[bool, str, Optional[int]]:
+    """
+    Browserless export: requests export_file.d2l, parses the viewFile.d2lfile
+    link out of the returned HTML and streams the download over the same
+    session straight into `archive`.
+    Single attempt apart from throttled (429/503) requests, which are paced
+    and retried through `rate_controller`; callers fall back to
+    export_one_role_v2 on failure. Phases are timed into `timer`.
+    """
+    timer = timer if timer is not None else RoleTimer()
+    timer.start_attempt(EXPORT_PATH_HTTP)
+    try:
+        file_url = f'{host_url}/d2l/lp/security/export_file.d2l?roleId={role_id}&ou={organization_unit_id}'
+        with timer.phase('navigate'):
+            response = rate_limited_request(session.get, file_url, rate_controller, timeout=page_timeout / 1000)
+            response.raise_for_status()
+
+        soup = BeautifulSoup(response.text, 'html.parser')
+        anchor = soup.find('a', href=re.compile(r'viewFile\.d2lfile'))
+        if not anchor:
+            return False, f'Export link not found for {role_id} (direct HTTP).', None
+
+        with timer.phase('download'), rate_limited_request(session.get, urljoin(response.url, anchor['href']), rate_controller, timeout=link_timeout / 1000, stream=True) as download:
+            download.raise_for_status()
+            # An HTML body here is a login/error page, not the permissions file
+            if 'text/html' in download.headers.get('Content-Type', '').lower():
+                return False, f'Unexpected HTML response for {role_id} (direct HTTP).', None
+
+            output_filename = role_output_filename(role_id, role_name)
+            file_size = archive.write_stream(output_filename, download.iter_content(DOWNLOAD_CHUNK_SIZE))
+        return True, output_filename, file_size
+    except Exception as exception:
+        # Do not log full exception as it might contain URL parameters or data
+        return False, f'Direct HTTP export failed for {role_id}. Error: {type(exception).__name__}', None
+
+BROWSER_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
+
+class BrowserPool:
+    """
+    Long-lived pool of headless Chromium browsers, reused across exports (and
+    Streamlit reruns when held in st.cache_resource).
+
+    Playwright's sync API is bound to the thread that started it, so each
+    browser lives on its own slot thread and work is submitted to it as jobs.
+    Every job gets a fresh, isolated context with its own cookies, which is
+    closed when the job ends; browsers are only shared, never contexts.
+    At most `max_contexts` jobs run at once (one per slot), and a slot closes
+    its browser and exits after `idle_timeout` seconds without work.
+    """
+
+    def __init__(self, max_contexts: int = 4, idle_timeout: float = 300.0):
+        self.max_contexts = max(1, int(max_contexts))
+        self.idle_timeout = idle_timeout
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._slot_count = 0
+        self._idle_slots = 0
+        self._closed = False
+
+    def submit(self, job: Callable[[Callable[[], Any]], Any], host_url: str, cookie_header: str) -> Future:
+        """
+        Queues `job(get_page)` on a browser slot. `get_page()` lazily opens a
+        new authenticated context/page for this job only. Returns a Future
+        with the job's result.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("BrowserPool is closed")
+            self._jobs.put((future, job, host_url, cookie_header))
+            if self._jobs.qsize() > self._idle_slots and self._slot_count < self.max_contexts:
+                self._slot_count += 1
+                self._idle_slots += 1
+                threading.Thread(target=self._slot_main, daemon=True).start()
+        return future
+
+    def close(self) -> None:
+        """Stops accepting jobs; slots finish queued work, then close their browsers."""
+        with self._lock:
+            self._closed = True
+            for _ in range(self._slot_count):
+                self._jobs.put(None)
+
+    def _slot_main(self) -> None:
+        playwright_instance, browser = None, None
+        try:
+            while True:
+                try:
+                    item = self._jobs.get(timeout=self.idle_timeout)
+                except queue.Empty:
+                    with self._lock:
+                        # Idle eviction; re-check under the lock so a job queued meanwhile is not stranded
+                        if self._jobs.empty():
+                            self._slot_count -= 1
+                            self._idle_slots -= 1
+                            return
+                    continue
+                if item is None:
+                    with self._lock:
+                        self._slot_count -= 1
+                        self._idle_slots -= 1
+                    return
+
+                with self._lock:
+                    self._idle_slots -= 1
+                future, job, host_url, cookie_header = item
+                try:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    with contextlib.ExitStack() as stack:
+                        def get_page():
+                            nonlocal playwright_instance, browser
+                            if browser is None or not browser.is_connected():
+                                if playwright_instance is None:
+                                    ensure_playwright_browsers()
+                                    playwright_instance = sync_playwright().start()
+                                browser = playwright_instance.chromium.launch(
+                                    headless=True,
+                                    args=['--no-sandbox', '--disable-dev-shm-usage']
+                                )
+                            # Secure Context (fresh per job, never shared between jobs)
+                            context = browser.new_context(
+                                accept_downloads=True,
+                                user_agent=BROWSER_USER_AGENT,
+                                viewport={'width': 1920, 'height': 1080}
+                            )
+                            stack.callback(context.close)
+                            add_cookies_to_browser_context(context, host_url, cookie_header)
+                            return context.new_page()
+
+                        result = job(get_page)
+                    future.set_result(result)
+                except Exception as e:
+                    future.set_exception(e)
+                finally:
+                    with self._lock:
+                        self._idle_slots += 1
+        finally:
+            for closer in (browser.close if browser else None, playwright_instance.stop if playwright_instance else None):
+                if closer:
+                    try:
+                        closer()
+                    except Exception:
+                        pass
+
+def export_role(archive: PipelinedArchiveWriter, host_url: str, organization_unit_id: int, cookie_header: str, role_id: int, role_name: str, page_timeout: int, link_timeout: int, max_retries: int, browser_pool: Optional[BrowserPool], http_session: Optional[requests.Session], path_selector: ExportPathSelector, rate_controller: RateController, timer: RoleTimer) -> Tuple[bool, str, Optional[int], str]:
+    """
+    Exports one role into `archive` and returns (success, filename or error,
+    size, method). Tries the available export paths (direct HTTP with
+    `http_session`, then the browser's Export button and export_file.d2l,
+    run as jobs on `browser_pool`) in the order `path_selector` gives, so
+    once a path has worked for this host it is used first. Holds one of
+    `rate_controller`'s slots while it runs.
+    """
+    available = [EXPORT_PATH_HTTP] if http_session is not None else []
+    if PLAYWRIGHT_AVAILABLE and browser_pool is not None:
+        available += [EXPORT_PATH_BUTTON, EXPORT_PATH_DIRECT]
+
+    success, fname, size, method = False, f'No export path available for {role_id}.', None, 'HTTP'
+    with rate_controller.slot():
+        browser_failed = False
+        for export_path in path_selector.candidates(host_url, available):
+            if export_path == EXPORT_PATH_HTTP:
+                method = 'HTTP'
+                success, fname, size = export_one_role_http(
+                    http_session, archive, host_url, organization_unit_id, role_id, role_name,
+                    page_timeout, link_timeout, rate_controller, timer
+                )
+            elif browser_failed:
+                continue
+            else:
+                method = 'Browser'
+                try:
+                    success, fname, size = browser_pool.submit(
+                        lambda get_page, export_path=export_path: export_one_role_v2(
+                            get_page(), archive, host_url, organization_unit_id, role_id, role_name,
+                            page_timeout, link_timeout, max_retries, export_path, rate_controller, timer
+                        ),
+                        host_url, cookie_header
+                    ).result()
+                except Exception as e:
+                    # Says nothing about the path itself, so it is not recorded
+                    logging.warning(f"Browser process error: {type(e).__name__}")
+                    success, fname, size = False, f'Browser unavailable for {role_id}.', None
+                    browser_failed = True
+                    continue
+            path_selector.record(host_url, export_path, success)
+            if success or archive.error is not None:
+                break
+    return success, fname, size, method
+
+def export_worker(task_queue: "queue.Queue", result_queue: "queue.Queue", archive: PipelinedArchiveWriter, host_url: str, organization_unit_id: int, cookie_header: str, page_timeout: int, link_timeout: int, max_retries: int, browser_pool: BrowserPool, http_session: Optional[requests.Session] = None, path_selector: Optional[ExportPathSelector] = None, rate_controller: Optional[RateController] = None, timings: Optional[ExportTimings] = None) -> None:
+    """
+    Pulls (index, role_id, role_name) tasks until the queue is drained, streams
+    each file into `archive` (see export_role) and pushes (index, role_id,
+    role_name, success, filename, size, method) results back.
+    `rate_controller` paces every request and caps how many roles are in
+    flight at once, below the worker count while the host is throttling.
+    Each role's phase timings are added to `timings`.
+    """
+    if path_selector is None:
+        path_selector = ExportPathSelector()
+    if rate_controller is None:
+        rate_controller = RateController()
+
+    while archive.error is None:
+        try:
+            index, role_id, role_name = task_queue.get_nowait()
+        except queue.Empty:
+            break
+
+        timer = RoleTimer()
+        success, fname, size, method = export_role(
+            archive, host_url, organization_unit_id, cookie_header, role_id, role_name,
+            page_timeout, link_timeout, max_retries, browser_pool, http_session, path_selector, rate_controller, timer
+        )
+        if timings is not None:
+            timings.add_role(role_id, role_name, timer, success, method)
+        result_queue.put((index, role_id, role_name, success, fname, size, method))
+
+def run_concurrent_export(archive: PipelinedArchiveWriter, role_list: List[Tuple[int, str]], worker_count: int, host_url: str, organization_unit_id: int, cookie_header: str, page_timeout: int, link_timeout: int, max_retries: int, direct_http: bool = False, browser_pool: Optional[BrowserPool] = None, path_selector: Optional[ExportPathSelector] = None, rate_controller: Optional[RateController] = None, timings: Optional[ExportTimings] = None):
+    """
+    Exports roles with `worker_count` workers in parallel, streaming files into `archive`.
+    Yields (index, role_id, role_name, success, filename, size, method) in completion order;
+    roles left unexported because every worker died are yielded as failures.
+    Without a shared `browser_pool`, a private one is created for this run and closed afterwards.
+    Pass a `path_selector` to reuse what earlier runs learned about this host's export path,
+    and a `rate_controller` to share request pacing with other work against the same host.
+    Per-role phase timings are collected into `timings` when given.
+    """
+    task_queue = queue.Queue()
+    for index, (role_id, role_name) in enumerate(role_list):
+        task_queue.put((index, role_id, role_name))
+    result_queue = queue.Queue()
+    worker_count = max(1, min(worker_count, len(role_list)))
+    http_session = build_http_session(cookie_header, pool_size=worker_count) if direct_http else None
+    own_pool = browser_pool is None
+    if own_pool:
+        browser_pool = BrowserPool(max_contexts=worker_count)
+    if path_selector is None:
+        path_selector = ExportPathSelector()
+    if rate_controller is None:
+        rate_controller = RateController(max_concurrency=worker_count)
+
+    workers = [
+        threading.Thread(
+            target=export_worker,
+            args=(task_queue, result_queue, archive, host_url, organization_unit_id, cookie_header, page_timeout, link_timeout, max_retries, browser_pool, http_session, path_selector, rate_controller, timings),
+            daemon=True
+        )
+        for _ in range(worker_count)
+    ]
+    for worker in workers:
+        worker.start()
+
+    pending = set(range(len(role_list)))
+    try:
+        while pending:
+            try:
+                result = result_queue.get(timeout=0.5)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers) and result_queue.empty():
+                    break
+                continue
+            pending.discard(result[0])
+            yield result
+
+        for index in sorted(pending):
+            role_id, role_name = role_list[index]
+            yield index, role_id, role_name, False, 'Browser worker stopped before this role was exported.', None, None
+    finally:
+        # If the consumer stops early (error, Streamlit rerun), workers finish their current role and exit
+        while True:
+            try:
+                task_queue.get_nowait()
+            except queue.Empty:
+                break
+        if http_session is not None:
+            http_session.close()
+        if own_pool:
+            browser_pool.close()
+
+
+# --- HIGH-LEVEL ENTRY POINTS ---
+
+def whoami_url(host_url: str) -> str:
+    return f'{host_url}/d2l/api/lp/{LP_API_VERSION}/users/whoami'
+
+def roles_api_url(host_url: str) -> str:
+    return f'{host_url}/d2l/api/lp/{LP_API_VERSION}/roles/'
+
+# Role lists per (host, org unit, cookie hash): (fetched at, TTL it was cached for, DataFrame)
+ROLE_LIST_CACHE_TTL_SECONDS = 300
+_role_list_cache: Dict[Tuple[str, int, str], Tuple[float, float, pd.DataFrame]] = {}
+_role_list_cache_lock = threading.Lock()
+
+def clear_role_list_cache() -> None:
+    with _role_list_cache_lock:
+        _role_list_cache.clear()
+
+def discover_roles(host_url: str, organization_unit_id: int, cookie_header: str, exclude_d2lmonitor: bool = True, progress_callback: Optional[Callable[[str], None]] = None, cache_ttl: float = ROLE_LIST_CACHE_TTL_SECONDS) -> pd.DataFrame:
+    """
+    Lists roles via the API, falling back to UI scraping when the API returns nothing.
+    Returns a DataFrame with Identifier/DisplayName columns sorted by name (empty if none found).
+    Raises Throttled, without waiting long, if the host keeps throttling.
+    A non-empty result is reused for `cache_ttl` seconds for the same host,
+    org unit and cookie (0 always fetches); the cookie is part of the key
+    so one session never sees a list fetched with another's credentials.
+    """
+    cache_key = (host_url, int(organization_unit_id), hashlib.sha256(cookie_header.encode('utf-8')).hexdigest())
+    with _role_list_cache_lock:
+        cached = _role_list_cache.get(cache_key)
+    if cache_ttl > 0 and cached is not None and time.time() - cached[0] < cache_ttl:
+        if progress_callback:
+            progress_callback("Using the role list fetched a moment ago...")
+        df = cached[2].copy()
+    else:
+        # Try API
+        df = fetch_roles_via_api(roles_api_url(host_url), cookie_header)
+
+        # Try Scrape if API empty
+        if df.empty:
+            if progress_callback:
+                progress_callback("API returned no roles. Trying UI scraping...")
+            df = fetch_roles_via_ui_scrape(host_url, organization_unit_id, cookie_header, progress_callback)
+        if not df.empty and cache_ttl > 0:
+            with _role_list_cache_lock:
+                now = time.time()
+                # Each entry expires after the TTL it was cached for, not this caller's
+                for key in [key for key, (fetched_at, ttl, _) in _role_list_cache.items() if now - fetched_at >= ttl]:
+                    del _role_list_cache[key]
+                _role_list_cache[cache_key] = (now, cache_ttl, df.copy())
+
+    if df.empty:
+        return df
+    if exclude_d2lmonitor:
+        df = df[df['DisplayName'] != 'D2LMonitor']
+    return df.sort_values('DisplayName')
+
+def filter_roles(roles_df: pd.DataFrame, role_selectors: Optional[List[str]], role_pattern: Optional[str]) -> List[Tuple[int, str]]:
+    """
+    Selects roles by exact display name or numeric ID (`role_selectors`) and
+    by a case-insensitive regex on the display name (`role_pattern`). No
+    filters keeps every role.
+    """
+    selected = roles_df
+    if role_selectors:
+        ids = {int(value) for value in role_selectors if value.isdigit()}
+        names = set(role_selectors)
+        selected = selected[selected['Identifier'].astype(int).isin(ids) | selected['DisplayName'].isin(names)]
+    if role_pattern:
+        selected = selected[selected['DisplayName'].str.contains(role_pattern, flags=re.I, regex=True)]
+    return [(int(row['Identifier']), str(row['DisplayName'])) for _, row in selected.iterrows()]
+
+def prepare_resume(output: Union[str, BinaryIO], role_list: List[Tuple[int, str]], manifest: ExportManifest) -> set:
+    """
+    Reconciles a partial ZIP with its manifest before resuming and returns
+    the ids of roles that are already safely in the archive.
+
+    A ZIP left without a central directory by a killed process is rebuilt
+    from its hash-verified entries first. Roles in the manifest whose file
+    is missing from the archive are forgotten so they get exported again,
+    and intact entries missing from the manifest are recorded.
+    """
+    if isinstance(output, str):
+        if not os.path.exists(output):
+            manifest.discard(manifest.completed_role_ids())
+            return set()
+        if not zipfile.is_zipfile(output):
+            recover_partial_zip(output, {entry['filename']: entry['sha256'] for entry in manifest.entries()})
+    elif not zipfile.is_zipfile(output):
+        manifest.discard(manifest.completed_role_ids())
+        return set()
+
+    filenames = {role_output_filename(role_id, role_name): (role_id, role_name) for role_id, role_name in role_list}
+    with zipfile.ZipFile(output) as existing:
+        archived = set(existing.namelist())
+        duplicates = parse_duplicates_manifest(existing.read(DUPLICATES_MANIFEST_NAME)) if DUPLICATES_MANIFEST_NAME in archived else {}
+        # Deduplicated roles count as archived while the file holding their bytes is
+        archived |= {filename for filename, stored_as in duplicates.items() if stored_as in archived}
+        for filename in archived:
+            if filename in filenames and manifest.get(filenames[filename][0]) is None:
+                role_id, role_name = filenames[filename]
+                data = existing.read(duplicates.get(filename, filename))
+                manifest.record(role_id, role_name, filename, len(data), hashlib.sha256(data).hexdigest(), stored_as=duplicates.get(filename))
+
+    manifest.discard([entry['role_id'] for entry in manifest.entries() if entry['filename'] not in archived])
+    return {role_id for role_id, role_name in role_list if role_output_filename(role_id, role_name) in archived}
+
+def export_roles_to_archive(
+    output: Union[str, BinaryIO],
+    role_list: List[Tuple[int, str]],
+    host_url: str,
+    organization_unit_id: int,
+    cookie_header: str,
+    page_timeout: int = 45000,
+    link_timeout: int = 30000,
+    max_retries: int = 2,
+    worker_count: int = 1,
+    direct_http: bool = False,
+    browser_pool: Optional[BrowserPool] = None,
+    archive_format: str = 'zip',
+    compression: str = 'default',
+    manifest: Optional[ExportManifest] = None,
+    resume: bool = False,
+    cache: Optional[RoleContentCache] = None,
+    sample_size: int = 3,
+    dedup: bool = False,
+    path_selector: Optional[ExportPathSelector] = None,
+    rate_controller: Optional[RateController] = None,
+    timings: Optional[ExportTimings] = None,
+    progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Exports every (role_id, role_name) in `role_list` into an archive written
+    to `output` (a path or a seekable binary file object such as a
+    SpooledArchive) and returns the export log, one dict per role in
+    `role_list` order. Raises ArchiveSizeExceeded if the output hits its cap.
+
+    `archive_format` is 'zip' or 'tar.zst'; `compression` is one of the
+    COMPRESSION_PRESETS (store/fast/default/max). Compression runs on its
+    own writer thread, pipelined with the downloads.
+    Pass a long-lived `browser_pool` to reuse warm browsers across runs, and
+    a `path_selector` (see export_paths.py) to remember which export path
+    works for this host. Requests are paced by `rate_controller` (by default
+    one for this run, see rate_limit.py), which backs off and narrows
+    concurrency when the host throttles, then recovers. Every export attempt
+    is timed phase by phase into `timings` (see timings.py), which the caller
+    can write out as a report.
+
+    Each committed file is checkpointed in `manifest` (role id, filename,
+    size, SHA-256, timestamp). With `resume=True`, `output` must be the
+    partial ZIP from an earlier run with the same manifest: roles already in
+    it are carried over (Method 'Checkpoint') and only missing or failed
+    roles are exported and appended to the same archive.
+
+    With a `cache`, the run is incremental: `sample_size` cached roles are
+    exported first, and if they all match their cached hash the other cached
+    roles are copied from the cache (Method 'Cache') instead of exported.
+    The log's Change column (and the manifest) marks every role as new,
+    changed, unchanged or carried over, and the cache is updated afterwards.
+
+    With `dedup=True`, roles whose files are byte-identical share one stored
+    copy; the manifest's `stored_as` and the archive's DUPLICATES_MANIFEST_NAME
+    map each duplicate to it.
+    `progress_callback` receives a dict after each role with the keys
+    completed, total, role, success_count, failure_count, in_flight, eta_seconds,
+    throttle_count and percentiles ({phase or 'role': (p50, p95) seconds}).
+    The ETA comes from the distribution of role durations so far.
+    """
+    if resume and manifest is None:
+        raise ValueError("Resuming an export needs its manifest")
+    manifest = manifest if manifest is not None else ExportManifest()
+    if rate_controller is None:
+        rate_controller = RateController(max_concurrency=worker_count)
+    timings = timings if timings is not None else ExportTimings()
+    completed_ids = prepare_resume(output, role_list, manifest) if resume else set()
+    if resume and not completed_ids and not isinstance(output, str):
+        # Nothing worth keeping: start the in-memory archive over
+        output.seek(0)
+        output.truncate(0)
+
+    export_log = []
+    for index, (rid, rname) in enumerate(role_list):
+        if rid in completed_ids:
+            export_log.append({'Role': rname, 'ID': rid, 'Status': 'OK', 'Method': 'Checkpoint', 'Bytes': manifest.get(rid)['size'], '_order': index})
+    pending_roles = [(index, role) for index, role in enumerate(role_list) if role[0] not in completed_ids]
+
+    counts = {'completed': 0, 'success': 0, 'failure': 0}
+    start_time = time.time()
+    total = len(pending_roles)
+
+    roles_by_filename = {role_output_filename(rid, rname): (rid, rname) for rid, rname in role_list}
+    carried_filenames = set()
+
+    def checkpoint(filename: str, size: int, sha256: str, stored_as: str) -> None:
+        if filename in roles_by_filename:
+            rid, rname = roles_by_filename[filename]
+            change = None
+            if cache is not None:
+                change = CHANGE_CARRIED_OVER if filename in carried_filenames else cache.classify(rid, rname, sha256)
+            manifest.record(rid, rname, filename, size, sha256, change=change, stored_as=stored_as)
+
+    def report_progress(rname: str) -> None:
+        counts['completed'] += 1
+        if progress_callback:
+            i = counts['completed']
+            eta = timings.eta_seconds(total - i, rate_controller.concurrency)
+            if eta is None:
+                # Nothing exported yet (e.g. only cached roles): plain throughput
+                elapsed = time.time() - start_time
+                eta = (total - i) / (i / elapsed) if elapsed > 0 else None
+            progress_callback({
+                'completed': i,
+                'total': total,
+                'role': rname,
+                'success_count': counts['success'],
+                'failure_count': counts['failure'],
+                'in_flight': min(rate_controller.concurrency, total - i),
+                'eta_seconds': eta,
+                'throttle_count': rate_controller.throttle_count,
+                'percentiles': timings.percentiles(),
+            })
+
+    def export_batch(archive: PipelinedArchiveWriter, batch: List[Tuple[int, Tuple[int, str]]]) -> None:
+        for batch_index, rid, rname, success, fname, size, method in run_concurrent_export(
+            archive, [role for _, role in batch], worker_count, host_url, organization_unit_id, cookie_header,
+            page_timeout, link_timeout, max_retries,
+            direct_http=direct_http, browser_pool=browser_pool, path_selector=path_selector,
+            rate_controller=rate_controller, timings=timings
+        ):
+            index = batch[batch_index][0]
+            if success:
+                counts['success'] += 1
+                export_log.append({'Role': rname, 'ID': rid, 'Status': 'OK', 'Method': method, 'Bytes': size, '_order': index})
+            else:
+                counts['failure'] += 1
+                # Only log generic error to UI
+                export_log.append({'Role': rname, 'ID': rid, 'Status': 'Failed', 'Error': 'Download Failed or Timed Out', '_order': index})
+            report_progress(rname)
+
+    with PipelinedArchiveWriter(
+        output, archive_format=archive_format, compression=compression,
+        max_pending_entries=2 * max(1, worker_count),
+        append=bool(completed_ids), on_entry_written=checkpoint, dedup=dedup
+    ) as archive:
+        if cache is None:
+            export_batch(archive, pending_roles)
+        else:
+            index_of = {role: index for index, role in pending_roles}
+            probe_roles, cached_roles = plan_incremental_export(cache, [role for _, role in pending_roles], sample_size)
+            skip = set(probe_roles) | set(cached_roles)
+            other_roles = [(index, role) for index, role in pending_roles if role not in skip]
+
+            # Probe first; the writer must commit (and hash) them before we can compare
+            export_batch(archive, [(index_of[role], role) for role in probe_roles])
+            archive.drain()
+            tenant_unchanged = bool(probe_roles) and all(
+                (entry := manifest.get(rid)) is not None and entry.get('change') == CHANGE_UNCHANGED
+                for rid, _ in probe_roles
+            )
+
+            if tenant_unchanged:
+                for rid, rname in cached_roles:
+                    cached_entry = cache.get(rid)
+                    filename = role_output_filename(rid, rname)
+                    carried_filenames.add(filename)
+                    archive.write_stream(filename, cache.iter_blob(cached_entry['sha256']))
+                    counts['success'] += 1
+                    export_log.append({'Role': rname, 'ID': rid, 'Status': 'OK', 'Method': 'Cache', 'Bytes': cached_entry['size'], '_order': index_of[(rid, rname)]})
+                    report_progress(rname)
+            else:
+                other_roles += [(index_of[role], role) for role in cached_roles]
+            export_batch(archive, other_roles)
+
+    if archive.error is not None:
+        raise archive.error
+
+    if cache is not None:
+        update_role_cache(cache, output, archive_format, manifest, export_log)
+        for entry in export_log:
+            manifest_entry = manifest.get(entry['ID']) if entry['Status'] == 'OK' else None
+            entry['Change'] = manifest_entry.get('change') if manifest_entry else None
+
+    # Keep the log in selection order regardless of completion order
+    export_log.sort(key=lambda entry: entry.pop('_order'))
+    return export_log
+
+def update_role_cache(cache: RoleContentCache, output: Union[str, BinaryIO], archive_format: str, manifest: ExportManifest, export_log: List[Dict[str, Any]]) -> None:
+    """
+    Records freshly exported roles in the cache, reading back from the
+    finished archive only the files whose content the cache does not have yet.
+    Carried-over roles keep their original timestamp, so they are verified
+    again once they reach the cache's max age.
+    """
+    missing_blobs = {}
+    for entry in export_log:
+        if entry['Status'] != 'OK' or entry['Method'] not in ('HTTP', 'Browser'):
+            continue
+        manifest_entry = manifest.get(entry['ID'])
+        if manifest_entry is None:
+            continue
+        cache.update(entry['ID'], entry['Role'], manifest_entry['sha256'], manifest_entry['size'])
+        if not cache.has_blob(manifest_entry['sha256']):
+            missing_blobs[manifest_entry.get('stored_as', manifest_entry['filename'])] = manifest_entry['sha256']
+
+    if missing_blobs:
+        for filename, member_file in iter_archive_members(output, archive_format, names=set(missing_blobs)):
+            cache.store_blob(missing_blobs[filename], member_file)
+    cache.save()
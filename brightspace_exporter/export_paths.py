@@ -0,0 +1,106 @@
+"""
+Per-host choice of export path, learned from what actually works.
+
+A role file can be fetched three ways:
+
+    http    export_file.d2l over plain HTTPS, no browser (Direct HTTP mode)
+    direct  export_file.d2l opened in the browser
+    button  export_preview.d2l, then the page's Export button
+
+Which one works depends on the host: on some tenants the Export button
+never renders, so trying it first costs a full button timeout per role.
+ExportPathSelector probes the paths in order on the first roles, then goes
+straight to the winner for that host and only tries the others again when
+the chosen path fails. With a file path, the choice survives across runs.
+"""
+
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+EXPORT_PATH_HTTP = 'http'
+EXPORT_PATH_DIRECT = 'direct'
+EXPORT_PATH_BUTTON = 'button'
+# Probe order before anything is known: cheapest first, then the original browser flow
+EXPORT_PATHS = [EXPORT_PATH_HTTP, EXPORT_PATH_BUTTON, EXPORT_PATH_DIRECT]
+
+
+def default_export_path_store() -> str:
+    """~/.cache/brightspace_exporter/export_paths.json (honours XDG_CACHE_HOME)."""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'brightspace_exporter', 'export_paths.json')
+
+
+class ExportPathSelector:
+    """
+    Thread-safe memory of the preferred export path per host, optionally
+    persisted as JSON at `path` (only host names and path names are stored).
+    `paths` restricts which export paths may be tried at all.
+    """
+
+    def __init__(self, path: Optional[str] = None, paths: Optional[List[str]] = None):
+        self.path = path
+        self.paths = list(paths) if paths is not None else list(EXPORT_PATHS)
+        self._lock = threading.Lock()
+        self._hosts: Dict[str, Dict[str, object]] = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as store_file:
+                    self._hosts = json.load(store_file)
+            except (OSError, ValueError):
+                # A damaged store only costs one round of probing
+                self._hosts = {}
+
+    @staticmethod
+    def _host_key(host_url: str) -> str:
+        return (urlparse(host_url).netloc or host_url).lower()
+
+    def preferred(self, host_url: str) -> Optional[str]:
+        with self._lock:
+            return self._hosts.get(self._host_key(host_url), {}).get('preferred')
+
+    def candidates(self, host_url: str, available: List[str]) -> List[str]:
+        """Paths to try for the next role, in order: the host's preferred path first, if known."""
+        ordered = [path for path in EXPORT_PATHS if path in available and path in self.paths]
+        preferred = self.preferred(host_url)
+        if preferred in ordered:
+            ordered.remove(preferred)
+            ordered.insert(0, preferred)
+        return ordered
+
+    def record(self, host_url: str, export_path: str, success: bool) -> None:
+        """
+        Notes the outcome of one attempt. The first path to succeed becomes
+        the preferred one; it is replaced only when it has failed and
+        another path then succeeds.
+        """
+        key = self._host_key(host_url)
+        with self._lock:
+            host = self._hosts.setdefault(key, {'preferred': None, 'failed': False})
+            if not success:
+                if host['preferred'] == export_path:
+                    host['failed'] = True
+                return
+            if host['preferred'] == export_path:
+                host['failed'] = False
+                return
+            if host['preferred'] is not None and not host['failed']:
+                return
+            logging.info(f"Export path for this host: {export_path}")
+            host['preferred'], host['failed'] = export_path, False
+            self._save()
+
+    def _save(self) -> None:
+        # Called with the lock held; only runs when the preferred path changes
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(f"{self.path}.tmp", 'w', encoding='utf-8') as store_file:
+                json.dump(self._hosts, store_file)
+            os.replace(f"{self.path}.tmp", self.path)
+        except OSError as e:
+            logging.warning(f"Could not save export path choice: {type(e).__name__}")
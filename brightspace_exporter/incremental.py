@@ -0,0 +1,125 @@
+"""
+Content-hash cache for incremental exports.
+
+Keeps the last exported file of every role per host/ou on disk, addressed
+by SHA-256, so a later run can reuse unchanged roles instead of exporting
+them again. D2L offers no per-role "last modified" signal, so change
+detection is sampled: a few cached roles are exported first, and only if
+all of them still match their cached hash (and the roles API still reports
+the same name) are the remaining cached roles carried over.
+"""
+
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from .archive import DOWNLOAD_CHUNK_SIZE
+
+CHANGE_NEW = 'new'
+CHANGE_CHANGED = 'changed'
+CHANGE_UNCHANGED = 'unchanged'
+CHANGE_CARRIED_OVER = 'carried over'
+
+
+class RoleContentCache:
+    """
+    On-disk cache for one host/ou: `index.json` maps role ids to their last
+    known content hash, and each distinct file is stored once as `<sha256>.gz`.
+    """
+
+    def __init__(self, cache_dir: str, host_url: str, organization_unit_id: int, max_age_days: Optional[float] = 30):
+        host = re.sub(r'[^A-Za-z0-9_.-]+', '_', urlparse(host_url).netloc or host_url)
+        self.directory = os.path.join(cache_dir, f"{host}_ou{int(organization_unit_id)}")
+        self.max_age_days = max_age_days
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self._index: Dict[str, Dict[str, Any]] = {}
+        index_path = os.path.join(self.directory, 'index.json')
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, encoding='utf-8') as index_file:
+                    self._index = json.load(index_file)
+            except (OSError, ValueError):
+                # A damaged index only costs a full export
+                self._index = {}
+
+    def get(self, role_id: int) -> Optional[Dict[str, Any]]:
+        """Cached entry for a role, or None if unknown, expired or its blob is missing."""
+        with self._lock:
+            entry = self._index.get(str(int(role_id)))
+        if not entry or not os.path.exists(self._blob_path(entry['sha256'])):
+            return None
+        if self.max_age_days is not None and time.time() - entry['exported_at'] > self.max_age_days * 86400:
+            return None
+        return entry
+
+    def classify(self, role_id: int, role_name: str, sha256: str) -> str:
+        entry = self.get(role_id)
+        if entry is None:
+            return CHANGE_NEW
+        return CHANGE_UNCHANGED if entry['sha256'] == sha256 and entry['role_name'] == role_name else CHANGE_CHANGED
+
+    def has_blob(self, sha256: str) -> bool:
+        return os.path.exists(self._blob_path(sha256))
+
+    def iter_blob(self, sha256: str) -> Iterator[bytes]:
+        with gzip.open(self._blob_path(sha256), 'rb') as blob:
+            yield from iter(lambda: blob.read(DOWNLOAD_CHUNK_SIZE), b'')
+
+    def store_blob(self, sha256: str, source: BinaryIO) -> None:
+        if self.has_blob(sha256):
+            return
+        # Write-then-rename so a crash never leaves a truncated blob under its final name
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as temporary_file:
+            with gzip.GzipFile(fileobj=temporary_file, mode='wb') as blob:
+                shutil.copyfileobj(source, blob, DOWNLOAD_CHUNK_SIZE)
+        os.replace(temporary_file.name, self._blob_path(sha256))
+
+    def update(self, role_id: int, role_name: str, sha256: str, size: int) -> None:
+        with self._lock:
+            self._index[str(int(role_id))] = {
+                'role_name': role_name,
+                'sha256': sha256,
+                'size': size,
+                'exported_at': time.time(),
+            }
+
+    def save(self) -> None:
+        """Writes the index atomically and drops blobs no role refers to anymore."""
+        with self._lock:
+            index = dict(self._index)
+        index_path = os.path.join(self.directory, 'index.json')
+        with open(f"{index_path}.tmp", 'w', encoding='utf-8') as index_file:
+            json.dump(index, index_file)
+        os.replace(f"{index_path}.tmp", index_path)
+        referenced = {f"{entry['sha256']}.gz" for entry in index.values()}
+        for name in os.listdir(self.directory):
+            if name.endswith('.gz') and name not in referenced:
+                os.remove(os.path.join(self.directory, name))
+
+    def _blob_path(self, sha256: str) -> str:
+        return os.path.join(self.directory, f"{sha256}.gz")
+
+
+def plan_incremental_export(cache: RoleContentCache, role_list: List[Tuple[int, str]], sample_size: int = 3) -> Tuple[List[Tuple[int, str]], List[Tuple[int, str]]]:
+    """
+    Splits `role_list` into (probe_roles, cached_roles): probe_roles is a
+    random sample of at most `sample_size` roles with a usable cache entry
+    and an unchanged name. Roles in neither list are new or renamed and
+    always need exporting.
+    """
+    cached_roles = [
+        (role_id, role_name) for role_id, role_name in role_list
+        if (entry := cache.get(role_id)) is not None and entry['role_name'] == role_name
+    ]
+    probe_roles = random.sample(cached_roles, min(max(1, sample_size), len(cached_roles)))
+    probe_ids = {role_id for role_id, _ in probe_roles}
+    return probe_roles, [role for role in cached_roles if role[0] not in probe_ids]
@@ -0,0 +1,221 @@
+"""
+Background export jobs, so a long export outlives the page that started it.
+
+ExportJobQueue runs submitted exports on a small pool of worker threads
+behind a bounded queue. Every job gets an unguessable id; its state, latest
+progress, result and error live on the ExportJob, which can be polled by
+id while the submitting script has long since returned. The queue does not
+check who asks: callers decide which session a job is handed back to.
+Workers are threads rather than processes: the archive a job fills (a
+SpooledArchive) and the shared browser pool live in this process, and the
+work is network-bound, so the GIL is not what limits it.
+
+Cancellation is cooperative: pass job.report as the export's
+progress_callback and the next progress report after cancel() raises
+JobCancelled, which stops the export with its partial archive finalized.
+Finished jobs are kept for `retention` seconds so their results can be
+fetched, then dropped (and handed to `release`, if given).
+"""
+
+import logging
+import queue
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+JOB_FINISHED_STATES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+
+class JobQueueFull(Exception):
+    """No room for another job, in the queue or for this owner."""
+
+
+class JobCancelled(Exception):
+    """Raised inside a job's progress reports once it has been cancelled."""
+
+
+class ExportJob:
+    """
+    One submitted export. `target(job)` does the work and its return value
+    becomes `result`; `data` holds whatever the submitter attached (e.g. the
+    archive being written) so that whoever picks the job up later can reach it.
+    """
+
+    def __init__(self, target: Callable[['ExportJob'], Any], owner: Optional[str] = None, description: str = '', data: Optional[Dict[str, Any]] = None):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.description = description
+        self.data = data if data is not None else {}
+        self.state = JOB_QUEUED
+        self.progress: Optional[Dict[str, Any]] = None
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.exception: Optional[BaseException] = None
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._target = target
+        self._cancel = threading.Event()
+        self._finished = threading.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self._finished.is_set()
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self._cancel.is_set()
+
+    def report(self, progress: Dict[str, Any]) -> None:
+        """Progress callback for the job's work; raises JobCancelled once cancel() was called."""
+        self.progress = progress
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def cancel(self) -> None:
+        """Asks the job to stop: a queued job never starts, a running one stops at its next report."""
+        self._cancel.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._finished.wait(timeout)
+
+    def run(self) -> None:
+        if self._cancel.is_set():
+            self._finish(JOB_CANCELLED)
+            return
+        self.state, self.started_at = JOB_RUNNING, time.time()
+        try:
+            self.result = self._target(self)
+        except JobCancelled:
+            self._finish(JOB_CANCELLED)
+        except Exception as e:
+            # Keep it generic: exceptions from an export can carry URLs or cookies in their text
+            logging.warning(f"Export job failed: {type(e).__name__}")
+            self.error, self.exception = type(e).__name__, e
+            self._finish(JOB_FAILED)
+        else:
+            self._finish(JOB_DONE)
+
+    def _finish(self, state: str) -> None:
+        # The target closes over the session cookie; do not keep it past the run
+        self._target = None
+        self.state, self.finished_at = state, time.time()
+        self._finished.set()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'state': self.state,
+            'description': self.description,
+            'progress': self.progress,
+            'error': self.error,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class ExportJobQueue:
+    """
+    Thread-safe job queue with `workers` worker threads and room for
+    `max_queued` waiting jobs. `max_per_owner` caps the unfinished jobs of
+    one owner (e.g. one browser session) so a single user cannot occupy
+    every worker. Finished jobs are dropped `retention` seconds after they
+    end unless discard() took them first; `release(job)` is then called so
+    their resources (archives, temp files) can be freed.
+    """
+
+    def __init__(self, workers: int = 2, max_queued: int = 8, max_per_owner: Optional[int] = None, retention: float = 3600.0, release: Optional[Callable[[ExportJob], None]] = None):
+        self.workers = max(1, workers)
+        self.max_per_owner = max_per_owner
+        self.retention = retention
+        self.release = release
+        self._queue: 'queue.Queue[Optional[ExportJob]]' = queue.Queue(maxsize=max(1, max_queued))
+        self._jobs: Dict[str, ExportJob] = {}
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._work, name=f'export-job-{n}', daemon=True) for n in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def submit(self, target: Callable[[ExportJob], Any], owner: Optional[str] = None, description: str = '', data: Optional[Dict[str, Any]] = None) -> ExportJob:
+        """Queues `target(job)` and returns the job; raises JobQueueFull if it cannot be taken."""
+        self.prune()
+        job = ExportJob(target, owner=owner, description=description, data=data)
+        with self._lock:
+            if owner is not None and self.max_per_owner is not None:
+                active = sum(1 for other in self._jobs.values() if other.owner == owner and not other.finished)
+                if active >= self.max_per_owner:
+                    raise JobQueueFull(f"Only {self.max_per_owner} unfinished export(s) per session")
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                raise JobQueueFull("The export queue is full") from None
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: Optional[str]) -> Optional[ExportJob]:
+        with self._lock:
+            return self._jobs.get(job_id) if job_id else None
+
+    def jobs(self, owner: Optional[str] = None) -> List[ExportJob]:
+        """Known jobs in submission order, optionally only those of `owner`."""
+        with self._lock:
+            return [job for job in self._jobs.values() if owner is None or job.owner == owner]
+
+    def position(self, job_id: str) -> int:
+        """How many queued jobs are ahead of this one (0 once it runs or if unknown)."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.state != JOB_QUEUED:
+                return 0
+            return sum(1 for other in self._jobs.values() if other.state == JOB_QUEUED and not other.cancel_requested and other.submitted_at < job.submitted_at)
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return False
+        job.cancel()
+        return True
+
+    def discard(self, job_id: str) -> Optional[ExportJob]:
+        """Forgets a finished job and returns it; the caller takes over its resources."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or not job.finished:
+                return None
+            return self._jobs.pop(job_id)
+
+    def prune(self) -> None:
+        """Drops finished jobs older than `retention`, releasing their resources."""
+        now = time.time()
+        with self._lock:
+            expired = [job for job in self._jobs.values() if job.finished and now - job.finished_at > self.retention]
+            for job in expired:
+                del self._jobs[job.id]
+        for job in expired:
+            if self.release is not None:
+                try:
+                    self.release(job)
+                except Exception as e:
+                    logging.warning(f"Could not release export job: {type(e).__name__}")
+
+    def shutdown(self) -> None:
+        """Cancels unfinished jobs and stops the workers once their current job ends."""
+        for job in self.jobs():
+            job.cancel()
+        for _ in self._threads:
+            # Blocking put: the stop markers queue up behind (now cancelled) waiting jobs
+            self._queue.put(None)
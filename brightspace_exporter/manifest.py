@@ -0,0 +1,111 @@
+"""
+Per-role checkpoint manifest for resumable exports.
+
+Every role file committed to the archive is recorded with its role id,
+filename, size, SHA-256 and timestamp (plus, in deduplicated archives, the
+file its identical content is stored under). With a path, each record is appended
+to a JSON Lines file and flushed immediately, so the manifest survives a
+crash of the exporter itself; without one it lives in memory (Streamlit).
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+from .archive import archive_base_path
+
+
+def manifest_path_for(output_path: str) -> str:
+    """Default sidecar location: roles.zip -> roles.manifest.jsonl"""
+    base = archive_base_path(output_path)
+    return f"{base}.manifest.jsonl"
+
+
+class ExportManifest:
+    """
+    Thread-safe record of completed roles, keyed by role id. A role recorded
+    twice (e.g. re-exported on resume) keeps its latest entry.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._entries: Dict[int, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as manifest_file:
+                for line in manifest_file:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn final line from a crash mid-write; that role is simply re-exported
+                        continue
+                    self._entries[int(entry['role_id'])] = entry
+
+    def record(self, role_id: int, role_name: str, filename: str, size: int, sha256: str, change: Optional[str] = None, stored_as: Optional[str] = None) -> None:
+        entry = {
+            'role_id': int(role_id),
+            'role_name': role_name,
+            'filename': filename,
+            'size': size,
+            'sha256': sha256,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        }
+        if change is not None:
+            # Incremental exports: new / changed / unchanged / carried over
+            entry['change'] = change
+        if stored_as is not None and stored_as != filename:
+            # Deduplicated: the bytes live in the archive under another role's file
+            entry['stored_as'] = stored_as
+        with self._lock:
+            self._entries[entry['role_id']] = entry
+            if self.path:
+                with open(self.path, 'a', encoding='utf-8') as manifest_file:
+                    manifest_file.write(json.dumps(entry) + '\n')
+                    manifest_file.flush()
+
+    def discard(self, role_ids) -> None:
+        """Forgets roles (e.g. entries lost from a damaged archive) and rewrites the file."""
+        with self._lock:
+            for role_id in role_ids:
+                self._entries.pop(int(role_id), None)
+            if self.path:
+                with open(self.path, 'w', encoding='utf-8') as manifest_file:
+                    for entry in self._entries.values():
+                        manifest_file.write(json.dumps(entry) + '\n')
+
+    def get(self, role_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._entries.get(int(role_id))
+
+    def entries(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._entries.values())
+
+    def completed_role_ids(self) -> set:
+        with self._lock:
+            return set(self._entries)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(self.entries())
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+def open_export_manifest(path: str, resume: bool = False) -> ExportManifest:
+    """
+    The manifest file for an export to record into. Unless resuming, any
+    manifest left by an earlier run is removed first: a fresh export must
+    not inherit its checkpoints.
+    """
+    if not resume and os.path.exists(path):
+        os.remove(path)
+    return ExportManifest(path)
@@ -0,0 +1,137 @@
+"""
+Indexed SQLite database of exported permissions for "who can do X" lookups.
+
+Built from the long-format dataset (see dataset.py) with one bulk
+`executemany` inside a single transaction; indexes are created after the
+load, which is much faster than maintaining them row by row. Text columns
+use NOCASE collation, so exact lookups are case-insensitive and still hit
+the indexes.
+"""
+
+import os
+import sqlite3
+from typing import Optional
+
+import pandas as pd
+
+from .archive import archive_base_path
+
+TRUE_VALUES = ('true', 'yes', 'y', '1', 'x', 'on', 'allowed', 'granted', 'checked')
+
+_SCHEMA = """
+CREATE TABLE roles (
+    role_id INTEGER PRIMARY KEY,
+    role_name TEXT NOT NULL COLLATE NOCASE
+);
+CREATE TABLE permissions (
+    role_id INTEGER NOT NULL REFERENCES roles(role_id),
+    tool TEXT COLLATE NOCASE,
+    permission TEXT COLLATE NOCASE,
+    org_unit_type TEXT COLLATE NOCASE,
+    value TEXT,
+    granted INTEGER NOT NULL
+);
+"""
+
+_INDEXES = """
+CREATE INDEX idx_permissions_permission ON permissions (permission, org_unit_type, granted);
+CREATE INDEX idx_permissions_tool ON permissions (tool, permission);
+CREATE INDEX idx_permissions_role ON permissions (role_id);
+CREATE INDEX idx_roles_name ON roles (role_name);
+"""
+
+
+def index_path_for(output_path: str) -> str:
+    """Default location next to the archive: roles.zip -> roles.permissions.sqlite"""
+    base = archive_base_path(output_path)
+    return f"{base}.permissions.sqlite"
+
+
+def build_permission_index(dataset: pd.DataFrame, path: str = ':memory:') -> sqlite3.Connection:
+    """
+    Loads the dataset into a fresh SQLite database at `path` (in memory by
+    default) and returns the open connection. An existing file is replaced.
+    The connection may be used from other threads (Streamlit reruns), one at
+    a time.
+    """
+    if path != ':memory:' and os.path.exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path, check_same_thread=False)
+    # Throwaway build: no journal or fsync needed until the file is complete
+    connection.execute('PRAGMA journal_mode = OFF')
+    connection.execute('PRAGMA synchronous = OFF')
+    connection.executescript(_SCHEMA)
+
+    rows = dataset[['role_id', 'tool', 'permission', 'org_unit_type', 'value']].astype(object)
+    rows = rows.where(rows.notna(), None)
+    rows['granted'] = dataset['value'].astype(str).str.strip().str.lower().isin(TRUE_VALUES).astype(int).to_numpy()
+    roles = dataset[['role_id', 'role_name']].drop_duplicates('role_id').astype(object)
+
+    with connection:
+        connection.executemany('INSERT INTO roles (role_id, role_name) VALUES (?, ?)', roles.itertuples(index=False, name=None))
+        connection.executemany(
+            'INSERT INTO permissions (role_id, tool, permission, org_unit_type, value, granted) VALUES (?, ?, ?, ?, ?, ?)',
+            rows.itertuples(index=False, name=None)
+        )
+    connection.executescript(_INDEXES)
+    connection.execute('ANALYZE')
+    return connection
+
+
+def _match_clause(column: str, term: str):
+    # Plain terms are exact, index-backed matches; * or % switch to a LIKE pattern
+    if '*' in term or '%' in term:
+        return f"{column} LIKE ?", term.replace('*', '%')
+    return f"{column} = ?", term
+
+
+def query_permissions(
+    connection: sqlite3.Connection,
+    permission: Optional[str] = None,
+    tool: Optional[str] = None,
+    org_unit_type: Optional[str] = None,
+    role: Optional[str] = None,
+    granted_only: bool = True,
+    limit: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    Answers "which roles can do X": returns matching rows (role, tool,
+    permission, org unit type, value) ordered by role name. Every filter is
+    optional and case-insensitive; use * as a wildcard, e.g.
+    query_permissions(connection, permission='Impersonate*', org_unit_type='Course Offering').
+    `role` matches a role name or a numeric role id.
+    """
+    clauses, parameters = [], []
+    for column, term in (('p.permission', permission), ('p.tool', tool), ('p.org_unit_type', org_unit_type)):
+        if term:
+            clause, parameter = _match_clause(column, term.strip())
+            clauses.append(clause)
+            parameters.append(parameter)
+    if role:
+        role = role.strip()
+        if role.isdigit():
+            clauses.append('p.role_id = ?')
+            parameters.append(int(role))
+        else:
+            clause, parameter = _match_clause('r.role_name', role)
+            clauses.append(clause)
+            parameters.append(parameter)
+    if granted_only:
+        clauses.append('p.granted = 1')
+
+    sql = (
+        "SELECT r.role_name AS Role, p.role_id AS ID, p.tool AS Tool, p.permission AS Permission, "
+        "p.org_unit_type AS \"Org Unit Type\", p.value AS Value "
+        "FROM permissions p JOIN roles r ON r.role_id = p.role_id"
+    )
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += " ORDER BY r.role_name, p.tool, p.permission, p.org_unit_type"
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    return pd.read_sql_query(sql, connection, params=parameters)
+
+
+def open_permission_index(path: str) -> sqlite3.Connection:
+    """Opens an index written by build_permission_index read-only."""
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
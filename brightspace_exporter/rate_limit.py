@@ -0,0 +1,193 @@
+"""
+Shared, adaptive request pacing for everything that talks to D2L.
+
+One RateController is shared by all workers of an export. It combines a
+token bucket that limits the request rate, an adaptive cap on how many
+roles are exported at once, and a pause that honours Retry-After when the
+host throttles (429/503). Tuning is AIMD: throttling halves the rate and
+the concurrency cap, a latency spike trims them, and every healthy
+response adds a little back, so throughput climbs to what the host
+sustains without getting the session blocked.
+"""
+
+import contextlib
+import email.utils
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional
+
+THROTTLE_STATUSES = (429, 503)
+# A Retry-After longer than this is treated as this; the export should not stall for hours
+MAX_RETRY_AFTER_SECONDS = 120.0
+DEFAULT_MAX_RATE = 10.0
+
+
+class Throttled(Exception):
+    """The host answered 429/503; the controller has already been told."""
+
+    def __init__(self, retry_after: Optional[float] = None):
+        super().__init__()
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date), or None."""
+    if not value:
+        return None
+    value = str(value).strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at is None:
+            return None
+        seconds = retry_at.timestamp() - time.time()
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER_SECONDS)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    """Exponential backoff with jitter: between half and all of min(cap, base * 2**attempt)."""
+    ceiling = min(cap, base * (2 ** attempt))
+    # The random half spreads retries from parallel workers apart
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+class RateController:
+    """
+    Thread-safe pacing shared by every worker of an export.
+
+    acquire() blocks until a request may be sent; slot() bounds the roles in
+    flight to the current `concurrency`. Report each response with
+    succeeded(latency) or throttled(retry_after) so the limits can adapt
+    between `min_rate` and `rate` requests per second, and between one and
+    `max_concurrency` roles at once.
+    """
+
+    def __init__(self, rate: float = DEFAULT_MAX_RATE, max_concurrency: int = 1, min_rate: float = 0.2, latency_spike_factor: float = 3.0):
+        self.max_rate = float(max(rate, min_rate))
+        self.min_rate = min_rate
+        self.rate = self.max_rate
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = self.max_concurrency
+        self.latency_spike_factor = latency_spike_factor
+        self.throttle_count = 0
+        self._burst = float(self.max_concurrency)
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._cooldown_until = 0.0
+        self._latency: Optional[float] = None
+        self._samples = 0
+        self._successes = 0
+        self._consecutive_throttles = 0
+        self._active = 0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        """Waits for a token and for any throttling pause to pass."""
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    @contextlib.contextmanager
+    def slot(self) -> Iterator[None]:
+        """Holds one of the `concurrency` export slots for the duration of the block."""
+        with self._condition:
+            while self._active >= self.concurrency:
+                self._condition.wait()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    def succeeded(self, latency: float) -> None:
+        with self._condition:
+            self._consecutive_throttles = 0
+            now = time.monotonic()
+            spike = self._samples >= 5 and latency > self.latency_spike_factor * self._latency
+            if now >= self._cooldown_until:
+                if spike:
+                    self._decrease(now, rate_factor=0.75, concurrency_step=1, cooldown=self._latency)
+                else:
+                    # Additive increase: 5% of the ceiling per healthy response, one slot per window
+                    self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+                    self._successes += 1
+                    if self.concurrency < self.max_concurrency and self._successes >= self.concurrency:
+                        self.concurrency += 1
+                        self._successes = 0
+                        self._condition.notify_all()
+            self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+            self._samples += 1
+
+    def throttled(self, retry_after: Optional[float] = None) -> None:
+        with self._condition:
+            self.throttle_count += 1
+            now = time.monotonic()
+            pause = retry_after if retry_after is not None else backoff_delay(min(self._consecutive_throttles, 5))
+            self._consecutive_throttles += 1
+            self._paused_until = max(self._paused_until, now + pause)
+            self._tokens = 0.0
+            if now >= self._cooldown_until:
+                # Requests already in flight get throttled too; count the burst as one signal
+                self._decrease(now, rate_factor=0.5, concurrency_step=self.concurrency // 2, cooldown=max(pause, self._latency or 1.0))
+                logging.info(f"Host is throttling; pausing {pause:.1f}s at {self.rate:.2f} req/s, {self.concurrency} in flight")
+
+    def _decrease(self, now: float, rate_factor: float, concurrency_step: int, cooldown: float) -> None:
+        self.rate = max(self.min_rate, self.rate * rate_factor)
+        self.concurrency = max(1, self.concurrency - concurrency_step)
+        self._successes = 0
+        self._cooldown_until = now + cooldown
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._condition:
+            return {'rate': self.rate, 'concurrency': self.concurrency, 'throttle_count': self.throttle_count}
+
+
+def rate_limited_request(send: Callable[..., Any], url: str, rate_controller: Optional[RateController] = None, max_retries: int = 3, max_wait: Optional[float] = None, **kwargs) -> Any:
+    """
+    Calls send(url, **kwargs) (e.g. requests.get or session.get), retrying
+    429/503 responses after their Retry-After or a jittered backoff. Returns
+    the last response, which is still throttled if every retry was. Without
+    a controller, `max_wait` caps the total seconds spent sleeping: a retry
+    that would wait past it is not made and the throttled response returned.
+    """
+    waited = 0.0
+    for attempt in range(max_retries + 1):
+        if rate_controller is not None:
+            rate_controller.acquire()
+        started = time.monotonic()
+        response = send(url, **kwargs)
+        if response.status_code not in THROTTLE_STATUSES:
+            if rate_controller is not None:
+                rate_controller.succeeded(time.monotonic() - started)
+            return response
+
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        if rate_controller is not None:
+            rate_controller.throttled(retry_after)
+        delay = retry_after if retry_after is not None else backoff_delay(attempt)
+        if attempt == max_retries or (rate_controller is None and max_wait is not None and waited + delay > max_wait):
+            return response
+        response.close()
+        if rate_controller is None:
+            time.sleep(delay)
+            waited += delay
+        # With a controller, the next acquire() waits out the pause
+    return response
@@ -0,0 +1,145 @@
+"""
+Per-phase latency instrumentation for role exports.
+
+Every export attempt is timed phase by phase: navigation to the preview (or
+export file) page, the wait for the Export button, the fallback navigation
+to export_file.d2l, the wait for the download link, the download itself and
+the hand-over to the archive writer. A phase that fails (e.g. the button
+wait timing out) is recorded with the time it took to fail, which is
+usually the interesting part. Direct HTTP exports record navigation
+(including any rate-limiter wait) and download, where the download streams
+straight into the archive writer.
+
+ExportTimings collects the per-role records from all workers, serves live
+p50/p95 figures and the ETA, and writes the CSV/JSON timing report.
+"""
+
+import contextlib
+import json
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .archive import archive_base_path
+
+TIMING_PHASES = ['navigate', 'button_wait', 'fallback_navigate', 'link_wait', 'download', 'archive_write']
+TIMING_COLUMNS = ['role_id', 'role_name', 'attempt', 'path', 'phase', 'seconds', 'ok']
+
+
+def timings_path_for(output_path: str, timings_format: str = 'csv') -> str:
+    """Default location next to the archive: roles.zip -> roles.timings.csv"""
+    base = archive_base_path(output_path)
+    return f"{base}.timings.{timings_format}"
+
+
+class RoleTimer:
+    """Phase timings of one role across its attempts and export paths. Used by a single worker."""
+
+    def __init__(self):
+        self.rows: List[Dict[str, Any]] = []
+        self.attempt = 0
+        self.export_path: Optional[str] = None
+        self._started = time.perf_counter()
+
+    def start_attempt(self, export_path: str) -> None:
+        self.attempt += 1
+        self.export_path = export_path
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started, ok = time.perf_counter(), False
+        try:
+            yield
+            ok = True
+        finally:
+            self.rows.append({'attempt': self.attempt, 'path': self.export_path, 'phase': name, 'seconds': time.perf_counter() - started, 'ok': ok})
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._started
+
+
+class ExportTimings:
+    """Thread-safe collection of the RoleTimers of an export, with live percentiles."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows: List[Dict[str, Any]] = []
+        self._roles: List[Dict[str, Any]] = []
+        self._phase_seconds: Dict[str, List[float]] = {phase: [] for phase in TIMING_PHASES}
+        self._role_seconds: List[float] = []
+
+    def add_role(self, role_id: int, role_name: str, timer: RoleTimer, success: bool, method: Optional[str]) -> None:
+        seconds = timer.elapsed()
+        with self._lock:
+            for row in timer.rows:
+                self._rows.append({'role_id': int(role_id), 'role_name': role_name, **row})
+                self._phase_seconds.setdefault(row['phase'], []).append(row['seconds'])
+            self._roles.append({'role_id': int(role_id), 'role_name': role_name, 'method': method, 'success': success, 'attempts': timer.attempt, 'seconds': seconds})
+            self._role_seconds.append(seconds)
+
+    def percentiles(self) -> Dict[str, Tuple[float, float]]:
+        """(p50, p95) seconds per phase seen so far, plus 'role' for whole roles."""
+        with self._lock:
+            samples = {phase: list(seconds) for phase, seconds in self._phase_seconds.items() if seconds}
+            if self._role_seconds:
+                samples['role'] = list(self._role_seconds)
+        return {name: tuple(float(value) for value in np.percentile(seconds, [50, 95])) for name, seconds in samples.items()}
+
+    def eta_seconds(self, remaining: int, concurrency: int) -> Optional[float]:
+        """Expected time for `remaining` roles at `concurrency` in flight, from the role-duration distribution."""
+        with self._lock:
+            if not self._role_seconds:
+                return None
+            # The mean, not the median: a few slow roles (timeouts, retries) are part of the total
+            mean = sum(self._role_seconds) / len(self._role_seconds)
+        return remaining * mean / max(1, concurrency)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """One row per role, attempt and phase (TIMING_COLUMNS)."""
+        with self._lock:
+            return pd.DataFrame(self._rows, columns=TIMING_COLUMNS)
+
+    def summary(self) -> pd.DataFrame:
+        """Count, mean, p50, p95, max and total seconds per phase, failed phases included."""
+        frame = self.to_dataframe()
+        if frame.empty:
+            return pd.DataFrame(columns=['phase', 'count', 'failed', 'mean', 'p50', 'p95', 'max', 'total'])
+        grouped = frame.groupby('phase', sort=False)['seconds']
+        summary = pd.DataFrame({
+            'count': grouped.size(),
+            'failed': frame.assign(failed=~frame['ok'].astype(bool)).groupby('phase', sort=False)['failed'].sum(),
+            'mean': grouped.mean(),
+            'p50': grouped.quantile(0.5),
+            'p95': grouped.quantile(0.95),
+            'max': grouped.max(),
+            'total': grouped.sum(),
+        })
+        order = [phase for phase in TIMING_PHASES if phase in summary.index] + [phase for phase in summary.index if phase not in TIMING_PHASES]
+        return summary.loc[order].rename_axis('phase').reset_index()
+
+    def to_csv_bytes(self) -> bytes:
+        return self.to_dataframe().to_csv(index=False).encode('utf-8')
+
+    def to_json(self) -> str:
+        with self._lock:
+            roles = list(self._roles)
+        return json.dumps({
+            'summary': self.summary().to_dict(orient='records'),
+            'roles': roles,
+            'phases': self.to_dataframe().to_dict(orient='records'),
+        }, indent=2)
+
+    def write(self, path: str) -> None:
+        """Writes the report as JSON (summary, per-role totals, phase rows) for a .json path, else as CSV rows."""
+        if path.endswith('.json'):
+            with open(path, 'w', encoding='utf-8') as report_file:
+                report_file.write(self.to_json())
+        else:
+            self.to_dataframe().to_csv(path, index=False)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._roles)
@@ -0,0 +1,191 @@
+"""
+Excel report of the exported permissions, written in constant memory.
+
+Rows are streamed one role file at a time from the archive into
+XlsxWriter's constant_memory mode, which flushes each row to a temporary
+file as soon as the next one starts, so a multi-million-row report needs
+about as much RAM as the largest role file. Excel caps a sheet at 1,048,576
+rows: the data continues on numbered sheets (Permissions, Permissions 2,
+...) or, with split='workbooks', in numbered workbooks next to the first.
+A Pivot sheet counts, per tool and permission, the org unit types in which
+each role holds it; it is aggregated while streaming and only grows with
+permissions x roles, never with rows.
+"""
+
+import importlib.util
+import os
+import tempfile
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from .archive import archive_base_path
+from .dataset import PERMISSION_COLUMNS, iter_permission_frames
+from .permission_index import TRUE_VALUES
+
+# Checked without importing it: xlsxwriter is only loaded once a report is written
+XLSXWRITER_AVAILABLE = importlib.util.find_spec('xlsxwriter') is not None
+
+EXCEL_MAX_ROWS = 1048576
+# Excel's column limit, less the Tool and Permission columns of the pivot
+PIVOT_MAX_ROLES = 16384 - 2
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+XLSX_SPLIT_MODES = ('sheets', 'workbooks')
+DATA_SHEET_NAME = 'Permissions'
+PIVOT_SHEET_NAME = 'Pivot'
+_HEADERS = ['Role ID', 'Role', 'Tool', 'Permission', 'Org Unit Type', 'Value']
+_COLUMN_WIDTHS = [10, 30, 30, 45, 22, 10]
+
+
+def xlsx_path_for(output_path: str) -> str:
+    """Default location next to the archive: roles.zip -> roles.permissions.xlsx"""
+    base = archive_base_path(output_path)
+    return f"{base}.permissions.xlsx"
+
+
+def workbook_part_path(path: str, part: int) -> str:
+    """Numbered workbook of a split report: roles.permissions.xlsx -> roles.permissions_2.xlsx"""
+    if part == 1:
+        return path
+    base, extension = os.path.splitext(path)
+    return f"{base}_{part}{extension or '.xlsx'}"
+
+
+class _DataSheets:
+    """Appends rows across as many sheets (or workbooks) as Excel's row limit requires."""
+
+    def __init__(self, workbook: 'xlsxwriter.Workbook', destination: Union[str, BinaryIO], split: str, max_rows: int, options: Dict[str, Any]):
+        self.first_workbook = workbook
+        self.workbook = workbook
+        self.destination = destination
+        self.split = split
+        self.rows_per_sheet = max_rows - 1
+        self.options = options
+        self.sheets: List[str] = []
+        self.workbooks: List[str] = [destination] if isinstance(destination, str) else []
+        self.rows = 0
+        self._sheet = None
+        self._sheet_rows = 0
+
+    def _next_sheet(self) -> None:
+        self._finish_sheet()
+        part = len(self.sheets) + 1
+        if self.split == 'workbooks':
+            if part > 1:
+                if self.workbook is not self.first_workbook:
+                    self.workbook.close()
+                path = workbook_part_path(self.destination, part)
+                self.workbook = type(self.first_workbook)(path, self.options)
+                self.workbooks.append(path)
+            name = DATA_SHEET_NAME
+        else:
+            name = DATA_SHEET_NAME if part == 1 else f"{DATA_SHEET_NAME} {part}"
+        self._sheet = self.workbook.add_worksheet(name)
+        self.sheets.append(name if self.split == 'sheets' else f"{os.path.basename(self.workbooks[-1])}:{name}")
+        bold = self.workbook.add_format({'bold': True})
+        for column, width in enumerate(_COLUMN_WIDTHS):
+            self._sheet.set_column(column, column, width)
+        self._sheet.write_row(0, 0, _HEADERS, bold)
+        self._sheet.freeze_panes(1, 0)
+        self._sheet_rows = 0
+
+    def _finish_sheet(self) -> None:
+        if self._sheet is not None and self._sheet_rows:
+            self._sheet.autofilter(0, 0, self._sheet_rows, len(_HEADERS) - 1)
+
+    def append(self, frame: pd.DataFrame) -> None:
+        # None, not NaN: XlsxWriter leaves None cells blank
+        values = frame[PERMISSION_COLUMNS].astype(object)
+        values = values.where(values.notna(), None)
+        for row in values.itertuples(index=False, name=None):
+            if self._sheet is None or self._sheet_rows == self.rows_per_sheet:
+                self._next_sheet()
+            self._sheet_rows += 1
+            # constant_memory: each row is flushed to disk once the next one starts
+            self._sheet.write_row(self._sheet_rows, 0, row)
+        self.rows += len(values)
+
+    def close(self) -> None:
+        if self._sheet is None:
+            self._next_sheet()
+        self._finish_sheet()
+        if self.workbook is not self.first_workbook:
+            self.workbook.close()
+
+
+def _write_pivot(workbook: 'xlsxwriter.Workbook', sheet, pivot_counts: Dict[Tuple[int, str], pd.Series], role_list: Optional[List[Tuple[int, str]]]) -> None:
+    bold = workbook.add_format({'bold': True})
+    # Selection order when known, else by role id; archive order is download order
+    order = {role_id: index for index, (role_id, _) in enumerate(role_list or [])}
+    roles = sorted(pivot_counts, key=lambda role: (order.get(role[0], len(order)), role[0]))[:PIVOT_MAX_ROLES]
+    sheet.write_row(0, 0, ['Tool', 'Permission'] + [f"{role_name} ({role_id})" for role_id, role_name in roles], bold)
+    sheet.set_column(0, 0, 30)
+    sheet.set_column(1, 1, 45)
+    sheet.freeze_panes(1, 2)
+    if not roles:
+        return
+    pivot = pd.concat([pivot_counts[role] for role in roles], axis=1).fillna(0).astype(int).sort_index()
+    for row_index, ((tool, permission), counts) in enumerate(zip(pivot.index, pivot.itertuples(index=False, name=None)), start=1):
+        sheet.write_row(row_index, 0, (tool, permission) + counts)
+    sheet.autofilter(0, 0, len(pivot), len(roles) + 1)
+
+
+def write_permission_workbook(
+    source: Union[str, BinaryIO],
+    destination: Union[str, BinaryIO],
+    archive_format: str = 'zip',
+    role_list: Optional[List[Tuple[int, str]]] = None,
+    split: str = 'sheets',
+    max_rows: int = EXCEL_MAX_ROWS,
+    pivot: bool = True,
+) -> Dict[str, Any]:
+    """
+    Streams every role file of the archive at `source` into an XLSX report
+    at `destination` (a path, or a binary file object for split='sheets').
+    Data rows continue on a new sheet, or with split='workbooks' a new
+    numbered workbook, every `max_rows` rows (header included). With
+    `pivot`, a first sheet counts the org unit types in which each role
+    holds each tool/permission. Returns the row count and the sheets and
+    workbooks written.
+    """
+    if not XLSXWRITER_AVAILABLE:
+        raise RuntimeError("Writing the Excel report requires xlsxwriter (pip install xlsxwriter)")
+    if split not in XLSX_SPLIT_MODES:
+        raise ValueError(f"Unknown split mode: {split}")
+    if split == 'workbooks' and not isinstance(destination, str):
+        raise ValueError("Splitting into workbooks needs a file path as the destination")
+
+    import xlsxwriter
+    options = {'constant_memory': True, 'strings_to_numbers': False, 'strings_to_formulas': False, 'strings_to_urls': False}
+    workbook = xlsxwriter.Workbook(destination, options)
+    # Added first so it is the sheet Excel opens on; written once the counts are complete
+    pivot_sheet = workbook.add_worksheet(PIVOT_SHEET_NAME) if pivot else None
+    data = _DataSheets(workbook, destination, split, max_rows, options)
+    pivot_counts: Dict[Tuple[int, str], pd.Series] = {}
+    try:
+        for frame in iter_permission_frames(source, archive_format, role_list):
+            data.append(frame)
+            if pivot and len(frame):
+                role = (int(frame['role_id'].iloc[0]), str(frame['role_name'].iloc[0]))
+                granted = frame['value'].fillna('').str.strip().str.lower().isin(TRUE_VALUES)
+                counts = granted.groupby([frame['tool'].fillna(''), frame['permission'].fillna('')]).sum()
+                pivot_counts[role] = pivot_counts[role].add(counts, fill_value=0) if role in pivot_counts else counts
+        data.close()
+        if pivot:
+            _write_pivot(workbook, pivot_sheet, pivot_counts, role_list)
+    finally:
+        workbook.close()
+    return {'rows': data.rows, 'sheets': ([PIVOT_SHEET_NAME] if pivot else []) + data.sheets, 'workbooks': data.workbooks}
+
+
+def permission_workbook_bytes(source: Union[str, BinaryIO], archive_format: str = 'zip', role_list: Optional[List[Tuple[int, str]]] = None) -> bytes:
+    """
+    Builds the report (extra rows on numbered sheets) in an anonymous temp
+    file and returns its contents, for download buttons. The rows never sit
+    in memory, but the finished workbook does, once, as the returned bytes;
+    the temp file is closed (and deleted) before returning.
+    """
+    with tempfile.TemporaryFile() as report_file:
+        write_permission_workbook(source, report_file, archive_format, role_list)
+        report_file.seek(0)
+        return report_file.read()
@@ -8,32 +8,51 @@
 #!/usr/bin/env python3
 # -- coding: utf-8 --
 
-import asyncio
-import io
+import hashlib
+import hmac
 import logging
 import os
-import re
-import sys
-import tempfile
 import time
-import zipfile
-import subprocess
-import socket
-from typing import Any, Dict, List, Optional, Tuple
-from urllib.parse import urlparse, urljoin
-from http.cookies import SimpleCookie
+import uuid
+from typing import Optional
+from urllib.parse import urlparse
 
 import pandas as pd
-import requests
 import streamlit as st
-from bs4 import BeautifulSoup
 
-# Attempt to import Playwright
-try:
-    from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
-    PLAYWRIGHT_AVAILABLE = True
-except ImportError:
-    PLAYWRIGHT_AVAILABLE = False
+from brightspace_exporter.archive import (
+    ARCHIVE_FORMATS,
+    COMPRESSION_PRESETS,
+    ArchiveSizeExceeded,
+    SpooledArchive,
+    archive_format_for,
+    available_archive_formats,
+    format_bytes,
+)
+from brightspace_exporter.dataset import DATASET_FORMATS, PYARROW_AVAILABLE, build_permission_dataset, permission_dataset_bytes
+from brightspace_exporter.diff import diff_archives
+from brightspace_exporter.export_paths import ExportPathSelector
+from brightspace_exporter.incremental import RoleContentCache
+from brightspace_exporter.jobs import JOB_CANCELLED, JOB_DONE, JOB_QUEUED, ExportJob, ExportJobQueue, JobQueueFull
+from brightspace_exporter.manifest import ExportManifest
+from brightspace_exporter.permission_index import build_permission_index, query_permissions
+from brightspace_exporter.rate_limit import Throttled
+from brightspace_exporter.timings import TIMING_PHASES, ExportTimings
+from brightspace_exporter.xlsx_report import XLSX_MIME, XLSXWRITER_AVAILABLE, permission_workbook_bytes
+from brightspace_exporter.engine import (
+    PLAYWRIGHT_AVAILABLE,
+    ROLE_LIST_CACHE_TTL_SECONDS,
+    BrowserPool,
+    check_whoami,
+    discover_roles,
+    export_roles_to_archive,
+    format_seconds_to_hms,
+    is_safe_url,
+    normalize_cookie,
+    normalize_url,
+    throttled_message,
+    whoami_url,
+)
 
 # --- CONFIGURATION ---
 st.set_page_config(
@@ -77,201 +96,231 @@ logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(m
 
 TEMPLATE_FILENAME = "Permissions_Report_Template.xlsx"
 
-# --- ASYNCIO SETUP FOR WINDOWS ---
-if sys.platform.startswith("win"):
-    try:
-        asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
-    except Exception:
-        pass
+# Chromium is provisioned lazily by the engine on the first browser export,
+# so starting the app or verifying credentials never waits on an install.
+
+# --- SHARED BROWSER POOL ---
+BROWSER_POOL_MAX_CONTEXTS = 8
+BROWSER_POOL_IDLE_SECONDS = 300
+
+# --- ARCHIVE OUTPUT ---
+# Archives stay in RAM up to this size, then spill to an anonymous temp file
+ARCHIVE_SPOOL_MEMORY_LIMIT = 32 * 1024 * 1024
+ARCHIVE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+# --- INCREMENTAL EXPORTS (opt-in) ---
+# Off unless the operator points this at a private directory: the cache keeps
+# exported files on the server's disk between sessions.
+ROLE_EXPORT_CACHE_DIR = os.environ.get('ROLE_EXPORT_CACHE_DIR')
+
+# --- BACKGROUND EXPORT JOBS ---
+# Exports run on these worker threads instead of the script thread, so reruns
+# and page reloads do not stop them and other sessions stay responsive.
+EXPORT_JOB_WORKERS = int(os.environ.get('EXPORT_JOB_WORKERS', 2))
+EXPORT_JOB_QUEUE_SIZE = 8
+# Archives of exports nobody came back for are freed after this
+EXPORT_JOB_RETENTION_SECONDS = 2 * 60 * 60
+EXPORT_JOB_POLL_SECONDS = 1.0
+
+def release_permission_index() -> None:
+    connection = st.session_state.pop('export_permission_index', None)
+    if connection is not None:
+        connection.close()
+
+def release_export_archive() -> None:
+    archive = st.session_state.pop('export_archive', None)
+    if archive is not None:
+        archive.close()
+    release_permission_index()
+    for key in ('export_manifest', 'export_job', 'export_interrupted', 'export_timings'):
+        st.session_state.pop(key, None)
 
-# --- AUTOMATED BROWSER INSTALLER ---
 @st.cache_resource
-def ensure_playwright_browsers():
-    print("Checking Playwright browser installation...")
-    try:
-        subprocess.run([sys.executable, "-m", "playwright", "install", "chromium"], check=True)
-        print("Playwright browsers installed successfully.")
-    except subprocess.CalledProcessError as e:
-        print(f"Error installing Playwright browsers: {e}")
+def get_browser_pool() -> BrowserPool:
+    # One warm pool per server process, shared by every session and rerun.
+    # Each export job still gets its own isolated browser context.
+    return BrowserPool(max_contexts=BROWSER_POOL_MAX_CONTEXTS, idle_timeout=BROWSER_POOL_IDLE_SECONDS)
 
-if PLAYWRIGHT_AVAILABLE:
-    ensure_playwright_browsers()
+@st.cache_resource
+def get_export_path_selector() -> ExportPathSelector:
+    # Which export path works per host, learned once per server process.
+    # Holds host names only, so sharing it across sessions is harmless.
+    return ExportPathSelector()
 
+def release_job_archive(job: ExportJob) -> None:
+    archive = job.data.get('archive')
+    if archive is not None:
+        archive.close()
 
-# --- SECURITY & UTILITY FUNCTIONS ---
+@st.cache_resource
+def get_export_job_queue() -> ExportJobQueue:
+    # One queue per server process; a session finds its job again by id.
+    # One unfinished export per session, so nobody can hold every worker.
+    return ExportJobQueue(
+        workers=EXPORT_JOB_WORKERS, max_queued=EXPORT_JOB_QUEUE_SIZE, max_per_owner=1,
+        retention=EXPORT_JOB_RETENTION_SECONDS, release=release_job_archive
+    )
 
 def safe_rerun() -> None:
     st.rerun()
 
-def is_safe_url(url: str) -> bool:
+def submit_export_job(job: dict, cookie_header: str, zip_spool: SpooledArchive, manifest: ExportManifest, resume: bool = False) -> None:
     """
-    SSRF Protection: Validates that the URL is http/s and not a local/internal address.
+    Queues the export described by `job` (or its resume) as a background
+    job and reruns; the page then follows the job by id until it finishes.
+    If the run dies midway, the finalized partial archive is kept so the
+    missing roles can be resumed instead of starting over.
     """
-    try:
-        parsed = urlparse(url)
-        if parsed.scheme not in ('http', 'https'):
-            return False
-        
-        hostname = parsed.hostname
-        if not hostname:
-            return False
-            
-        # Block localhost
-        if hostname in ('localhost', '127.0.0.1', '::1', '0.0.0.0'):
-            return False
-            
-        # Optional: specific D2L/Brightspace regex check could go here
-        # if "brightspace.com" not in hostname and "d2l" not in hostname: return False
-        
-        return True
-    except Exception:
-        return False
-
-def normalize_url(url: str) -> str:
-    return (url or '').strip().rstrip('/')
-
-def normalize_cookie(value: str) -> str:
-    if not value:
-        return ''
-    value = value.strip()
-    if value.lower().startswith('cookie:'):
-        value = value[7:].strip()
-    return re.sub(r'\s*;\s*', '; ', value)
-
-def sanitize_filename(name: str, default: str) -> str:
-    safe_name = re.sub(r'[^A-Za-z0-9_. -]+', '_', (name or '').strip())
-    return safe_name or default
-
-def format_seconds_to_hms(total_seconds: float) -> str:
-    total_seconds = max(0, int(total_seconds))
-    minutes, seconds = divmod(total_seconds, 60)
-    hours, minutes = divmod(minutes, 60)
-    return f'{hours:02d}:{minutes:02d}:{seconds:02d}'
-
-def add_cookies_to_browser_context(context, host_url: str, cookie_header: str) -> None:
-    domain = urlparse(host_url).netloc
-    simple_cookie = SimpleCookie()
-    try:
-        simple_cookie.load(cookie_header or '')
-        cookies_for_playwright = [
-            {
-                'name': name,
-                'value': morsel.value,
-                'domain': domain,
-                'path': '/',
-                'secure': host_url.lower().startswith('https'),
-                'httpOnly': False,
-                'sameSite': 'Lax'
-            }
-            for name, morsel in simple_cookie.items()
-        ]
-        if cookies_for_playwright:
-            context.add_cookies(cookies_for_playwright)
-    except Exception as e:
-        logging.warning(f"Error parsing cookies: {e}") # Changed to warning
-
-# --- CORE LOGIC ---
+    cache = None
+    if job.get('incremental') and ROLE_EXPORT_CACHE_DIR:
+        cache = RoleContentCache(ROLE_EXPORT_CACHE_DIR, job['host_url'], job['organization_unit_id'])
+    timings = ExportTimings()
+    # Resolved here: cached resources belong to the script thread, not the job's worker
+    browser_pool, path_selector = get_browser_pool(), get_export_path_selector()
+
+    def export(export_job: ExportJob) -> list:
+        return export_roles_to_archive(
+            zip_spool, job['role_list'], job['host_url'], job['organization_unit_id'], cookie_header,
+            browser_pool=browser_pool,
+            path_selector=path_selector,
+            manifest=manifest,
+            resume=resume,
+            cache=cache,
+            timings=timings,
+            progress_callback=export_job.report,
+            **job['options']
+        )
 
-def check_whoami(api_endpoint_url: str, cookie_header: str) -> Dict[str, Any]:
-    # User-Agent is important for WAFs
-    headers = {'User-Agent': 'Role-Permissions-Exporter/2.0', 'Cookie': cookie_header}
     try:
-        response = requests.get(api_endpoint_url, headers=headers, timeout=15)
-        if response.status_code == 200:
-            user_data = response.json()
-            user_full_name = user_data.get('FirstName', '') + ' ' + user_data.get('LastName', '')
-            return {'status': 'success', 'message': f"Authentication successful for: {user_full_name.strip()}"}
+        export_job = get_export_job_queue().submit(
+            export,
+            owner=st.session_state.setdefault('export_owner', uuid.uuid4().hex),
+            description=f"{len(job['role_list'])} roles from {urlparse(job['host_url']).netloc}",
+            data={
+                'archive': zip_spool,
+                'manifest': manifest,
+                'export_job': job,
+                'timings': timings,
+                'base_zip_name': st.session_state.get('base_zip_name', 'roles'),
+                'archive_format': job['options']['archive_format'],
+                'credential': export_credential(cookie_header),
+            },
+        )
+    except JobQueueFull as e:
+        if not resume:
+            zip_spool.close()
+        st.error(f"⏳ {e}. Try again once a running export has finished.")
+        return
+
+    # The job owns the archive now; results come back when it finishes
+    release_permission_index()
+    for key in ('export_archive', 'export_manifest', 'export_job', 'export_interrupted', 'export_timings', 'export_log'):
+        st.session_state.pop(key, None)
+    st.session_state['export_job_id'] = export_job.id
+    # Lets a reloaded page find the job again (it still has to prove ownership, see reclaim_export_job)
+    st.query_params['job'] = export_job.id
+    safe_rerun()
+
+def export_credential(cookie_header: str) -> str:
+    # Only a digest is kept on the job; the cookie itself must not outlive the run
+    return hashlib.sha256(cookie_header.encode('utf-8')).hexdigest()
+
+def find_own_export_job() -> Optional[ExportJob]:
+    """This session's background export, if it is still known."""
+    export_job = get_export_job_queue().get(st.session_state.get('export_job_id'))
+    if export_job is None or export_job.owner != st.session_state.get('export_owner'):
+        return None
+    return export_job
+
+def reclaim_export_job(job_id: str, cookie_header: str) -> Optional[ExportJob]:
+    """
+    Hands the job named in a reloaded page's URL to this (new) session, but
+    only if `cookie_header` is the Brightspace cookie the export was started
+    with: the job id alone is no proof of ownership, since URLs get shared.
+    """
+    export_job = get_export_job_queue().get(job_id)
+    if export_job is None or not cookie_header:
+        return None
+    if not hmac.compare_digest(export_job.data.get('credential', ''), export_credential(cookie_header)):
+        return None
+    # Takes over the job's per-session slot as well
+    st.session_state['export_owner'] = export_job.owner
+    st.session_state['export_job_id'] = export_job.id
+    return export_job
+
+@st.fragment(run_every=EXPORT_JOB_POLL_SECONDS)
+def show_export_job(job_id: str) -> None:
+    """Live progress of a background export; reruns the whole page once it has finished."""
+    job_queue = get_export_job_queue()
+    export_job = job_queue.get(job_id)
+    if export_job is None or export_job.finished:
+        st.rerun(scope='app')
+
+    progress = export_job.progress
+    if export_job.state == JOB_QUEUED:
+        ahead = job_queue.position(job_id)
+        st.info(f"⏳ Export queued{f' behind {ahead} other export(s)' if ahead else ''}; it starts automatically.")
+    elif progress is None:
+        st.progress(0.0, text='Initializing secure browser...')
+    else:
+        i, total = progress['completed'], progress['total']
+        in_flight = progress['in_flight']
+        st.progress(i / total, text=f"Exported ({i}/{total}): {progress['role']}" + (f" | {in_flight} in flight" if in_flight > 1 else ""))
+        if progress['eta_seconds'] is not None:
+            throttled = f" | 🐢 Throttled {progress['throttle_count']}x, slowed down" if progress['throttle_count'] else ""
+            st.caption(f"✅ {progress['success_count']} | ❌ {progress['failure_count']} | ⏳ ETA: {format_seconds_to_hms(progress['eta_seconds'])}{throttled}")
+        percentiles = progress['percentiles']
+        if percentiles:
+            st.caption("p50 / p95: " + " · ".join(
+                f"{name.replace('_', ' ')} {percentiles[name][0]:.1f}s / {percentiles[name][1]:.1f}s"
+                for name in ['role'] + TIMING_PHASES if name in percentiles
+            ))
+
+    st.caption("Runs in the background: changing settings or reloading this page does not stop it.")
+    if not export_job.cancel_requested and st.button("⏹️ Cancel Export"):
+        # Roles already exported stay in the archive and can be resumed
+        export_job.cancel()
+    if export_job.cancel_requested:
+        st.caption("Stopping after the roles in flight...")
+
+def collect_export_job(export_job: ExportJob) -> None:
+    """Takes a finished job off the queue and puts its archive, manifest and log in session state."""
+    get_export_job_queue().discard(export_job.id)
+    st.session_state.pop('export_job_id', None)
+    st.query_params.pop('job', None)
+    data = export_job.data
+
+    if isinstance(export_job.exception, ArchiveSizeExceeded):
+        data['archive'].close()
+        st.error(f"Export stopped: the archive grew past the {format_bytes(ARCHIVE_MAX_SIZE)} limit. Select fewer roles.")
+        return
+    if export_job.state != JOB_DONE and not len(data['manifest']):
+        # Stopped before its writer opened: the spool is empty, not a valid archive
+        data['archive'].close()
+        if export_job.state == JOB_CANCELLED:
+            st.warning("Export cancelled before it started: no roles were exported.")
         else:
-            return {'status': 'fail', 'message': f"Authentication failed (Status {response.status_code}). Expired cookie or wrong host."}
-    except requests.RequestException as exception:
-        # Log generic error, do not log 'exception' object blindly as it may contain headers
-        logging.error(f"WhoAmI check failed for {api_endpoint_url}") 
-        return {'status': 'fail', 'message': "Network error. Please check URL."}
-
-def fetch_roles_via_api(api_endpoint_url: str, cookie_header: str) -> pd.DataFrame:
-    headers = {'User-Agent': 'Role-Permissions-Exporter/2.0', 'Accept': 'application/json', 'Cookie': cookie_header}
-    try:
-        response = requests.get(api_endpoint_url, headers=headers, timeout=30)
-        response.raise_for_status()
-        roles_data = [{'Identifier': role.get('Identifier'), 'DisplayName': role.get('DisplayName')} for role in response.json()]
-        return pd.DataFrame(roles_data)
-    except Exception as exception:
-        logging.warning(f"API call failed (Status: {getattr(exception.response, 'status_code', 'N/A') if hasattr(exception, 'response') else 'N/A'})")
-        return pd.DataFrame()
-
-def fetch_roles_via_ui_scrape(host_url: str, organization_unit_id: int, cookie_header: str) -> pd.DataFrame:
-    headers = {'Cookie': cookie_header, 'User-Agent': 'Mozilla/5.0'}
-    start_url = f'{host_url}/d2l/lp/security/role_list.d2l?ou={organization_unit_id}'
-    roles, seen_urls, max_pages_to_scrape = [], set(), 50
-    current_url = start_url
-    
-    status_text = st.empty()
-    status_text.text("Scraping role list from UI...")
-
-    for i in range(max_pages_to_scrape):
-        if not current_url or current_url in seen_urls:
-            break
-        seen_urls.add(current_url)
-        try:
-            response = requests.get(current_url, headers=headers, timeout=30)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'html.parser')
-            for anchor in soup.find_all('a', href=re.compile(r'roleId=\d+')):
-                match = re.search(r'roleId=(\d+)', anchor['href'])
-                if match:
-                    roles.append({'Identifier': int(match.group(1)), 'DisplayName': anchor.get_text(strip=True) or f'Role_{match.group(1)}'})
-            next_link_element = soup.find('a', title=re.compile(r'next', re.I))
-            current_url = urljoin(current_url, next_link_element['href']) if next_link_element and 'href' in next_link_element.attrs else None
-        except Exception as exception:
-            logging.warning(f"UI scraping failed on page {i}")
-            break
-            
-    status_text.empty()
-    return pd.DataFrame(roles).drop_duplicates(subset=['Identifier']) if roles else pd.DataFrame()
-
-def export_one_role_v2(page, host_url: str, organization_unit_id: int, role_id: int, role_name: str, page_timeout: int, link_timeout: int, max_retries: int) -> Tuple[bool, str, Optional[bytes]]:
-    last_error_message = "No attempts were made."
-    for attempt in range(max_retries + 1):
-        try:
-            preview_url = f'{host_url}/d2l/lp/security/export_preview.d2l?roleId={role_id}&ou={organization_unit_id}'
-            page.goto(preview_url, wait_until='domcontentloaded', timeout=page_timeout)
-            
-            # Handling the "Export" button
-            export_button = page.get_by_role('button', name=re.compile(r'^\s*Export\s*$', re.I))
-            try:
-                export_button.wait_for(state='visible', timeout=8000)
-                export_button.click()
-            except PlaywrightTimeoutError:
-                file_url = f'{host_url}/d2l/lp/security/export_file.d2l?roleId={role_id}&ou={organization_unit_id}'
-                page.goto(file_url, wait_until='domcontentloaded', timeout=page_timeout)
-            
-            link_locator = page.locator('a[href*="viewFile.d2lfile"]')
-            link_locator.wait_for(state='visible', timeout=link_timeout)
-            
-            with page.expect_download(timeout=link_timeout) as download_info:
-                link_locator.click()
-            
-            download = download_info.value
-            safe_name = sanitize_filename(role_name or f'role_{role_id}', f'role_{role_id}')
-            output_filename = f"{safe_name}_{role_id}.txt"
-            
-            with tempfile.NamedTemporaryFile(delete=False) as temporary_file:
-                temporary_file_path = temporary_file.name
-                download.save_as(temporary_file_path)
-            
-            with open(temporary_file_path, 'rb') as file_handle:
-                file_data = file_handle.read()
-            
-            os.remove(temporary_file_path)
-            return True, output_filename, file_data
-
-        except Exception as exception:
-            # Do not log full exception as it might contain URL parameters or data
-            last_error_message = f'Export failed for {role_id}. Attempt {attempt+1}. Error: {type(exception).__name__}'
-            if attempt < max_retries:
-                time.sleep(3) 
-
-    return False, last_error_message, None
+            st.error("Export failed before any role was exported. Try again.")
+        return
+
+    release_export_archive()
+    st.session_state['export_archive'] = data['archive']
+    st.session_state['export_manifest'] = manifest = data['manifest']
+    st.session_state['export_job'] = job = data['export_job']
+    st.session_state['export_timings'] = data['timings']
+    st.session_state['base_zip_name'] = data['base_zip_name']
+    st.session_state['export_archive_format'] = data['archive_format']
+    if export_job.state == JOB_DONE:
+        st.session_state['export_log'] = export_job.result
+        st.session_state['export_interrupted'] = False
+    else:
+        # Failed or cancelled: whatever the manifest checkpointed is in the archive
+        st.session_state['export_log'] = [
+            {'Role': rname, 'ID': rid, 'Status': 'OK' if manifest.get(rid) else 'Not Exported'}
+            for rid, rname in job['role_list']
+        ]
+        st.session_state['export_interrupted'] = True
+    safe_rerun()
 
 # --- STREAMLIT UI ---
 
@@ -283,10 +332,13 @@ if 'fetched_roles_df' not in st.session_state:
 if 'active_cookie' not in st.session_state:
     st.session_state['active_cookie'] = ""
 
+# This session's running background export; after a reload it is reclaimed below, once the cookie is entered
+active_export_job = find_own_export_job()
+
 # --- SECURITY NOTICE ---
 st.warning("""
 **Security & Privacy Notice:**  
-This tool runs on a public cloud server. While your data is processed in-memory and not saved to disk, 
+This tool runs on a public cloud server. While your data is processed in-memory (very large ZIPs spill to an anonymous temporary file that is deleted when you clear the results or leave, or two hours after an export you never came back for), 
 you are submitting a sensitive Session Cookie.  
 1. **Do not** use this on a shared or public computer.
 2. **Log out** of Brightspace immediately after downloading your ZIP file to invalidate the cookie.
@@ -314,7 +366,7 @@ with st.expander("📖 Instructions & Notes", expanded=False):
     **1. Get Cookie:** Open Incognito > Login Brightspace > DevTools (F12) > Network > Refresh > Click top request > Headers > Copy `Cookie` value.
     **2. Fetch Roles:** Enter URL/Cookie below, click "Fetch Available Roles".
     **3. Select Roles:** Choose which roles to keep.
-    **4. Export:** Click "Start Export" and download the ZIP.
+    **4. Export:** Click "Start Export" and download the ZIP. The export runs in the background, so you can reload the page (enter the same cookie and its URL finds the export again) while it works.
     **5. Logout:** Log out of Brightspace to kill the session.
     
     NOTE: Each Role you select forces the app to generate a complete ‘checklist’ of every possible permission setting in the entire system for that role.
@@ -343,6 +395,10 @@ with col2:
     )
     cookie_header_value = normalize_cookie(cookie_header_raw)
 
+reload_job_id = st.query_params.get('job') if active_export_job is None else None
+if reload_job_id:
+    active_export_job = reclaim_export_job(reload_job_id, cookie_header_value)
+
 if host_url and cookie_header_value:
     # SSRF Check
     if not is_safe_url(host_url):
@@ -351,10 +407,11 @@ if host_url and cookie_header_value:
 
     if st.button("🔍 Verify Credentials"):
         with st.spinner("Verifying session..."):
-            api_url = f'{host_url}/d2l/api/lp/1.48/users/whoami'
-            result = check_whoami(api_url, cookie_header_value)
+            result = check_whoami(whoami_url(host_url), cookie_header_value)
             if result['status'] == 'success':
                 st.success(result['message'])
+            elif result['status'] == 'throttled':
+                st.warning(f"🐢 {result['message']}")
             else:
                 st.error(result['message'])
 
@@ -367,6 +424,7 @@ with col_fetch1:
     organization_unit_id = st.number_input('Org Unit ID (ou)', value=6606, step=1, help="Usually 6606 for the main organization.")
 with col_fetch2:
     exclude_d2lmonitor = st.checkbox("Exclude 'D2LMonitor'", value=True)
+    refresh_roles = st.checkbox("Refresh role list", value=False, help="Role lists are reused for 5 minutes so re-running Step 1 is instant. Tick to fetch again, e.g. after adding a role.")
 
 if st.button("📥 Step 1: Fetch Available Roles", type="primary"):
     if not host_url or not cookie_header_value:
@@ -375,27 +433,27 @@ if st.button("📥 Step 1: Fetch Available Roles", type="primary"):
         st.error("Invalid Host URL.")
     else:
         st.info("Connecting to Brightspace to list roles...")
-        roles_api_url = f'{host_url}/d2l/api/lp/1.48/roles/'
-        
-        # Try API
-        df = fetch_roles_via_api(roles_api_url, cookie_header_value)
-        
-        # Try Scrape if API empty
-        if df.empty:
-            st.warning("API returned no roles. Trying UI scraping...")
-            df = fetch_roles_via_ui_scrape(host_url, organization_unit_id, cookie_header_value)
-            
-        if not df.empty:
-            if exclude_d2lmonitor:
-                df = df[df['DisplayName'] != 'D2LMonitor']
-            
-            # Save to session state
-            st.session_state['fetched_roles_df'] = df.sort_values('DisplayName')
-            st.session_state['active_cookie'] = cookie_header_value
-            
-            st.success(f"Successfully found {len(df)} roles.")
+        status_text = st.empty()
+        try:
+            df = discover_roles(
+                host_url, organization_unit_id, cookie_header_value,
+                exclude_d2lmonitor=exclude_d2lmonitor,
+                progress_callback=status_text.text,
+                cache_ttl=0 if refresh_roles else ROLE_LIST_CACHE_TTL_SECONDS
+            )
+        except Throttled as throttled:
+            status_text.empty()
+            st.warning(f"🐢 {throttled_message(throttled.retry_after)}")
         else:
-            st.error("Could not find any roles. Check Org Unit ID or Cookie.")
+            status_text.empty()
+            if not df.empty:
+                # Save to session state
+                st.session_state['fetched_roles_df'] = df
+                st.session_state['active_cookie'] = cookie_header_value
+
+                st.success(f"Successfully found {len(df)} roles.")
+            else:
+                st.error("Could not find any roles. Check Org Unit ID or Cookie.")
 
 # --- STEP 2: SELECTION & EXPORT ---
 if not st.session_state['fetched_roles_df'].empty:
@@ -406,7 +464,7 @@ if not st.session_state['fetched_roles_df'].empty:
     all_role_names = roles_df['DisplayName'].tolist()
     
     # SELECTION WIDGET
-    st.info("💡 Tip: DE-select roles you don't need to reduce file size; too many roles - say: over 70 - risks hitting the ~1.4million Excel row limit.")
+    st.info("💡 Tip: DE-select roles you don't need to reduce file size; too many roles - say: over 70 - risks hitting the ~1.4million Excel row limit. The Excel Report download continues on extra sheets instead.")
     selected_role_names = st.multiselect(
         "Select Roles to Include in Export:",
         options=all_role_names,
@@ -424,11 +482,40 @@ if not st.session_state['fetched_roles_df'].empty:
             download_link_timeout = st.number_input('Download Wait (ms)', value=30000, step=5000)
         with c3:
             number_of_retries = st.number_input('Retries', value=2, min_value=0, max_value=5)
+        concurrent_exports = st.number_input(
+            'Parallel Exports', value=1, min_value=1, max_value=8,
+            help="Number of roles exported at the same time. Each one runs its own headless browser, so raise carefully on small servers."
+        )
+        direct_http_mode = st.checkbox(
+            'Direct HTTP mode (experimental)', value=False,
+            help="Download files over plain HTTPS without a browser. Roles that fail this way fall back to the browser automatically."
+        )
+        c4, c5 = st.columns(2)
+        with c4:
+            compression_preset = st.selectbox(
+                'Compression', options=list(COMPRESSION_PRESETS), index=list(COMPRESSION_PRESETS).index('default'),
+                help="'store' skips compression entirely; 'max' gives the smallest file but uses the most CPU."
+            )
+        with c5:
+            archive_format = st.selectbox(
+                'Archive Format', options=available_archive_formats(),
+                help="tar.zst is smaller and faster to build, but Excel/Windows cannot open it without extra tools."
+            )
+        dedup_mode = st.checkbox(
+            'Store identical role files once', value=False,
+            help="Roles with byte-identical exports (e.g. cloned TA/Grader roles) are stored once; a _duplicates.csv inside the archive lists which role file holds each duplicate's permissions."
+        )
+        incremental_mode = False
+        if ROLE_EXPORT_CACHE_DIR:
+            incremental_mode = st.checkbox(
+                'Incremental export', value=True,
+                help="Spot-checks a few roles against the last export and, if they are unchanged, reuses the cached files for the rest."
+            )
         append_timestamp = st.checkbox('Append timestamp to filename', value=True)
 
     # EXPORT BUTTON
-    if st.button("🚀 Step 2: Start Export", disabled=(len(selected_role_names) == 0)):
-        if not PLAYWRIGHT_AVAILABLE:
+    if st.button("🚀 Step 2: Start Export", disabled=(len(selected_role_names) == 0 or active_export_job is not None)):
+        if not PLAYWRIGHT_AVAILABLE and not direct_http_mode:
             st.error("Playwright is not available.")
             st.stop()
 
@@ -442,96 +529,95 @@ if not st.session_state['fetched_roles_df'].empty:
         role_list = [(int(row['Identifier']), str(row['DisplayName'])) for _, row in target_roles.iterrows()]
         
         # Setup Export Vars
-        zip_buffer = io.BytesIO()
-        export_log = []
-        success_count = 0
-        failure_count = 0
-        start_time = time.time()
-        
-        progress_bar = st.progress(0.0, text='Initializing secure browser...')
-        status_area = st.empty()
-
-        try:
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_archive:
-                with sync_playwright() as playwright_instance:
-                    
-                    browser = playwright_instance.chromium.launch(
-                        headless=True, 
-                        args=['--no-sandbox', '--disable-dev-shm-usage']
-                    )
-                    
-                    # Secure Context
-                    context = browser.new_context(
-                        accept_downloads=True,
-                        user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
-                        viewport={'width': 1920, 'height': 1080}
-                    )
-                    
-                    add_cookies_to_browser_context(context, host_url, active_cookie)
-                    
-                    page = context.new_page()
-                    
-                    total = len(role_list)
-                    for i, (rid, rname) in enumerate(role_list, 1):
-                        progress_bar.progress(i / total, text=f"Exporting ({i}/{total}): {rname}")
-                        
-                        success, fname, data = export_one_role_v2(
-                            page, host_url, organization_unit_id, rid, rname,
-                            page_load_timeout, download_link_timeout, number_of_retries
-                        )
-                        
-                        if success and data:
-                            success_count += 1
-                            zip_archive.writestr(fname, data)
-                            export_log.append({'Role': rname, 'ID': rid, 'Status': 'OK'})
-                        else:
-                            failure_count += 1
-                            # Only log generic error to UI
-                            export_log.append({'Role': rname, 'ID': rid, 'Status': 'Failed', 'Error': 'Download Failed or Timed Out'})
-                            
-                        elapsed = time.time() - start_time
-                        if elapsed > 0:
-                            rate = i / elapsed
-                            eta = (total - i) / rate
-                            status_area.caption(f"✅ {success_count} | ❌ {failure_count} | ⏳ ETA: {format_seconds_to_hms(eta)}")
-                            
-                    context.close()
-                    browser.close()
-
-            # SAVE RESULTS TO STATE
-            st.session_state['export_zip_buffer'] = zip_buffer
-            st.session_state['export_log'] = export_log
-            
-            netloc = urlparse(host_url).netloc or 'export'
-            base_name = f"{netloc}_roles"
-            if append_timestamp:
-                base_name += f"_{time.strftime('%Y%m%d_%H%M%S')}"
-            st.session_state['base_zip_name'] = base_name
-            
-            safe_rerun()
+        release_export_archive()
+        netloc = urlparse(host_url).netloc or 'export'
+        base_name = f"{netloc}_roles"
+        if append_timestamp:
+            base_name += f"_{time.strftime('%Y%m%d_%H%M%S')}"
+        st.session_state['base_zip_name'] = base_name
+        st.session_state['export_archive_format'] = archive_format
+
+        export_job = {
+            'role_list': role_list,
+            'host_url': host_url,
+            'organization_unit_id': int(organization_unit_id),
+            'incremental': incremental_mode,
+            'options': {
+                'page_timeout': page_load_timeout,
+                'link_timeout': download_link_timeout,
+                'max_retries': number_of_retries,
+                'worker_count': int(concurrent_exports),
+                'direct_http': direct_http_mode,
+                'archive_format': archive_format,
+                'compression': compression_preset,
+                'dedup': dedup_mode,
+            },
+        }
+        submit_export_job(
+            export_job, active_cookie,
+            SpooledArchive(memory_limit=ARCHIVE_SPOOL_MEMORY_LIMIT, max_size=ARCHIVE_MAX_SIZE),
+            ExportManifest()
+        )
 
-        except Exception as e:
-            st.error("Browser process failed.")
-            # Log exception to console for admin, but keep it generic
-            logging.warning(f"Browser Process Error: {type(e).__name__}")
+# --- EXPORT IN PROGRESS ---
+if active_export_job is not None:
+    if active_export_job.finished:
+        collect_export_job(active_export_job)
+    else:
+        st.markdown("---")
+        st.markdown("### Export Progress")
+        show_export_job(active_export_job.id)
+elif reload_job_id and get_export_job_queue().get(reload_job_id) is not None:
+    st.markdown("---")
+    st.info("🔒 This link belongs to a background export. Enter the Cookie Header Value it was started with to follow its progress and collect the results.")
+elif 'export_job_id' in st.session_state or 'job' in st.query_params:
+    st.session_state.pop('export_job_id', None)
+    st.query_params.pop('job', None)
+    st.warning("That export is no longer available; its results were either collected or expired. Start a new export.")
 
 # --- RESULTS DISPLAY ---
-if 'export_zip_buffer' in st.session_state:
+if 'export_archive' in st.session_state:
     st.markdown("---")
-    st.success("🎉 Export Complete!")
-    st.balloons()
+    export_job = st.session_state['export_job']
+    export_manifest = st.session_state['export_manifest']
+    roles_missing = len(export_job['role_list']) - len(export_manifest.completed_role_ids() & {rid for rid, _ in export_job['role_list']})
+
+    if st.session_state.get('export_interrupted'):
+        st.warning(f"⚠️ Export interrupted: {len(export_job['role_list']) - roles_missing} of {len(export_job['role_list'])} roles were saved. Resume to export the rest into the same archive.")
+    else:
+        st.success("🎉 Export Complete!")
+        st.balloons()
+
+    if roles_missing and export_job['options']['archive_format'] == 'zip':
+        if st.button(f"🔁 Resume: export {roles_missing} missing/failed role(s)"):
+            active_cookie = st.session_state.get('active_cookie')
+            if not active_cookie:
+                st.error("Session Error: Cookie lost. Please re-fetch roles (Step 1).")
+                st.stop()
+            submit_export_job(export_job, active_cookie, st.session_state['export_archive'], export_manifest, resume=True)
     
     col_d1, col_d2 = st.columns(2)
     fname = st.session_state.get('base_zip_name', 'roles')
+    export_archive = st.session_state['export_archive']
+    archive_extension, archive_mime = ARCHIVE_FORMATS[st.session_state.get('export_archive_format', 'zip')]
     
     with col_d1:
+        # Deferred: the archive is only copied into memory when the button is clicked, not on every rerun
         st.download_button(
-            label="📥 Download Permissions ZIP",
-            data=st.session_state['export_zip_buffer'].getvalue(),
-            file_name=f"{fname}.zip",
-            mime="application/zip",
+            label="📥 Download Permissions ZIP" if archive_extension == '.zip' else "📥 Download Permissions Archive",
+            data=export_archive.getvalue,
+            file_name=f"{fname}{archive_extension}",
+            mime=archive_mime,
+            on_click="ignore",
             use_container_width=True
         )
+        footprint = export_archive.memory_footprint()
+        st.caption(
+            f"Archive size: {format_bytes(footprint['archive_bytes'])} | "
+            f"held in memory: {format_bytes(footprint['in_memory_bytes'])} | "
+            f"spooled to temp disk: {format_bytes(footprint['on_disk_bytes'])}. "
+            "Downloading copies the whole archive into memory while it is served."
+        )
     
     with col_d2:
         log_df = pd.DataFrame(st.session_state.get('export_log', []))
@@ -543,10 +629,141 @@ if 'export_zip_buffer' in st.session_state:
             use_container_width=True
         )
         
-    with st.expander("View Log Details"):
-        st.dataframe(log_df, use_container_width=True)
+    if PYARROW_AVAILABLE:
+        # Long-format table of every role file; avoids Excel's row limit entirely
+        col_p1, col_p2 = st.columns([1, 3])
+        with col_p1:
+            dataset_format = st.selectbox('Dataset Format', options=list(DATASET_FORMATS), label_visibility='collapsed')
+        with col_p2:
+            dataset_extension, dataset_mime = DATASET_FORMATS[dataset_format]
+            st.download_button(
+                label="📊 Download Permissions Dataset",
+                data=lambda: permission_dataset_bytes(export_archive, st.session_state.get('export_archive_format', 'zip'), export_job['role_list'], dataset_format),
+                file_name=f"{fname}.permissions{dataset_extension}",
+                mime=dataset_mime,
+                on_click="ignore",
+                use_container_width=True,
+                help="One row per role, tool, permission and org unit type. Opens in pandas, Power BI or DuckDB without Excel's row limit."
+            )
 
+    if XLSXWRITER_AVAILABLE:
+        # Built on click into a temp file, then copied into memory while the download is served; rows past Excel's limit continue on the next sheet
+        st.download_button(
+            label="📗 Download Excel Report",
+            data=lambda: permission_workbook_bytes(export_archive, st.session_state.get('export_archive_format', 'zip'), export_job['role_list']),
+            file_name=f"{fname}.permissions.xlsx",
+            mime=XLSX_MIME,
+            on_click="ignore",
+            use_container_width=True,
+            help="Every permission row, continued on numbered sheets past Excel's 1,048,576-row limit, plus a Pivot sheet counting the org unit types in which each role holds each permission."
+        )
+
+    export_timings = st.session_state.get('export_timings')
+    if export_timings is not None and len(export_timings):
+        with st.expander("⏱️ Phase Timings"):
+            st.caption("Where the export time went, per phase of each attempt (failed waits included). Use it to tune timeouts.")
+            st.dataframe(export_timings.summary().round(2), hide_index=True, use_container_width=True)
+            col_t1, col_t2 = st.columns(2)
+            with col_t1:
+                st.download_button(
+                    label="⏱️ Download Timings (CSV)",
+                    data=export_timings.to_csv_bytes,
+                    file_name=f"{fname}.timings.csv",
+                    mime='text/csv',
+                    on_click="ignore",
+                    use_container_width=True
+                )
+            with col_t2:
+                st.download_button(
+                    label="⏱️ Download Timings (JSON)",
+                    data=lambda: export_timings.to_json().encode('utf-8'),
+                    file_name=f"{fname}.timings.json",
+                    mime='application/json',
+                    on_click="ignore",
+                    use_container_width=True
+                )
+
+    with st.expander("🔎 Query Permissions"):
+        st.caption("Which roles can do X? Filters are case-insensitive; use * as a wildcard (e.g. `Impersonate*`).")
+        q1, q2, q3, q4 = st.columns(4)
+        with q1:
+            query_permission = st.text_input('Permission', key='query_permission')
+        with q2:
+            query_tool = st.text_input('Tool', key='query_tool')
+        with q3:
+            query_org_unit_type = st.text_input('Org Unit Type', key='query_org_unit_type')
+        with q4:
+            query_role = st.text_input('Role (name or ID)', key='query_role')
+        query_granted_only = st.checkbox('Only granted permissions', value=True, key='query_granted_only')
+
+        if any((query_permission, query_tool, query_org_unit_type, query_role)):
+            if 'export_permission_index' not in st.session_state:
+                with st.spinner("Indexing exported role files..."):
+                    # In-memory SQLite, built once per export and dropped with the results
+                    st.session_state['export_permission_index'] = build_permission_index(
+                        build_permission_dataset(export_archive, st.session_state.get('export_archive_format', 'zip'), export_job['role_list'])
+                    )
+            query_start = time.perf_counter()
+            query_results = query_permissions(
+                st.session_state['export_permission_index'],
+                permission=query_permission,
+                tool=query_tool,
+                org_unit_type=query_org_unit_type,
+                role=query_role,
+                granted_only=query_granted_only,
+            )
+            st.caption(f"{len(query_results):,} matching rows across {query_results['ID'].nunique()} role(s) in {(time.perf_counter() - query_start) * 1000:.1f} ms")
+            st.dataframe(query_results, use_container_width=True, hide_index=True)
 
+    with st.expander("View Log Details"):
+        st.dataframe(log_df, use_container_width=True)
 
+    with st.expander("View Checkpoint Manifest"):
+        manifest_df = export_manifest.to_dataframe()
+        st.dataframe(manifest_df, use_container_width=True)
+        st.download_button(
+            label="🧾 Download Manifest (CSV)",
+            data=manifest_df.to_csv(index=False).encode('utf-8'),
+            file_name=f"{fname}_manifest.csv",
+            mime='text/csv'
+        )
 
+    if st.button("🗑️ Clear Results from Server"):
+        release_export_archive()
+        st.session_state.pop('export_log', None)
+        safe_rerun()
 
+# --- COMPARE EXPORTS ---
+st.markdown("---")
+with st.expander("🔀 Compare Two Exports (audit diff)"):
+    st.caption("Upload an earlier and a later archive from this tool to see which permissions were added, removed or changed per role. The files are only used for this comparison and are not kept.")
+    c_old, c_new = st.columns(2)
+    with c_old:
+        old_upload = st.file_uploader('Earlier export', type=['zip', 'zst'], key='diff_old')
+    with c_new:
+        new_upload = st.file_uploader('Later export', type=['zip', 'zst'], key='diff_new')
+
+    if old_upload and new_upload and st.button("Compare Exports"):
+        try:
+            with st.spinner("Comparing exports..."):
+                diff_start = time.perf_counter()
+                diff_changes, diff_summary = diff_archives(old_upload, new_upload, archive_format_for(old_upload.name), archive_format_for(new_upload.name))
+        except Exception as e:
+            logging.warning(f"Diff Error: {type(e).__name__}")
+            st.error("Could not read one of the archives. Make sure both were produced by this tool.")
+        else:
+            changed_roles = diff_summary[diff_summary['status'] != 'unchanged']
+            m1, m2, m3, m4 = st.columns(4)
+            m1.metric('Roles changed', f"{len(changed_roles)} / {len(diff_summary)}")
+            m2.metric('Added', f"{(diff_changes['change'] == 'added').sum():,}")
+            m3.metric('Removed', f"{(diff_changes['change'] == 'removed').sum():,}")
+            m4.metric('Changed', f"{(diff_changes['change'] == 'changed').sum():,}")
+            st.caption(f"Compared in {time.perf_counter() - diff_start:.1f}s")
+            st.dataframe(changed_roles, use_container_width=True, hide_index=True)
+            st.dataframe(diff_changes, use_container_width=True, hide_index=True)
+            st.download_button(
+                label="📄 Download Change Report (CSV)",
+                data=diff_changes.to_csv(index=False).encode('utf-8'),
+                file_name=f"{os.path.splitext(old_upload.name)[0]}_vs_{os.path.splitext(new_upload.name)[0]}_changes.csv",
+                mime='text/csv'
+            )
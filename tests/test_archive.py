@@ -0,0 +1,65 @@
+import io
+
+import pytest
+
+from brightspace_exporter.archive import ZSTD_AVAILABLE, PipelinedArchiveWriter, SpooledArchive, iter_archive_members
+
+CHUNK = b'x' * 65536
+ARCHIVE_FORMATS = ['zip', pytest.param('tar.zst', marks=pytest.mark.skipif(not ZSTD_AVAILABLE, reason='needs zstandard'))]
+
+
+def _stream_failing_after(chunk_count):
+    for _ in range(chunk_count):
+        yield CHUNK
+    raise ConnectionError('connection dropped')
+
+
+@pytest.mark.parametrize('archive_format', ARCHIVE_FORMATS)
+def test_stream_larger_than_buffer_failing_halfway_leaves_no_entry(archive_format):
+    output, checkpoints = io.BytesIO(), []
+    writer = PipelinedArchiveWriter(output, archive_format, entry_buffer_bytes=4 * len(CHUNK), on_entry_written=lambda name, size, *_: checkpoints.append((name, size)))
+    with pytest.raises(ConnectionError):
+        writer.write_stream('Role_1.txt', _stream_failing_after(10))
+    # The per-role fallback writes the same name again
+    writer.write_stream('Role_1.txt', [b'Tool,Permission\n'])
+    writer.close()
+
+    output.seek(0)
+    entries = [(name, len(member.read())) for name, member in iter_archive_members(output, archive_format)]
+    assert entries == [('Role_1.txt', 16)]
+    assert checkpoints == [('Role_1.txt', 16)]
+    assert writer.error is None
+
+
+@pytest.mark.parametrize('archive_format', ARCHIVE_FORMATS)
+def test_stream_larger_than_buffer_is_written_whole(archive_format):
+    output = io.BytesIO()
+    with PipelinedArchiveWriter(output, archive_format, entry_buffer_bytes=4 * len(CHUNK)) as writer:
+        writer.write_stream('Role_2.txt', (CHUNK for _ in range(10)))
+
+    output.seek(0)
+    assert [(name, member.read()) for name, member in iter_archive_members(output, archive_format)] == [('Role_2.txt', CHUNK * 10)]
+
+
+def test_spooled_archive_readers_keep_their_own_position():
+    archive = SpooledArchive(memory_limit=len(CHUNK))
+    with PipelinedArchiveWriter(archive, 'zip') as writer:
+        writer.write_stream('Role_3.txt', (CHUNK for _ in range(4)))
+    expected = archive.getvalue()
+
+    # Interleaved reads, as when two downloads and the query index overlap
+    first, second = archive.open_reader(), archive.open_reader()
+    parts_first, parts_second = [], []
+    while True:
+        chunk_first, chunk_second = first.read(1000), second.read(777)
+        parts_first.append(chunk_first)
+        parts_second.append(chunk_second)
+        if not chunk_first and not chunk_second:
+            break
+    first.close()
+    second.close()
+
+    assert b''.join(parts_first) == expected
+    assert b''.join(parts_second) == expected
+    assert [(name, member.read()) for name, member in iter_archive_members(archive, 'zip')] == [('Role_3.txt', CHUNK * 4)]
+    assert not archive.closed